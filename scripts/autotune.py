@@ -0,0 +1,120 @@
+import argparse
+import os
+import time
+import numpy as np
+from db_manager import DBManager
+from gallery import DEFAULT_TREES, DEFAULT_SEARCH_K, NEAREST_NEIGHBOURS
+from image_processor import ImageProcessor, ENCODING_LENGTH
+
+
+def split_holdout(encodings_dict, n_holdout, seed=0):
+    """
+    Hold out one encoding of up to n_holdout celebs that have at least two, so each held-out celeb is still in
+    the gallery. Returns (gallery_dict, holdout_encodings, holdout_ids).
+    """
+    rng = np.random.default_rng(seed)
+    candidates = [imdb_id for imdb_id, encodings in encodings_dict.items() if len(encodings) >= 2]
+    held_out = set(rng.choice(candidates, size=min(n_holdout, len(candidates)), replace=False).tolist()) \
+        if candidates else set()
+
+    gallery_dict, holdout_encodings, holdout_ids = {}, [], []
+    for imdb_id, encodings in encodings_dict.items():
+        if imdb_id in held_out:
+            # Never hold out the first (main image) encoding
+            position = int(rng.integers(1, len(encodings)))
+            holdout_encodings.append(encodings[position])
+            holdout_ids.append(imdb_id)
+            encodings = encodings[:position] + encodings[position + 1:]
+        gallery_dict[imdb_id] = encodings
+    return gallery_dict, np.array(holdout_encodings, dtype=np.float32).reshape(-1, ENCODING_LENGTH), holdout_ids
+
+
+def evaluate(image_processor, encodings, expected_ids, k, search_k):
+    """Top-1 accuracy and mean latency of matching the held-out encodings one request at a time."""
+    start = time.perf_counter()
+    matched = [image_processor.match_encodings(encoding[None], k=k, search_k=search_k)[0] for encoding in encodings]
+    mean_ms = (time.perf_counter() - start) / len(encodings) * 1000
+    accuracy = float(np.mean([m == e for m, e in zip(matched, expected_ids)]))
+    return accuracy, mean_ms
+
+
+def autotune(encodings_dict, target_accuracy, trees_list, search_ks, ks, n_holdout):
+    """
+    Sweep trees, search_k and k on a held-out split and pick the cheapest configuration that reaches
+    target_accuracy, by mean query latency. Falls back to the most accurate configuration if none does.
+    Returns (best, results): best is a dict with trees, k, search_k, top1_accuracy and mean_query_ms.
+    """
+    gallery_dict, holdout_encodings, holdout_ids = split_holdout(encodings_dict, n_holdout)
+    if not holdout_ids:
+        raise ValueError("No celeb has more than one encoding to hold out.")
+    print(f"Tuning on {len(holdout_ids)} held-out encodings against "
+          f"{sum(len(encodings) for encodings in gallery_dict.values())} gallery encodings.")
+
+    results = []
+    for trees in trees_list:
+        image_processor = ImageProcessor(bucket_name=None, search_backend="annoy")
+        start = time.perf_counter()
+        image_processor.build_annoy_index_and_mapping(gallery_dict, ENCODING_LENGTH, trees, version="autotune")
+        build_s = time.perf_counter() - start
+        for k in ks:
+            for search_k in search_ks:
+                accuracy, mean_ms = evaluate(image_processor, holdout_encodings, holdout_ids, k, search_k)
+                results.append({"trees": trees, "k": k, "search_k": search_k, "top1_accuracy": accuracy,
+                                "mean_query_ms": mean_ms, "build_s": build_s})
+                print(f"trees={trees:<4} k={k:<3} search_k={search_k:<7} top-1 {accuracy:.4f}  {mean_ms:.3f} ms/query")
+        image_processor.annoy_index.unload()
+
+    passing = [result for result in results if result["top1_accuracy"] >= target_accuracy]
+    if passing:
+        # Fewer trees breaks latency ties, since it also means a smaller index and a faster build
+        best = min(passing, key=lambda result: (result["mean_query_ms"], result["trees"]))
+    else:
+        print(f"No configuration reached top-1 accuracy {target_accuracy}, using the most accurate one.")
+        best = max(results, key=lambda result: (result["top1_accuracy"], -result["mean_query_ms"]))
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tune trees/search_k/k on held-out Face_Encodings and build the index with the chosen values.")
+    parser.add_argument("--target-accuracy", type=float, default=0.95)
+    parser.add_argument("--trees", default=f"{DEFAULT_TREES},25,50")
+    parser.add_argument("--search-k", default=f"{DEFAULT_SEARCH_K},500,2000,10000")
+    parser.add_argument("--k", default=f"5,10,{NEAREST_NEIGHBOURS}")
+    parser.add_argument("--holdout", type=int, default=2000, help="Number of celebs to hold one encoding out of.")
+    parser.add_argument("--index", default="../data/new_annoy.ann")
+    parser.add_argument("--mapping", default="../data/new_idx_labels")
+    args = parser.parse_args()
+
+    db_manager = DBManager(
+        host="celebs-database-1.c4duzx241qat.eu-north-1.rds.amazonaws.com",
+        user=os.environ.get("DB_USER"),
+        password=os.environ.get("DB_PASSWORD"),
+        database="celebs_database",
+        table="Celebs2")
+    encodings_dict = {}
+    for imdb_ids, encodings in db_manager.iter_processed_celebs_encodings():
+        for imdb_id, encoding in zip(imdb_ids, encodings):
+            encodings_dict.setdefault(imdb_id, []).append(encoding)
+
+    best, _ = autotune(encodings_dict, args.target_accuracy, [int(trees) for trees in args.trees.split(",")],
+                       [int(search_k) for search_k in args.search_k.split(",")],
+                       [int(k) for k in args.k.split(",")], args.holdout)
+    print(f"Chosen: {best}")
+
+    # Build the served index on every encoding, with the chosen parameters in its metadata
+    metadata = {"k": best["k"], "search_k": best["search_k"],
+                "autotune": {"target_accuracy": args.target_accuracy, "top1_accuracy": best["top1_accuracy"],
+                             "mean_query_ms": best["mean_query_ms"], "holdout": args.holdout,
+                             "tuned_at": time.strftime("%Y-%m-%dT%H:%M:%S")}}
+    image_processor = ImageProcessor(bucket_name=None, search_backend="annoy")
+    image_processor.build_annoy_index_from_batches(
+        (([imdb_id] * len(encodings), encodings) for imdb_id, encodings in encodings_dict.items()),
+        ENCODING_LENGTH, best["trees"], metadata=metadata)
+    image_processor.save_annoy_index_and_mapping(args.index, args.mapping)
+    print(f"Saved the tuned index to {args.index} and its labels to {args.mapping}. "
+          f"Reload it with POST /admin/reloadIndex/.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from db_manager import DBManager
+from image_processor import ImageProcessor, compute_face_encodings, ENCODING_LENGTH
+from main import load_image_as_np_array
+from utils import download_image
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+# Images whose faces are looked up in the gallery and the DB together
+LOOKUP_BATCH_SIZE = 256
+
+
+def list_image_sources(source):
+    """
+    Expand a batch source into image paths and URLs.
+    Parameters:
+    - source: A directory (every image in it, recursively), or a text file with one path or URL per line.
+    """
+    if os.path.isdir(source):
+        return sorted(os.path.join(root, name) for root, _, names in os.walk(source)
+                      for name in names if name.lower().endswith(IMAGE_EXTENSIONS))
+    with open(source) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def encode_image_source(image_source):
+    """
+    Load one image from disk or a URL and compute its face encodings. Runs in the batch process pool.
+    Returns (encodings, error): an (N, 128) array, or None and the error message if the image couldn't be used.
+    """
+    try:
+        if image_source.startswith(("http://", "https://")):
+            image_np = download_image(image_source)
+        else:
+            image_np = load_image_as_np_array(image_source)
+        return compute_face_encodings(image_np), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def recognize_batch(image_sources, image_processor: ImageProcessor, db_manager: DBManager = None, workers=None,
+                    batch_size=LOOKUP_BATCH_SIZE):
+    """
+    Recognize the celebs in many images, yielding one result dict per image in input order.
+    Images are decoded and encoded across a process pool. The faces of every batch_size images are matched
+    against the gallery in one vectorized call and their celebs' info is fetched with one bulk query.
+    Parameters:
+    - image_sources: Image paths and/or URLs.
+    - image_processor: ImageProcessor with a loaded index.
+    - db_manager: Used to add each celeb's name and page; without it only IMDb IDs are returned.
+    - workers: Number of encoding processes. Defaults to the number of CPUs.
+    - batch_size: Number of images per gallery lookup and DB query.
+    """
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as encoding_pool:
+        results = encoding_pool.map(encode_image_source, image_sources, chunksize=4)
+        batch = []
+        for image_source, (encodings, error) in zip(image_sources, results):
+            batch.append((image_source, encodings, error))
+            if len(batch) == batch_size:
+                yield from resolve_batch(batch, image_processor, db_manager)
+                batch = []
+        if batch:
+            yield from resolve_batch(batch, image_processor, db_manager)
+
+
+def resolve_batch(batch, image_processor: ImageProcessor, db_manager: DBManager = None):
+    # Step 1: Match the faces of all images in the batch at once
+    face_counts = [len(encodings) if encodings is not None else 0 for _, encodings, _ in batch]
+    all_encodings = [encodings for _, encodings, _ in batch if encodings is not None and len(encodings)]
+    all_encodings = np.vstack(all_encodings) if all_encodings else np.empty((0, ENCODING_LENGTH), np.float32)
+    matched_ids, scores = image_processor.match_encodings_with_scores(all_encodings)
+
+    # Step 2: Fetch the info of every matched celeb with one query
+    celeb_infos = db_manager.get_celeb_infos(celeb_id for celeb_id in matched_ids if celeb_id) if db_manager else {}
+
+    # Step 3: Split the matches back per image
+    start = 0
+    for (image_source, _, error), face_count in zip(batch, face_counts):
+        faces = []
+        for celeb_id, score in zip(matched_ids[start:start + face_count], scores[start:start + face_count]):
+            celeb_info = celeb_infos.get(celeb_id)
+            faces.append({"imdb_id": celeb_id,
+                          "name": celeb_info[1] if celeb_info else None,
+                          "page_url": celeb_info[5] if celeb_info else None,
+                          "score": score})
+        start += face_count
+        result = {"source": image_source, "faces": faces}
+        if error:
+            result["error"] = error
+        yield result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recognize the celebs in a set of images, writing JSON lines.")
+    parser.add_argument("source", help="Directory of images, or a text file with one image path or URL per line.")
+    parser.add_argument("--output", help="JSONL output file. Defaults to stdout.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=LOOKUP_BATCH_SIZE)
+    parser.add_argument("--backend", default="auto", choices=["annoy", "numpy", "auto"])
+    parser.add_argument("--scoring", default="vote", choices=["vote", "weighted"])
+    parser.add_argument("--threshold", type=float, help="Report faces scored above this as unknown.")
+    parser.add_argument("--index", default="../data/new_annoy.ann")
+    parser.add_argument("--mapping", default="../data/new_idx_labels")
+    parser.add_argument("--no-db", action="store_true", help="Only output IMDb IDs, without celeb names.")
+    args = parser.parse_args()
+
+    image_processor = ImageProcessor(bucket_name='celebs-images-bucket-2', search_backend=args.backend,
+                                     scoring=args.scoring, match_threshold=args.threshold)
+    image_processor.load_annoy_index_and_mapping(ENCODING_LENGTH, args.index, args.mapping)
+    db_manager = None
+    if not args.no_db:
+        db_manager = DBManager(
+            host="celebs-database-1.c4duzx241qat.eu-north-1.rds.amazonaws.com",
+            user=os.environ.get("DB_USER"),
+            password=os.environ.get("DB_PASSWORD"),
+            database="celebs_database",
+            table="Celebs2")
+
+    image_sources = list_image_sources(args.source)
+    output = open(args.output, "w") if args.output else sys.stdout
+    n_images = n_faces = n_errors = 0
+    start = time.perf_counter()
+    try:
+        for result in recognize_batch(image_sources, image_processor, db_manager, args.workers, args.batch_size):
+            output.write(json.dumps(result, default=str) + "\n")
+            n_images += 1
+            n_faces += len(result["faces"])
+            n_errors += "error" in result
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Recognized {n_faces} faces in {n_images} images ({n_errors} failed) in {elapsed:.1f}s: "
+          f"{n_images / elapsed:.2f} images/sec, {n_images / elapsed / args.workers:.2f} images/sec per core.",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Offline benchmarks. Run them from the scripts directory, e.g. `python -m benchmarks.bench_brute_force_index`."""
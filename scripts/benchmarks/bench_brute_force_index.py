@@ -0,0 +1,60 @@
+import argparse
+import time
+import numpy as np
+from annoy import AnnoyIndex
+from brute_force_index import BruteForceIndex
+from benchmarks.synthetic import make_gallery, make_queries, recall_at_k, ENCODING_LENGTH
+
+K = 15
+
+
+def build_indexes(encodings_dict, trees):
+    vectors = np.array([encoding for encodings in encodings_dict.values() for encoding in encodings])
+    annoy_index = AnnoyIndex(ENCODING_LENGTH, 'euclidean')
+    for i, vector in enumerate(vectors):
+        annoy_index.add_item(i, vector)
+    annoy_index.build(trees)
+
+    brute_force_index = BruteForceIndex(ENCODING_LENGTH)
+    brute_force_index.set_vectors(vectors)
+    return annoy_index, brute_force_index
+
+
+def time_per_query(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the exact NumPy index against Annoy on a synthetic gallery.")
+    parser.add_argument("--celebs", type=int, default=300)
+    parser.add_argument("--per-celeb", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--faces-per-image", type=int, default=10)
+    parser.add_argument("--trees", type=int, default=10)
+    args = parser.parse_args()
+
+    encodings_dict, centres = make_gallery(args.celebs, args.per_celeb)
+    queries, _ = make_queries(centres, args.queries)
+    annoy_index, brute_force_index = build_indexes(encodings_dict, args.trees)
+    print(f"Gallery: {brute_force_index.get_n_items()} encodings of {args.celebs} celebs, {args.queries} queries.")
+
+    # Ground truth comes from the exact index
+    exact_rows, _ = brute_force_index.query(queries, K)
+    annoy_rows = np.array([annoy_index.get_nns_by_vector(q, K) + [-1] * K for q in queries])[:, :K]
+
+    annoy_single = time_per_query(lambda: [annoy_index.get_nns_by_vector(q, K) for q in queries], 3) / len(queries)
+    numpy_single = time_per_query(lambda: [brute_force_index.query(q, K) for q in queries], 3) / len(queries)
+    batch = queries[:args.faces_per_image]
+    numpy_batch = time_per_query(lambda: brute_force_index.query(batch, K), 20)
+
+    print(f"annoy (trees={args.trees}): {annoy_single * 1e6:8.1f} us/query, "
+          f"recall@{K} = {recall_at_k(annoy_rows, exact_rows):.3f}")
+    print(f"numpy brute force:     {numpy_single * 1e6:8.1f} us/query, recall@{K} = 1.000")
+    print(f"numpy batch of {len(batch)} faces: {numpy_batch * 1e6:8.1f} us/image")
+
+
+if __name__ == "__main__":
+    main()
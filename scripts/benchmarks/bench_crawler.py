@@ -0,0 +1,93 @@
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import scrape_manager
+from crawler import Crawler
+from ingestion_jobs import JobStore
+from benchmarks.fixture_server import start_fixture_server, LIST_PATH
+
+
+class RecordingDBManager:
+    """Stand-in for the DBManager calls made while scraping; records what would have been written."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.celebs = {}
+        self.main_images = {}
+        self.additional_images = {}
+
+    def insert_celeb(self, celeb_id, name, dob, dod, age, page_url):
+        with self._lock:
+            self.celebs[celeb_id] = (name, dob, dod, age, page_url)
+
+    def update_celeb_main_image_url(self, celeb_id, image_url, to_s3=False):
+        with self._lock:
+            self.main_images[celeb_id] = image_url
+
+    def insert_additional_images_urls(self, celeb_id, images_list):
+        with self._lock:
+            self.additional_images[celeb_id] = list(images_list)
+
+    def delete_additional_images_urls(self, celeb_id):
+        with self._lock:
+            self.additional_images.pop(celeb_id, None)
+
+
+def scrape_list(base_url, celeb_concurrency, args):
+    """Scrape the fixture list page with a fresh crawler. Returns (seconds, db, crawler stats)."""
+    scrape_manager.IMDB_DOMAIN = base_url
+    scrape_manager.CELEB_CONCURRENCY = celeb_concurrency
+    scrape_manager._crawler = Crawler(per_host_concurrency=args.per_host, per_host_rate=args.rate,
+                                      backoff_base=0.01, headers_factory=scrape_manager.build_headers)
+    db_manager = RecordingDBManager()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # A fresh job table, so no celeb counts as already scraped
+        jobs = JobStore(os.path.join(tmp_dir, "jobs.sqlite"))
+        start = time.perf_counter()
+        soup = scrape_manager.scrape_html(base_url + LIST_PATH)
+        scrape_manager.process_imdb_list(soup, db_manager, None, jobs)
+        elapsed = time.perf_counter() - start
+        jobs.close()
+    stats = scrape_manager._crawler.stats()
+    scrape_manager._crawler.close()
+    return elapsed, db_manager, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scrape a local IMDb fixture server, sequentially and concurrently.")
+    parser.add_argument("--celebs", type=int, default=20)
+    parser.add_argument("--photos", type=int, default=15)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.05, help="Share of responses that are 503s.")
+    parser.add_argument("--per-host", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=0, help="Requests per second per host, 0 for unlimited.")
+    parser.add_argument("--html-dir", help="Saved IMDb pages to serve instead of synthetic ones.")
+    args = parser.parse_args()
+
+    server, base_url = start_fixture_server(args.html_dir, args.celebs, args.photos, args.latency_ms / 1000,
+                                            args.error_rate)
+    results = {}
+    for label, concurrency in [("sequential", 1), ("concurrent", scrape_manager.CELEB_CONCURRENCY)]:
+        elapsed, db_manager, stats = scrape_list(base_url, concurrency, args)
+        results[label] = db_manager
+        print(f"{label:<10} ({concurrency} celebs at once): {elapsed:6.2f}s, {len(db_manager.celebs)} celebs, "
+              f"crawler {stats}")
+    print(f"fixture server: {server.stats()}")
+    server.shutdown()
+
+    # Both runs must scrape the same data, and every celeb must be complete despite the injected errors
+    sequential, concurrent = results["sequential"], results["concurrent"]
+    complete = (len(concurrent.celebs) == args.celebs and len(concurrent.main_images) == args.celebs
+                and all(None not in urls for urls in concurrent.additional_images.values()))
+    if args.html_dir is None and not (complete and sequential.celebs == concurrent.celebs
+                                      and sequential.additional_images == concurrent.additional_images):
+        print("FAIL: concurrent scrape differs from the sequential one or is incomplete.")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
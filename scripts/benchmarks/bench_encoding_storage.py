@@ -0,0 +1,45 @@
+import argparse
+import time
+import numpy as np
+from utils import string_to_encoding_main_image, string_to_encoding_additional_image, strings_to_encodings, \
+    encoding_to_blob, blobs_to_encodings
+from benchmarks.synthetic import make_gallery
+
+
+def timed(label, fn, n_encodings):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<45} {elapsed * 1000:9.1f}ms  ({elapsed / n_encodings * 1e6:6.2f} us/encoding)")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare decoding Face_Encodings rows from TEXT and from BLOB.")
+    parser.add_argument("--celebs", type=int, default=2000)
+    parser.add_argument("--per-celeb", type=int, default=20)
+    args = parser.parse_args()
+
+    encodings_dict, _ = make_gallery(args.celebs, args.per_celeb)
+    encodings = [encoding.astype(np.float64) for celeb_encodings in encodings_dict.values()
+                 for encoding in celeb_encodings]
+    n = len(encodings)
+
+    # The stored forms, as insert_face_encoding wrote them before and after the switch to binary storage
+    main_strs = [','.join(map(str, [encoding])) for encoding in encodings]
+    additional_strs = [','.join(map(str, encoding)) for encoding in encodings]
+    blobs = [encoding_to_blob(encoding) for encoding in encodings]
+    print(f"{n} encodings. Stored size per encoding: main text {np.mean([len(s) for s in main_strs]):.0f}B, "
+          f"additional text {np.mean([len(s) for s in additional_strs]):.0f}B, blob {len(blobs[0])}B")
+
+    timed("text, string_to_encoding_main_image", lambda: [string_to_encoding_main_image(s) for s in main_strs], n)
+    timed("text, string_to_encoding_additional_image",
+          lambda: [string_to_encoding_additional_image(s) for s in additional_strs], n)
+    timed("text, strings_to_encodings (batched)", lambda: strings_to_encodings(additional_strs), n)
+    decoded = timed("blob, np.frombuffer (batched)", lambda: blobs_to_encodings(blobs), n)
+
+    assert np.allclose(decoded, np.array(encodings, dtype=np.float32))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import glob
+import os
+import time
+import numpy as np
+from image_processor import detect_faces, compute_face_encodings
+from main import load_image_as_np_array
+
+# Same-person threshold used by face_recognition.compare_faces
+MATCH_TOLERANCE = 0.6
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def compare_encodings(reference, encodings):
+    """Number of reference faces also found in encodings, and the largest distance among those matches."""
+    if len(reference) == 0 or len(encodings) == 0:
+        return 0, 0.0
+    distances = np.linalg.norm(reference[:, None, :] - encodings[None, :, :], axis=2).min(axis=1)
+    matched = distances <= MATCH_TOLERANCE
+    return int(matched.sum()), float(distances[matched].max()) if matched.any() else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Face detection latency and accuracy against the detection size.")
+    parser.add_argument("--images", default="../images4README/*.jpg")
+    parser.add_argument("--max-sides", default="0,2048,1024,640", help="0 detects at full resolution.")
+    parser.add_argument("--model", default="hog", choices=["hog", "cnn"])
+    parser.add_argument("--upsample", type=int, default=1)
+    parser.add_argument("--jitters", type=int, default=1)
+    args = parser.parse_args()
+    max_sides = [int(max_side) for max_side in args.max_sides.split(",")]
+
+    for path in sorted(glob.glob(args.images)):
+        image_np = load_image_as_np_array(path)
+        print(f"{os.path.basename(path)} ({image_np.shape[1]}x{image_np.shape[0]})")
+        # Full-resolution detection is the reference the downscaled runs are compared against
+        reference = compute_face_encodings(image_np, 0, args.model, args.upsample, args.jitters)
+        for max_side in max_sides:
+            boxes, detect_ms = timed(detect_faces, image_np, max_side, args.model, args.upsample)
+            encodings, total_ms = timed(compute_face_encodings, image_np, max_side, args.model, args.upsample,
+                                        args.jitters)
+            matched, max_distance = compare_encodings(reference, encodings)
+            print(f"  max_side {max_side or 'full':>5}: detect {detect_ms:8.1f}ms, detect+encode {total_ms:8.1f}ms, "
+                  f"{len(boxes)} faces, {matched}/{len(reference)} reference faces matched "
+                  f"(max encoding distance {max_distance:.3f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import json
+import os
+import sys
+import time
+from html_extraction import AVAILABLE_BACKENDS, HTML_PARSER
+from benchmarks.fixture_server import celeb_page, media_index_page, media_viewer_page
+from tests.saved_pages import SAVED_PAGES_DIR, GOLDEN_PATH, page_kind, load_pages, extract, legacy_extract
+
+
+def synthetic_pages(n_celebs, padding_kb):
+    """Fixture server pages, padded with a <script> blob like the JSON IMDb embeds in every page."""
+    padding = f'<body><script type="application/json">{"x" * padding_kb * 1024}</script>'
+    pages = {}
+    for i in range(1, n_celebs + 1):
+        imdb_id = f"nm{i:07d}"
+        pages[f"name_{imdb_id}.html"] = celeb_page(imdb_id).replace("<body>", padding)
+        pages[f"name_{imdb_id}_mediaindex.html"] = media_index_page(imdb_id, 20).replace("<body>", padding)
+        pages[f"name_{imdb_id}_mediaviewer_rm1.html"] = media_viewer_page(imdb_id, 1).replace("<body>", padding)
+    return pages
+
+
+def time_ms(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the HTML extractors against golden results and time them.")
+    parser.add_argument("--html-dir", default=SAVED_PAGES_DIR,
+                        help="Saved IMDb pages (name_nm0000001.html, ..._mediaindex.html, ..._mediaviewer_rm1.html).")
+    parser.add_argument("--golden", default=GOLDEN_PATH,
+                        help="JSON file of expected results per page. Written from the legacy extraction if missing "
+                             "or with --update-golden, and then has to be checked by hand.")
+    parser.add_argument("--update-golden", action="store_true")
+    parser.add_argument("--synthetic", action="store_true",
+                        help="Time padded synthetic fixture pages instead, checked against the legacy extraction.")
+    parser.add_argument("--celebs", type=int, default=5)
+    parser.add_argument("--padding-kb", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    pages = synthetic_pages(args.celebs, args.padding_kb) if args.synthetic else load_pages(args.html_dir)
+    if not pages:
+        sys.exit(f"No profile, media index or photo pages found in {args.html_dir}.")
+    golden_path = None if args.synthetic else args.golden
+
+    # Step 1: Expected results, from the golden file or the legacy extraction
+    golden = {}
+    if golden_path and os.path.exists(golden_path) and not args.update_golden:
+        with open(golden_path) as f:
+            golden = json.load(f)
+    legacy = {file_name: legacy_extract(page_kind(file_name), file_name, html) for file_name, html in pages.items()}
+    expected = {file_name: golden.get(file_name, legacy[file_name]) for file_name in pages}
+    if golden_path and (args.update_golden or not golden):
+        with open(golden_path, "w") as f:
+            json.dump(legacy, f, indent=2, sort_keys=True)
+        print(f"Wrote golden results for {len(legacy)} pages to {golden_path}, check them by hand")
+
+    # Step 2: Check and time every backend on every page
+    print(f"BeautifulSoup tree builder: {HTML_PARSER}, backends: {', '.join(AVAILABLE_BACKENDS)}")
+    print(f"{'page':<45} {'kb':>6} {'legacy ms':>10} " + " ".join(f"{b + ' ms':>14}" for b in AVAILABLE_BACKENDS))
+    mismatches = []
+    totals = {backend: 0.0 for backend in ("legacy",) + AVAILABLE_BACKENDS}
+    for file_name, html in pages.items():
+        kind = page_kind(file_name)
+        if legacy[file_name] != expected[file_name]:
+            mismatches.append((file_name, "legacy", legacy[file_name], expected[file_name]))
+        row = {"legacy": time_ms(lambda: legacy_extract(kind, file_name, html), args.repeat)}
+        for backend in AVAILABLE_BACKENDS:
+            result = extract(kind, file_name, html, backend)
+            if result != expected[file_name]:
+                mismatches.append((file_name, backend, result, expected[file_name]))
+            row[backend] = time_ms(lambda: extract(kind, file_name, html, backend), args.repeat)
+        for backend, ms in row.items():
+            totals[backend] += ms
+        print(f"{file_name:<45} {len(html) / 1024:>6.0f} {row['legacy']:>10.2f} "
+              + " ".join(f"{row[b]:>14.2f}" for b in AVAILABLE_BACKENDS))
+    print(f"{'total':<45} {'':>6} {totals['legacy']:>10.2f} "
+          + " ".join(f"{totals[b]:>14.2f}" for b in AVAILABLE_BACKENDS))
+
+    for file_name, backend, result, wanted in mismatches:
+        print(f"MISMATCH {file_name} [{backend}]: got {result!r}, expected {wanted!r}")
+    if mismatches:
+        sys.exit(1)
+    print(f"All backends match the expected results on {len(pages)} pages.")
+
+
+if __name__ == "__main__":
+    main()
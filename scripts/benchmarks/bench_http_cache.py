@@ -0,0 +1,87 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import scrape_manager
+from crawler import Crawler
+from http_cache import HTTPCache
+from ingestion_jobs import JobStore
+from benchmarks.bench_crawler import RecordingDBManager
+from benchmarks.fixture_server import start_fixture_server, LIST_PATH
+
+
+def scrape_list(base_url, cache, jobs_path):
+    """
+    Scrape the fixture list page through cache with a fresh crawler and job table.
+    Returns (seconds, db, crawler stats).
+    """
+    scrape_manager.IMDB_DOMAIN = base_url
+    scrape_manager._crawler = Crawler(backoff_base=0.01, per_host_rate=0, headers_factory=scrape_manager.build_headers,
+                                      cache=cache)
+    db_manager = RecordingDBManager()
+    start = time.perf_counter()
+    soup = scrape_manager.scrape_html(base_url + LIST_PATH)
+    if soup is not None:
+        jobs = JobStore(jobs_path)
+        scrape_manager.process_imdb_list(soup, db_manager, None, jobs)
+        jobs.close()
+    elapsed = time.perf_counter() - start
+    stats = scrape_manager._crawler.stats()
+    scrape_manager._crawler.close()
+    return elapsed, db_manager, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-scrape a local IMDb fixture server through the HTTP cache: "
+                                                 "cold, warm, revalidating and offline.")
+    parser.add_argument("--celebs", type=int, default=20)
+    parser.add_argument("--photos", type=int, default=15)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--html-dir", help="Saved IMDb pages to serve instead of synthetic ones.")
+    args = parser.parse_args()
+
+    server, base_url = start_fixture_server(args.html_dir, args.celebs, args.photos, args.latency_ms / 1000)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "http_cache.sqlite")
+        # Each run opens the file anew, like a re-run of the scraper would
+        runs = [
+            ("cold", lambda: HTTPCache(path, ttl=3600)),
+            ("warm", lambda: HTTPCache(path, ttl=3600)),
+            # Two hours later every entry is stale, so each one is revalidated with its ETag
+            ("revalidate", lambda: HTTPCache(path, ttl=3600, clock=lambda: time.time() + 7200)),
+            ("offline", lambda: HTTPCache(path, offline=True)),
+        ]
+        results = {}
+        for label, make_cache in runs:
+            if label == "offline":
+                server.shutdown()
+                server.server_close()
+            requests_before = server.stats()["requests"]
+            cache = make_cache()
+            elapsed, db_manager, stats = scrape_list(base_url, cache, os.path.join(tmp_dir, f"jobs_{label}.sqlite"))
+            results[label] = db_manager
+            print(f"{label:<10}: {elapsed:6.2f}s, {len(db_manager.celebs)} celebs, "
+                  f"{server.stats()['requests'] - requests_before} server requests, cache {cache.stats()}")
+            cache.close()
+        print(f"fixture server: {server.stats()}")
+
+        # A cap below the cached bytes must evict down to it, least recently used first
+        capped = HTTPCache(path, max_bytes=64 * 1024)
+        capped._evict()
+        print(f"capped to 64 KiB: {capped.stats()}")
+        evicted_ok = capped.total_bytes <= capped.max_bytes
+        capped.close()
+
+    # Every run must scrape exactly what the cold one did, and only the cold one may download pages
+    cold = results["cold"]
+    same = all(run.celebs == cold.celebs and run.main_images == cold.main_images
+               and run.additional_images == cold.additional_images for run in results.values())
+    if not (same and len(cold.celebs) and evicted_ok):
+        print("FAIL: cached runs differ from the cold one, nothing was scraped, or the size cap was not enforced.")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
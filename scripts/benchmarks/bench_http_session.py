@@ -0,0 +1,48 @@
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from http_session import http_get, connection_stats, ACCEPT_ENCODING, HTTP_TIMEOUT
+from benchmarks.fixture_server import start_fixture_server, media_viewer_page
+
+
+def fetch_all(get, urls, threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        texts = list(executor.map(lambda url: get(url).text, urls))
+    return time.perf_counter() - start, texts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="New connection per request vs the shared pooled session.")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=2)
+    args = parser.parse_args()
+
+    urls = [f"/name/nm{i % 50 + 1:07d}/mediaviewer/rm{i}/" for i in range(args.requests)]
+    expected = [media_viewer_page(f"nm{i % 50 + 1:07d}", i) for i in range(args.requests)]
+    print(f"Accept-Encoding sent by the shared session: {ACCEPT_ENCODING}")
+
+    for label, get in [("requests.get per call", lambda url: requests.get(url, timeout=HTTP_TIMEOUT)),
+                       ("shared session", http_get)]:
+        # A fresh gzip-serving fixture server per run, so its connection count covers only this client
+        server, base_url = start_fixture_server(latency=args.latency_ms / 1000, compress=True)
+        elapsed, texts = fetch_all(get, [base_url + url for url in urls], args.threads)
+        server_stats = server.stats()
+        server.shutdown()
+        if texts != expected:
+            print(f"FAIL: {label} returned bodies that don't match the uncompressed pages.")
+            sys.exit(1)
+        print(f"{label:<22} {args.requests / elapsed:8.1f} req/s, "
+              f"{server_stats['connections']} TCP connections for {server_stats['requests']} requests")
+
+    stats = connection_stats()
+    print(f"shared session pool stats: {stats['requests']} requests, {stats['connections']} connections opened, "
+          f"reuse rate {stats['reuse_rate']:.1%}")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
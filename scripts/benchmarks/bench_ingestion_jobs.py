@@ -0,0 +1,142 @@
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from ingestion_jobs import JobStore, SkipJob, run_pipeline, run_stage, STAGES, MAIN_ENCODED, DONE, SKIPPED
+
+
+class FlakyStages:
+    """
+    Stand-in stage handlers: each one sleeps for latency seconds and fails at error_rate. A few celebs have no
+    usable main image and are skipped. Successful runs are appended to log_path, one "<imdb_id> <stage>" per line.
+    """
+
+    def __init__(self, latency, error_rate, log_path, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.log_path = log_path
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def handler(self, stage):
+        def run(imdb_id):
+            time.sleep(self.latency)
+            with self._lock:
+                failed = self._random.random() < self.error_rate
+            if failed:
+                raise RuntimeError("injected failure")
+            if stage == MAIN_ENCODED and imdb_id.endswith("7"):
+                raise SkipJob("no single face in the main image")
+            with self._lock, open(self.log_path, "a") as f:
+                f.write(f"{imdb_id} {stage}\n")
+        return run
+
+    def handlers(self, workers):
+        return {stage: (self.handler(stage), workers) for stage in STAGES}
+
+
+def make_store(path):
+    # Short backoff and lease so the benchmark doesn't wait on real-world timings
+    return JobStore(path, max_attempts=20, backoff_base=0.01, lease_seconds=60)
+
+
+def crashing_run(jobs_path, log_path, latency, error_rate, workers, crash_after):
+    """Run the pipeline in a child process that dies abruptly after crash_after seconds, mid-work."""
+    threading.Timer(crash_after, os._exit, args=(1,)).start()
+    stages = FlakyStages(latency, error_rate, log_path, seed=1)
+    run_pipeline(make_store(jobs_path), stages.handlers(workers), poll_interval=0.05)
+
+
+def read_log(log_path):
+    if not os.path.exists(log_path):
+        return []
+    with open(log_path) as f:
+        return [tuple(line.split()) for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a flaky five-stage ingestion through the job table: stage by "
+                                                 "stage, pipelined, and crashed then resumed.")
+    parser.add_argument("--celebs", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--error-rate", type=float, default=0.1)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--crash-after", type=float, default=0.5, help="Seconds before the crashing run is killed.")
+    args = parser.parse_args()
+
+    imdb_ids = [f"nm{i:07d}" for i in range(1, args.celebs + 1)]
+    latency = args.latency_ms / 1000
+    failed_checks = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        def fresh(label):
+            jobs = make_store(os.path.join(tmp_dir, f"{label}.sqlite"))
+            jobs.add_celebs(imdb_ids)
+            return jobs, os.path.join(tmp_dir, f"{label}.log")
+
+        # Step 1: Every stage over every celeb before the next stage starts, as the old scripts ran
+        jobs, log_path = fresh("sequential")
+        stages = FlakyStages(latency, args.error_rate, log_path)
+        start = time.perf_counter()
+        for stage in STAGES:
+            run_stage(jobs, stage, stages.handler(stage), args.workers, poll_interval=0.05)
+        sequential_s = time.perf_counter() - start
+        print(f"stage by stage: {sequential_s:6.2f}s, {jobs.counts()}")
+
+        # Step 2: All stages at once, each celeb moving on as soon as its previous stage is done
+        jobs, log_path = fresh("pipelined")
+        stages = FlakyStages(latency, args.error_rate, log_path)
+        start = time.perf_counter()
+        run_pipeline(jobs, stages.handlers(args.workers), poll_interval=0.05)
+        pipelined_s = time.perf_counter() - start
+        print(f"pipelined:      {pipelined_s:6.2f}s ({sequential_s / pipelined_s:.1f}x), {jobs.counts()}")
+
+        # Step 3: Crash a run part way through, then resume it from the job table
+        jobs, log_path = fresh("crashed")
+        jobs_path = os.path.join(tmp_dir, "crashed.sqlite")
+        child = multiprocessing.get_context("spawn").Process(
+            target=crashing_run, args=(jobs_path, log_path, latency, args.error_rate, args.workers, args.crash_after))
+        child.start()
+        child.join()
+        done_before_crash = len(read_log(log_path))
+        print(f"crashed run:    exit code {child.exitcode}, {done_before_crash} stage runs done, {jobs.counts()}")
+        # The crashed worker is gone, so its running jobs can be handed out right away
+        recovered = jobs.recover()
+        start = time.perf_counter()
+        run_pipeline(jobs, FlakyStages(latency, args.error_rate, log_path, seed=2).handlers(args.workers),
+                     poll_interval=0.05)
+        print(f"resumed:        {time.perf_counter() - start:6.2f}s after recovering {recovered} running jobs, "
+              f"{jobs.counts()}")
+
+        # Step 4: Every run must finish every job, and the resumed one must only redo what was in flight
+        for label in ("sequential", "pipelined", "crashed"):
+            label_jobs = make_store(os.path.join(tmp_dir, f"{label}.sqlite"))
+            unfinished = {stage: {status: n for status, n in counts.items() if status not in (DONE, SKIPPED)}
+                          for stage, counts in label_jobs.counts().items()}
+            if any(unfinished.values()):
+                failed_checks.append(f"{label} left unfinished jobs: {unfinished}")
+            runs = read_log(os.path.join(tmp_dir, f"{label}.log"))
+            redone = len(runs) - len(set(runs))
+            expected_runs = sum(label_jobs.counts()[stage].get(DONE, 0) for stage in STAGES)
+            if len(set(runs)) != expected_runs:
+                failed_checks.append(f"{label}: {len(set(runs))} distinct stage runs for {expected_runs} done jobs")
+            if label == "crashed":
+                print(f"redone after the crash: {redone} stage runs (at most {args.workers * len(STAGES)} in flight)")
+                if redone > args.workers * len(STAGES):
+                    failed_checks.append(f"resume redid {redone} stage runs")
+            elif redone:
+                failed_checks.append(f"{label} ran {redone} stages twice")
+            label_jobs.close()
+
+    for check in failed_checks:
+        print(f"FAIL: {check}")
+    if failed_checks:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import argparse
+import os
+import time
+import boto3
+from botocore.config import Config
+import utils
+from utils import create_presigned_url, create_presigned_urls, S3_REGION
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
+
+BUCKET_NAME = 'celebs-images-bucket-bench'
+
+
+def create_presigned_url_per_call_client(bucket_name, image_s3_url, expiration=3600):
+    """The previous implementation: a new boto3 client for every URL."""
+    s3 = boto3.client('s3', config=Config(signature_version='s3v4'), region_name=S3_REGION)
+    key = image_s3_url.split(".s3.amazonaws.com/")[-1]
+    return s3.generate_presigned_url('get_object', Params={'Bucket': bucket_name, 'Key': key}, ExpiresIn=expiration)
+
+
+def per_call_ms(fn, n):
+    start = time.perf_counter()
+    fn()
+    return (time.perf_counter() - start) / n * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-request cost of generating pre-signed URLs, against moto.")
+    parser.add_argument("--urls", type=int, default=200)
+    parser.add_argument("--faces-per-request", type=int, default=5)
+    args = parser.parse_args()
+
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        boto3.client('s3', region_name=S3_REGION).create_bucket(
+            Bucket=BUCKET_NAME, CreateBucketConfiguration={'LocationConstraint': S3_REGION})
+        s3_urls = [f"https://{BUCKET_NAME}.s3.amazonaws.com/nm{i:07d}_Name/main_image.jpg" for i in range(args.urls)]
+
+        new_client = per_call_ms(lambda: [create_presigned_url_per_call_client(BUCKET_NAME, url) for url in s3_urls],
+                                 len(s3_urls))
+        utils.presigned_url_cache.clear()
+        shared_cold = per_call_ms(lambda: [create_presigned_url(BUCKET_NAME, url) for url in s3_urls], len(s3_urls))
+        shared_warm = per_call_ms(lambda: [create_presigned_url(BUCKET_NAME, url) for url in s3_urls], len(s3_urls))
+        batches = [s3_urls[i:i + args.faces_per_request] for i in range(0, len(s3_urls), args.faces_per_request)]
+        batch_warm = per_call_ms(lambda: [create_presigned_urls(BUCKET_NAME, batch) for batch in batches], len(batches))
+
+    print(f"new client per URL:          {new_client:8.3f} ms/URL")
+    print(f"shared client, cache miss:   {shared_cold:8.3f} ms/URL")
+    print(f"shared client, cache hit:    {shared_warm:8.3f} ms/URL")
+    print(f"batch of {args.faces_per_request} (cached):          {batch_warm:8.3f} ms/request")
+    print(f"cache: {utils.presigned_url_cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import argparse
+import time
+import numpy as np
+from image_processor import ImageProcessor
+from benchmarks.synthetic import make_gallery, make_queries, ENCODING_LENGTH
+
+
+def make_unknown_queries(n_queries, seed=2):
+    """Encodings of people who are not in the gallery: fresh centres drawn like make_gallery's."""
+    _, centres = make_gallery(n_queries, 1, seed=seed)
+    return make_queries(centres, n_queries, seed=seed)[0]
+
+
+def per_request_ms(image_processor, queries, faces_per_request, repeat=3):
+    requests = [queries[i:i + faces_per_request] for i in range(0, len(queries), faces_per_request)]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for request in requests:
+            image_processor.match_encodings_with_scores(request)
+    return (time.perf_counter() - start) / (repeat * len(requests)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency and open-set accuracy of the scoring modes.")
+    parser.add_argument("--celebs", type=int, default=2000)
+    parser.add_argument("--per-celeb", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--faces-per-request", type=int, default=3)
+    parser.add_argument("--threshold", type=float, default=0.6)
+    parser.add_argument("--backend", default="annoy", choices=["annoy", "numpy"])
+    args = parser.parse_args()
+
+    encodings_dict, centres = make_gallery(args.celebs, args.per_celeb)
+    known, ordinals = make_queries(centres, args.queries)
+    expected = [f"nm{ordinal:07d}" for ordinal in ordinals]
+    unknown = make_unknown_queries(args.queries)
+
+    image_processor = ImageProcessor(bucket_name=None, search_backend=args.backend)
+    image_processor.build_annoy_index_and_mapping(encodings_dict, ENCODING_LENGTH, version="bench")
+    print(f"Gallery: {args.celebs * args.per_celeb} encodings, {args.queries} known and {args.queries} unknown "
+          f"queries, {args.faces_per_request} faces per request, backend={args.backend}.")
+
+    for scoring, threshold in [("vote", None), ("vote", args.threshold), ("weighted", args.threshold)]:
+        image_processor.scoring, image_processor.match_threshold = scoring, threshold
+        known_ids, _ = image_processor.match_encodings_with_scores(known)
+        unknown_ids, _ = image_processor.match_encodings_with_scores(unknown)
+        accuracy = np.mean([m == e for m, e in zip(known_ids, expected)])
+        false_accepts = np.mean([m is not None for m in unknown_ids])
+        latency = per_request_ms(image_processor, known, args.faces_per_request)
+        print(f"{scoring:<9} threshold={threshold}: {latency:7.3f} ms/request, known top-1 {accuracy:.4f}, "
+              f"unknown faces matched {false_accepts:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import argparse
+import glob
+import os
+import tempfile
+import time
+from main import load_image_as_np_array, load_image_from_bytes
+
+
+def via_disk(image_bytes, directory):
+    """The previous upload path: write the upload to disk, read it back, then delete it."""
+    image_path = os.path.join(directory, "captured_image.jpg")
+    with open(image_path, "wb") as f:
+        f.write(image_bytes)
+    image_np = load_image_as_np_array(image_path)
+    os.remove(image_path)
+    return image_np
+
+
+def mean_ms(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload decode latency with and without the disk round trip.")
+    parser.add_argument("--images", default="../images4README/*.jpg")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for path in sorted(glob.glob(args.images)):
+            with open(path, "rb") as f:
+                image_bytes = f.read()
+            disk = mean_ms(lambda: via_disk(image_bytes, directory), args.repeat)
+            memory = mean_ms(lambda: load_image_from_bytes(image_bytes), args.repeat)
+            print(f"{os.path.basename(path):<40} {len(image_bytes) / 2 ** 20:5.1f}MB  "
+                  f"disk {disk:7.1f}ms  in-memory {memory:7.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from annoy import AnnoyIndex
+from label_store import LabelStore
+from utils import get_memory_usage
+from benchmarks.synthetic import make_gallery, make_queries, ENCODING_LENGTH
+
+
+def build_files(directory, n_celebs, per_celeb, trees):
+    """Write a synthetic Annoy index and label store to directory, like the ones the server loads."""
+    encodings_dict, centres = make_gallery(n_celebs, per_celeb)
+    annoy_index = AnnoyIndex(ENCODING_LENGTH, 'euclidean')
+    row_ids = []
+    for imdb_id, encodings in encodings_dict.items():
+        for encoding in encodings:
+            annoy_index.add_item(len(row_ids), encoding)
+            row_ids.append(imdb_id)
+    annoy_index.build(trees)
+
+    index_path, mapping_path = os.path.join(directory, "index.ann"), os.path.join(directory, "labels")
+    annoy_index.save(index_path)
+    LabelStore.from_row_ids(row_ids).save(mapping_path)
+    return index_path, mapping_path, centres
+
+
+def worker(index_path, mapping_path, centres, mmap, start_barrier, results):
+    """Load the index like a server worker does, touch every page with queries, and report memory."""
+    before = get_memory_usage()
+    start = time.perf_counter()
+    annoy_index = AnnoyIndex(ENCODING_LENGTH, 'euclidean')
+    annoy_index.load(index_path, prefault=not mmap)
+    labels = LabelStore.load(mapping_path, mmap=mmap)
+    load_time = time.perf_counter() - start
+
+    queries, _ = make_queries(centres, 500)
+    for query in queries:
+        labels.labels_of(np.array(annoy_index.get_nns_by_vector(query, 15)))
+    # Touch every label page without allocating a private copy
+    labels.row_labels.sum()
+
+    after = get_memory_usage()
+    results.put((os.getpid(), load_time, before, after))
+    # Stay alive until every worker has reported, so shared pages are counted while all are mapped
+    start_barrier.wait()
+
+
+def run(n_workers, index_path, mapping_path, centres, mmap):
+    context = multiprocessing.get_context("spawn")
+    barrier, results = context.Barrier(n_workers), context.Queue()
+    processes = [context.Process(target=worker, args=(index_path, mapping_path, centres, mmap, barrier, results))
+                 for _ in range(n_workers)]
+    for process in processes:
+        process.start()
+    reports = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that N server workers share the memory-mapped index.")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--celebs", type=int, default=5000)
+    parser.add_argument("--per-celeb", type=int, default=20)
+    parser.add_argument("--trees", type=int, default=10)
+    parser.add_argument("--no-mmap", action="store_true", help="Load privately, for comparison.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        index_path, mapping_path, centres = build_files(directory, args.celebs, args.per_celeb, args.trees)
+        files_mb = (os.path.getsize(index_path) + sum(
+            os.path.getsize(os.path.join(mapping_path, name)) for name in os.listdir(mapping_path))) / 2 ** 20
+        reports = run(args.workers, index_path, mapping_path, centres, mmap=not args.no_mmap)
+
+    print(f"Index and labels on disk: {files_mb:.1f}MB, {args.workers} workers, mmap={not args.no_mmap}")
+    private_growth = []
+    for pid, load_time, before, after in reports:
+        growth = after.get('RssAnon', 0) - before.get('RssAnon', 0)
+        private_growth.append(growth)
+        print(f"worker {pid}: load {load_time * 1000:7.1f}ms, RSS {after.get('VmRSS', 0):7.1f}MB, "
+              f"private +{growth:6.1f}MB, file-backed {after.get('RssFile', 0):7.1f}MB, PSS {after.get('Pss', 0):7.1f}MB")
+
+    # Private memory that scales with the index would mean every worker holds its own copy
+    total_private = sum(private_growth)
+    print(f"Private memory added by loading, summed over workers: {total_private:.1f}MB")
+    if not args.no_mmap and total_private > 0.5 * files_mb * args.workers:
+        print("FAIL: resident memory grows linearly with the number of workers.")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import argparse
+import gzip
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Synthetic pages use the same tags and attributes scrape_manager looks for on IMDb
+LIST_PATH = "/search/name/"
+CELEB_PATH = re.compile(r"^/name/(nm\d{7})/$")
+MEDIA_INDEX_PATH = re.compile(r"^/name/(nm\d{7})/mediaindex/$")
+MEDIA_VIEWER_PATH = re.compile(r"^/name/(nm\d{7})/mediaviewer/rm(\d+)/$")
+
+
+def list_page(n_celebs):
+    items = "".join(f'<h3 class="lister-item-header"><a href="/name/nm{i:07d}/">Celeb {i}</a></h3>'
+                    for i in range(1, n_celebs + 1))
+    return f"<html><body>{items}</body></html>"
+
+
+def celeb_page(imdb_id):
+    return (f'<html><body><h1 data-testid="hero__pageTitle"><span>Celeb {imdb_id}</span></h1>'
+            f'<div data-testid="birth-and-death-birthdate"><span>Born</span><span>January 1, 1980</span></div>'
+            f'<section class="ipc-page-section"><img class="ipc-image" src="/images/{imdb_id}/main.jpg">'
+            f'<a class="ipc-lockup-overlay ipc-focusable" href="/name/{imdb_id}/mediaviewer/rm1/"></a></section>'
+            f'</body></html>')
+
+
+def media_index_page(imdb_id, n_photos):
+    links = "".join(f'<a href="/name/{imdb_id}/mediaviewer/rm{i}/"></a>' for i in range(1, n_photos + 1))
+    return f'<html><body><div class="media_index_thumb_list">{links}</div></body></html>'
+
+
+def media_viewer_page(imdb_id, photo):
+    return (f'<html><body><img data-image-id="rm{photo}-curr" '
+            f'src="https://m.media-amazon.com/images/{imdb_id}_{photo}.jpg"></body></html>')
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """Serves saved pages from html_dir when present, otherwise synthetic IMDb-like pages."""
+    protocol_version = "HTTP/1.1"  # Keep-alive, so clients can reuse connections
+    html_dir = None
+    n_celebs = 50
+    n_photos = 20
+    latency = 0.0
+    error_rate = 0.0
+    compress = False  # gzip bodies for clients that accept it, like IMDb does
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.count_request(self)
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return self.respond(503, "Service Unavailable", {"Retry-After": "0"})
+
+        path = self.path.split("?", 1)[0]
+        body = self.saved_page(path) or self.synthetic_page(path)
+        if body is None:
+            return self.respond(404, "Not Found")
+        # ETags let caching clients revalidate a page they already have for a bodiless 304
+        etag = '"%s"' % hashlib.md5(body.encode("utf-8")).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.server.count_not_modified()
+            return self.respond(304, "", {"ETag": etag})
+        self.respond(200, body, {"ETag": etag})
+
+    def saved_page(self, path):
+        """Saved pages are looked up by path, e.g. /name/nm0000001/ -> <html_dir>/name_nm0000001.html."""
+        if not self.html_dir:
+            return None
+        file_path = os.path.join(self.html_dir, (path.strip("/").replace("/", "_") or "index") + ".html")
+        if os.path.exists(file_path):
+            with open(file_path, encoding="utf-8") as f:
+                return f.read()
+        return None
+
+    def synthetic_page(self, path):
+        if path == LIST_PATH:
+            return list_page(self.n_celebs)
+        if match := CELEB_PATH.match(path):
+            return celeb_page(match.group(1))
+        if match := MEDIA_INDEX_PATH.match(path):
+            return media_index_page(match.group(1), self.n_photos)
+        if match := MEDIA_VIEWER_PATH.match(path):
+            return media_viewer_page(match.group(1), int(match.group(2)))
+        return None
+
+    def respond(self, status, body, headers=None):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        if self.compress and "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = gzip.compress(data)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FixtureServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler):
+        super().__init__(address, handler)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+        self.connections = set()
+
+    def count_request(self, handler):
+        with self._lock:
+            self.requests += 1
+            self.connections.add(handler.client_address)
+
+    def count_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+
+    def stats(self):
+        return {"requests": self.requests, "not_modified": self.not_modified, "connections": len(self.connections)}
+
+
+def start_fixture_server(html_dir=None, n_celebs=50, n_photos=20, latency=0.0, error_rate=0.0, port=0,
+                         compress=False):
+    """Start the server on a background thread. Returns (server, base_url), e.g. to set IMDB_DOMAIN to."""
+    handler = type("Handler", (FixtureHandler,), {"html_dir": html_dir, "n_celebs": n_celebs, "n_photos": n_photos,
+                                                  "latency": latency, "error_rate": error_rate,
+                                                  "compress": compress})
+    server = FixtureServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve saved or synthetic IMDb pages for offline scraping runs.")
+    parser.add_argument("--html-dir", help="Directory of saved pages, named by their path (name_nm0000001.html).")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--celebs", type=int, default=50)
+    parser.add_argument("--photos", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--gzip", action="store_true")
+    args = parser.parse_args()
+
+    server, base_url = start_fixture_server(args.html_dir, args.celebs, args.photos, args.latency_ms / 1000,
+                                            args.error_rate, args.port, args.gzip)
+    print(f"Serving on {base_url}; run the scraper with IMDB_DOMAIN={base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import numpy as np
+from brute_force_index import BruteForceIndex
+from image_processor import ImageProcessor
+from main import handle_image_upload
+from benchmarks.synthetic import make_gallery, make_queries, recall_at_k, ENCODING_LENGTH
+
+BUCKET_NAME = 'celebs-images-bucket-bench'
+
+
+class LocalDBManager:
+    """Stand-in for DBManager on the recognition path: serves synthetic celeb rows from memory."""
+
+    def __init__(self, imdb_ids):
+        self.celeb_infos = {imdb_id: (imdb_id, f"Celeb {imdb_id}", None, None, None,
+                                      f"https://www.imdb.com/name/{imdb_id}/", None,
+                                      f"https://{BUCKET_NAME}.s3.amazonaws.com/{imdb_id}/main_image.jpg")
+                            for imdb_id in imdb_ids}
+
+    def get_celeb_info(self, imdb_id):
+        return self.celeb_infos.get(imdb_id)
+
+    def get_celeb_infos(self, imdb_ids):
+        return {imdb_id: self.celeb_infos.get(imdb_id) for imdb_id in set(imdb_ids)}
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def latency_summary(seconds):
+    seconds = np.asarray(seconds) * 1000
+    return {"mean_ms": float(seconds.mean()), "p50_ms": float(np.percentile(seconds, 50)),
+            "p95_ms": float(np.percentile(seconds, 95)), "p99_ms": float(np.percentile(seconds, 99))}
+
+
+def exact_neighbours(vectors, queries, k):
+    exact_index = BruteForceIndex(ENCODING_LENGTH)
+    exact_index.set_vectors(vectors)
+    # The exact index searches the queries in chunks, so a 1M gallery doesn't need a queries x gallery matrix
+    return exact_index.query(queries, k)[0]
+
+
+def bench_index(encodings_dict, centres, trees, search_ks, n_queries, k, directory):
+    """Build, save, load and query one gallery. Returns a list of result records."""
+    image_processor = ImageProcessor(bucket_name=BUCKET_NAME)
+    start = time.perf_counter()
+    image_processor.build_annoy_index_and_mapping(encodings_dict, ENCODING_LENGTH, trees, version="bench")
+    build_s = time.perf_counter() - start
+
+    index_path, mapping_path = os.path.join(directory, "index.ann"), os.path.join(directory, "labels")
+    image_processor.save_annoy_index_and_mapping(index_path, mapping_path)
+    loaded = ImageProcessor(bucket_name=BUCKET_NAME)
+    start = time.perf_counter()
+    loaded.load_annoy_index_and_mapping(ENCODING_LENGTH, index_path, mapping_path, version="bench")
+    load_s = time.perf_counter() - start
+
+    queries, true_ordinals = make_queries(centres, n_queries)
+    vectors = np.vstack([np.asarray(encodings, dtype=np.float32) for encodings in encodings_dict.values()])
+    exact_rows = exact_neighbours(vectors, queries, k)
+
+    records = []
+    base = {"n_items": len(vectors), "n_celebs": len(centres), "trees": trees, "k": k,
+            "build_s": build_s, "load_s": load_s, "index_mb": os.path.getsize(index_path) / 2 ** 20}
+    annoy_index = loaded.annoy_index
+    for search_k in search_ks:
+        latencies, found_rows = [], np.full((n_queries, k), -1, dtype=np.int64)
+        for i, query in enumerate(queries):
+            start = time.perf_counter()
+            rows = annoy_index.get_nns_by_vector(query, k, search_k=search_k)
+            latencies.append(time.perf_counter() - start)
+            found_rows[i, :len(rows)] = rows
+        records.append({**base, "benchmark": "annoy_query", "search_k": search_k,
+                        f"recall_at_{k}": recall_at_k(found_rows, exact_rows), **latency_summary(latencies)})
+
+    # Full lookup including the vote, checked against the celeb each query was drawn from
+    start = time.perf_counter()
+    matched = loaded.match_encodings(queries, k)
+    match_s = time.perf_counter() - start
+    expected = [f"nm{ordinal:07d}" for ordinal in true_ordinals]
+    records.append({**base, "benchmark": "match_encodings", "search_k": -1,
+                    "top1_accuracy": float(np.mean([m == e for m, e in zip(matched, expected)])),
+                    "mean_ms": match_s / n_queries * 1000})
+    return records, loaded
+
+
+def bench_upload(image_processor, imdb_ids, images, repeat):
+    """Time handle_image_upload on real photos, with the DB and S3 replaced by local stand-ins."""
+    try:
+        from moto import mock_aws
+    except ImportError:  # moto < 5
+        from moto import mock_s3 as mock_aws
+
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    db_manager = LocalDBManager(imdb_ids)
+    records = []
+    with mock_aws():
+        for image_path in images:
+            latencies = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                handle_image_upload(image_path, image_processor, db_manager)
+                latencies.append(time.perf_counter() - start)
+            records.append({"benchmark": "handle_image_upload", "image": os.path.basename(image_path),
+                            "n_items": len(image_processor.index_to_imdb), **latency_summary(latencies)})
+    return records
+
+
+def compare(results, baseline_path):
+    """Print the relative change of every timing against a previous results file."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    identity = ("benchmark", "n_items", "trees", "search_k", "image")
+    previous = {tuple(record.get(key) for key in identity): record for record in baseline["results"]}
+    for record in results:
+        old = previous.get(tuple(record.get(key) for key in identity))
+        if old and old.get("mean_ms"):
+            change = record["mean_ms"] / old["mean_ms"] - 1
+            print(f"{record['benchmark']:<20} n={record.get('n_items')} trees={record.get('trees')} "
+                  f"search_k={record.get('search_k')} {record.get('image') or ''}: "
+                  f"{old['mean_ms']:.3f} -> {record['mean_ms']:.3f} ms ({change:+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark suite: index build/load/query and upload path.")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Gallery sizes in encodings, up to 1000000.")
+    parser.add_argument("--per-celeb", type=int, default=20)
+    parser.add_argument("--trees", default="10,50")
+    parser.add_argument("--search-k", default="-1,1000,10000", help="-1 is Annoy's default, trees * k.")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=15)
+    parser.add_argument("--images", default="../images4README/*.jpg", help="Photos for the upload benchmark.")
+    parser.add_argument("--upload-repeat", type=int, default=3)
+    parser.add_argument("--skip-upload", action="store_true")
+    parser.add_argument("--output", help="Results JSON. Defaults to benchmarks/results/<timestamp>-<commit>.json.")
+    parser.add_argument("--compare", help="Previous results JSON to compare timings against.")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    trees_list = [int(trees) for trees in args.trees.split(",")]
+    search_ks = [int(search_k) for search_k in args.search_k.split(",")]
+
+    results = []
+    for size in sizes:
+        encodings_dict, centres = make_gallery(max(1, size // args.per_celeb), args.per_celeb)
+        for trees in trees_list:
+            with tempfile.TemporaryDirectory() as directory:
+                records, image_processor = bench_index(encodings_dict, centres, trees, search_ks, args.queries,
+                                                       args.k, directory)
+                for record in records:
+                    print(json.dumps(record))
+                results += records
+                # The upload path is timed once per size, on the first trees setting
+                if not args.skip_upload and trees == trees_list[0]:
+                    upload_records = bench_upload(image_processor, list(encodings_dict),
+                                                  sorted(glob.glob(args.images)), args.upload_repeat)
+                    for record in upload_records:
+                        print(json.dumps(record))
+                    results += upload_records
+                image_processor.annoy_index.unload()
+
+    commit = current_commit()
+    output = args.output or os.path.join("benchmarks", "results",
+                                         f"{time.strftime('%Y%m%d-%H%M%S')}-{commit or 'unknown'}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"commit": commit, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "python": platform.python_version(), "machine": platform.machine(),
+                   "cpu_count": os.cpu_count(), "args": vars(args), "results": results}, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+import numpy as np
+
+ENCODING_LENGTH = 128
+
+
+def make_gallery(n_celebs, encodings_per_celeb=20, vector_length=ENCODING_LENGTH, seed=0):
+    """
+    Generate a synthetic gallery shaped like the one built from Face_Encodings: every celeb gets a random
+    centre and its encodings are scattered around it, so same-celeb distances stay well below 0.6.
+    Returns (encodings_dict, centres) where encodings_dict maps a fake IMDb ID to a list of encodings.
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(0, 0.1, size=(n_celebs, vector_length)).astype(np.float32)
+    encodings_dict = {}
+    for ordinal, centre in enumerate(centres):
+        noise = rng.normal(0, 0.02, size=(encodings_per_celeb, vector_length)).astype(np.float32)
+        encodings_dict[f"nm{ordinal:07d}"] = list(centre + noise)
+    return encodings_dict, centres
+
+
+def make_queries(centres, n_queries, seed=1):
+    """Draw fresh encodings of random gallery celebs. Returns (queries, true celeb ordinals)."""
+    rng = np.random.default_rng(seed)
+    ordinals = rng.integers(0, len(centres), size=n_queries)
+    queries = centres[ordinals] + rng.normal(0, 0.02, size=(n_queries, centres.shape[1])).astype(np.float32)
+    return queries.astype(np.float32), ordinals
+
+
+def recall_at_k(found_rows, true_rows):
+    """Fraction of the exact k nearest rows that were also found, averaged over all queries."""
+    hits = [len(set(found[found >= 0]) & set(true)) for found, true in zip(found_rows, true_rows)]
+    return sum(hits) / true_rows.size
@@ -0,0 +1,126 @@
+import numpy as np
+
+# Queries are searched in chunks of at most this many query x gallery distances (64 MiB of float32), so a large
+# batch against a large gallery doesn't need the whole distance matrix at once
+QUERY_CHUNK_ELEMENTS = 16 * 1024 * 1024
+
+
+class BruteForceIndex:
+    """
+    Exact euclidean nearest-neighbour index over a contiguous float32 matrix.
+    Mirrors the parts of the AnnoyIndex interface used by ImageProcessor (add_item, build, save, load,
+    get_nns_by_vector, get_n_items, get_item_vector) and adds a batched query.
+    """
+
+    def __init__(self, f, metric='euclidean'):
+        if metric != 'euclidean':
+            raise ValueError(f"BruteForceIndex only supports the euclidean metric, got {metric!r}.")
+        self.f = f
+        self._pending = {}
+        self._vectors = np.empty((0, f), dtype=np.float32)
+        self._sq_norms = np.empty(0, dtype=np.float32)
+        # Celeb ordinal of every row, parallel to the vectors matrix
+        self._labels = np.empty(0, dtype=np.int32)
+
+    def add_item(self, i, vector):
+        """Queue a vector for row i. Like Annoy, it becomes searchable after build()."""
+        self._pending[i] = vector
+
+    def build(self, n_trees=None, n_jobs=-1):
+        """Stack the queued vectors into the gallery matrix. n_trees and n_jobs are accepted for Annoy compatibility."""
+        if self._pending:
+            vectors = np.zeros((max(self._pending) + 1, self.f), dtype=np.float32)
+            for i, vector in self._pending.items():
+                vectors[i] = vector
+            self._pending = {}
+            self.set_vectors(vectors)
+        return True
+
+    def set_vectors(self, vectors, labels=None):
+        """Replace the gallery with an (n, f) matrix and optionally its parallel label array."""
+        # Memory-mapped float32 matrices are already contiguous and are kept as views
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.f)
+        self._vectors = vectors
+        self._sq_norms = np.einsum('ij,ij->i', vectors, vectors)
+        if labels is not None:
+            self.set_labels(labels)
+        else:
+            self._labels = np.full(len(vectors), -1, dtype=np.int32)
+
+    def set_labels(self, labels):
+        labels = np.ascontiguousarray(labels, dtype=np.int32)
+        if len(labels) != len(self._vectors):
+            raise ValueError(f"Got {len(labels)} labels for {len(self._vectors)} vectors.")
+        self._labels = labels
+
+    def save(self, path):
+        """Save the vectors as a plain .npy file. Labels are saved with the label store, not here."""
+        with open(path, 'wb') as f:
+            np.save(f, self._vectors)
+        return True
+
+    def load(self, path, mmap=True):
+        """Load saved vectors. With mmap the matrix is a read-only view of the file shared by all processes."""
+        self.set_vectors(np.load(path, mmap_mode='r' if mmap else None))
+        return True
+
+    def unload(self):
+        self.set_vectors(np.empty((0, self.f), dtype=np.float32))
+        return True
+
+    @property
+    def vectors(self):
+        return self._vectors
+
+    @property
+    def labels(self):
+        return self._labels
+
+    def get_n_items(self):
+        return len(self._vectors)
+
+    def get_item_vector(self, i):
+        return self._vectors[i].tolist()
+
+    def query(self, encodings, k):
+        """
+        Find the k nearest gallery rows of every encoding.
+        Parameters:
+        - encodings: (N, f) array of query vectors.
+        - k: Number of neighbours per query.
+        Returns (rows, distances), both (N, k) and sorted by distance. Rows are padded with -1 and distances
+        with inf when the gallery holds fewer than k vectors.
+        """
+        encodings = np.atleast_2d(np.asarray(encodings, dtype=np.float32))
+        rows = np.full((len(encodings), k), -1, dtype=np.int64)
+        distances = np.full((len(encodings), k), np.inf, dtype=np.float32)
+        n_found = min(k, len(self._vectors))
+        if n_found == 0 or len(encodings) == 0:
+            return rows, distances
+
+        chunk_size = max(1, QUERY_CHUNK_ELEMENTS // len(self._vectors))
+        for start in range(0, len(encodings), chunk_size):
+            end = start + chunk_size
+            rows[start:end, :n_found], distances[start:end, :n_found] = self._query_chunk(encodings[start:end],
+                                                                                         n_found)
+        return rows, distances
+
+    def _query_chunk(self, encodings, k):
+        """The k nearest rows and their distances for a chunk of encodings, with k at most the gallery size."""
+        # |q - g|^2 = |q|^2 + |g|^2 - 2 q.g, computed for the whole chunk with one matrix multiply
+        query_sq_norms = np.einsum('ij,ij->i', encodings, encodings)
+        sq_distances = query_sq_norms[:, None] + self._sq_norms[None, :] - 2.0 * (encodings @ self._vectors.T)
+
+        nearest = np.argpartition(sq_distances, k - 1, axis=1)[:, :k]
+        nearest_sq_distances = np.take_along_axis(sq_distances, nearest, axis=1)
+        order = np.argsort(nearest_sq_distances, axis=1, kind='stable')
+        return (np.take_along_axis(nearest, order, axis=1),
+                np.sqrt(np.maximum(np.take_along_axis(nearest_sq_distances, order, axis=1), 0)))
+
+    def get_nns_by_vector(self, vector, n, search_k=-1, include_distances=False):
+        """Annoy-compatible single query. search_k is ignored since the search is always exact."""
+        rows, distances = self.query(vector, n)
+        found = rows[0] >= 0
+        if include_distances:
+            return rows[0][found].tolist(), distances[0][found].tolist()
+        return rows[0][found].tolist()
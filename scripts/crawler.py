@@ -0,0 +1,158 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import requests
+from requests import RequestException
+from http_cache import get_http_cache, OfflineCacheMiss
+from html_extraction import parse_html
+from http_session import get_session, connection_stats, HTTP_TIMEOUT
+
+CRAWLER_WORKERS = 16
+# Concurrent requests and requests per second allowed against any single host
+PER_HOST_CONCURRENCY = 4
+PER_HOST_RATE = 5.0
+MAX_RETRIES = 3
+BACKOFF_BASE_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 30
+# Responses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Transport errors worth retrying; a malformed or unsupported URL (MissingSchema, InvalidURL, ...) fails right away
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+class Crawler:
+    """
+    Shared fetch engine for the scraper: the process-wide keep-alive session (see http_session) and one bounded
+    worker pool, with a per-host concurrency limit, per-host rate limiting and retries with exponential backoff.
+    Thread-safe, so celebs can be scraped in parallel while each of them fans out over its photo pages.
+    """
+
+    def __init__(self, workers=CRAWLER_WORKERS, per_host_concurrency=PER_HOST_CONCURRENCY, per_host_rate=PER_HOST_RATE,
+                 max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE_SECONDS, timeout=HTTP_TIMEOUT,
+                 headers_factory=None, session=None, cache=None):
+        self.per_host_concurrency = per_host_concurrency
+        self.min_interval = 1.0 / per_host_rate if per_host_rate else 0.0
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.timeout = timeout
+        # Called for every request, e.g. to rotate the User-Agent
+        self.headers_factory = headers_factory or dict
+
+        self.session = session or get_session()
+        # On-disk response cache (see http_cache), by default the process-wide one if HTTP_CACHE_PATH is set
+        self.cache = cache if cache is not None else get_http_cache()
+        # Only leaf fetches run here (they never submit more work), so nested fan-out can't deadlock the pool
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="crawler")
+
+        self._lock = threading.Lock()
+        self._host_slots = {}
+        self._next_request_at = {}
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+
+    def _host_slot(self, host):
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host_concurrency)
+            return self._host_slots[host]
+
+    def _wait_for_rate_limit(self, host):
+        """Space the requests to a host min_interval apart, reserving the next free start time under the lock."""
+        with self._lock:
+            now = time.monotonic()
+            start_at = max(now, self._next_request_at.get(host, 0.0))
+            self._next_request_at[host] = start_at + self.min_interval
+        if start_at > now:
+            time.sleep(start_at - now)
+
+    def _backoff(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), MAX_BACKOFF_SECONDS)
+            except ValueError:
+                try:
+                    return min(max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()),
+                               MAX_BACKOFF_SECONDS)
+                except (TypeError, ValueError):
+                    pass
+        # Exponential backoff with jitter, so parallel workers don't retry in lockstep
+        return min(self.backoff_base * 2 ** attempt * (1 + random.random()), MAX_BACKOFF_SECONDS)
+
+    def fetch(self, url):
+        """
+        GET url through the HTTP cache if there is one, retrying connection errors, timeouts and RETRY_STATUSES
+        with backoff. Returns the response, or None if it still failed after max_retries retries, got a
+        non-retryable error or isn't cached in offline mode.
+        """
+        if self.cache is None:
+            return self._fetch(url)
+        try:
+            return self.cache.get(url, lambda conditional_headers: self._fetch(url, conditional_headers))
+        except OfflineCacheMiss as e:
+            print(f"Unable to get url {url}: {e}. Skipping...")
+            with self._lock:
+                self.failures += 1
+            return None
+
+    def _fetch(self, url, extra_headers=None):
+        host = urlsplit(url).netloc
+        for attempt in range(self.max_retries + 1):
+            response = None
+            with self._host_slot(host):
+                self._wait_for_rate_limit(host)
+                with self._lock:
+                    self.requests += 1
+                try:
+                    headers = {**self.headers_factory(), **(extra_headers or {})}
+                    response = self.session.get(url, headers=headers, timeout=self.timeout)
+                    if response.status_code not in RETRY_STATUSES:
+                        response.raise_for_status()
+                        return response
+                    error = f"HTTP {response.status_code}"
+                except RETRY_EXCEPTIONS as e:
+                    error = e
+                except RequestException as e:
+                    # 404 and other client errors, or a bad URL, won't get better by retrying
+                    print(f"Unable to get url {url} due to {e}. Skipping...")
+                    break
+
+            if attempt < self.max_retries:
+                with self._lock:
+                    self.retries += 1
+                time.sleep(self._backoff(attempt, response))
+            else:
+                print(f"Unable to get url {url} due to {error} after {self.max_retries} retries. Skipping...")
+
+        with self._lock:
+            self.failures += 1
+        return None
+
+    def fetch_text(self, url):
+        response = self.fetch(url)
+        return response.text if response is not None else None
+
+    def fetch_soup(self, url, parse_only=None):
+        """Fetch and parse url, keeping only the elements matched by parse_only (a SoupStrainer) if given."""
+        text = self.fetch_text(url)
+        return parse_html(text, parse_only) if text is not None else None
+
+    def map(self, fn, items):
+        """Run fn over items on the shared worker pool and return the results in order. fn must not call map."""
+        return list(self._executor.map(fn, items))
+
+    def stats(self):
+        connections = connection_stats()
+        stats = {"requests": self.requests, "retries": self.retries, "failures": self.failures,
+                 "connections_opened": connections["connections"], "connection_reuse_rate": connections["reuse_rate"]}
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+    def close(self):
+        # The session is shared with the rest of the process, so only the worker pool is shut down
+        self._executor.shutdown(wait=True)
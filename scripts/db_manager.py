@@ -1,179 +1,328 @@
-import mysql.connector
-from utils import string_to_encoding_main_image, string_to_encoding_additional_image
+import os
+import threading
+import time
+from contextlib import contextmanager
+from mysql.connector import pooling
+import numpy as np
+from cache import TTLCache, MISSING
+from utils import string_to_encoding_main_image, string_to_encoding_additional_image, strings_to_encodings, \
+    encoding_to_blob, blob_to_encoding, blobs_to_encodings
+
+DEFAULT_POOL_SIZE = 5
+# Pooled connections idle for longer than this are pinged (and reconnected if stale) before use
+HEALTH_CHECK_IDLE_SECONDS = 30
+EXPORT_CHUNK_SIZE = 5000
+# The celebs table is small and rarely changes, so get_celeb_info is served from memory
+CELEB_INFO_CACHE_SIZE = 10000
+CELEB_INFO_CACHE_TTL = 6 * 3600
+MIGRATION_BATCH_SIZE = 1000
+
+
+def decode_encoding(encoding_blob, encoding_str, image_type):
+    """
+    Decode a Face_Encodings row, preferring the float32 blob over the legacy text column.
+    Returns a float32 array, or None for main images stored without an encoding (no or several faces).
+    """
+    if encoding_blob:
+        return blob_to_encoding(encoding_blob)
+    if not encoding_str or not encoding_str.strip():
+        return None
+    if image_type == 'main':
+        return np.array(string_to_encoding_main_image(encoding_str), dtype=np.float32)
+    return np.array(string_to_encoding_additional_image(encoding_str), dtype=np.float32)
 
 
 class DBManager:
 
-    def __init__(self, host, user, password, database, table):
+    def __init__(self, host, user, password, database, table, pool_size=DEFAULT_POOL_SIZE,
+                 celeb_info_cache_size=CELEB_INFO_CACHE_SIZE, celeb_info_cache_ttl=CELEB_INFO_CACHE_TTL):
         self.host = host
         self.user = user
         self.password = password
         self.database = database
-        self.conn = None
-        self.cursor = None
         self.current_table = table
-
-    def connect(self):
-        self.conn = mysql.connector.connect(
-            host=self.host,
-            user=self.user,
-            password=self.password,
-            database=self.database,
-        )
-        self.cursor = self.conn.cursor()
-
-    def close(self):
-        self.conn.close()
-        self.conn = None
-        self.cursor = None
+        self.pool_size = pool_size
+        # The pool is created on first use, and again in a forked child, which can't share its parent's sockets
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+        # mysql.connector pools raise instead of waiting when exhausted; this makes borrowers wait for a free slot
+        self._pool_slots = threading.BoundedSemaphore(pool_size)
+        self._last_used = {}
+        # Read-through cache in front of get_celeb_info, invalidated by the methods that write celeb rows
+        self.celeb_info_cache = TTLCache(celeb_info_cache_size, celeb_info_cache_ttl)
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = pooling.MySQLConnectionPool(
+                    pool_name=f"{self.database}_{id(self)}",
+                    pool_size=self.pool_size,
+                    pool_reset_session=True,
+                    host=self.host,
+                    user=self.user,
+                    password=self.password,
+                    database=self.database,
+                )
+                self._pool_pid = os.getpid()
+                self._last_used = {}
+            return self._pool
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection from the pool for the duration of the block. Blocks while all pool_size connections
+        are in use. Connections that sat idle are health-checked and transparently reconnected if the server
+        dropped them.
+        """
+        with self._pool_slots:
+            conn = self._get_pool().get_connection()
+            try:
+                key = id(getattr(conn, '_cnx', conn))
+                if time.monotonic() - self._last_used.get(key, 0) > HEALTH_CHECK_IDLE_SECONDS:
+                    conn.ping(reconnect=True, attempts=3, delay=1)
+                yield conn
+                self._last_used[key] = time.monotonic()
+            finally:
+                conn.close()  # Returns the connection to the pool
+
+    @contextmanager
+    def transaction(self, buffered=True):
+        """
+        Cursor on a pooled connection for one or more statements. Commits when the block succeeds and rolls
+        back if it raises.
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor(buffered=buffered)
+            try:
+                yield cursor
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
 
     def create_celeb_table(self):
-        self.connect()
-        print("connected")
-        self.cursor.execute(f"CREATE TABLE IF NOT EXISTS {self.current_table} ("
-                            "imdb_id VARCHAR(255) PRIMARY KEY, "
-                            "name VARCHAR(255), "
-                            "dob DATE, "
-                            "dod DATE, "
-                            "age INT, "
-                            "page_url VARCHAR(255), "
-                            "main_image_url VARCHAR(255), "
-                            "main_image_s3_url VARCHAR(255), "
-                            "additional_photos_urls TEXT)"
-                            )
-        self.conn.commit()
-        self.close()
+        with self.transaction() as cursor:
+            print("connected")
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {self.current_table} ("
+                           "imdb_id VARCHAR(255) PRIMARY KEY, "
+                           "name VARCHAR(255), "
+                           "dob DATE, "
+                           "dod DATE, "
+                           "age INT, "
+                           "page_url VARCHAR(255), "
+                           "main_image_url VARCHAR(255), "
+                           "main_image_s3_url VARCHAR(255), "
+                           "additional_photos_urls TEXT)"
+                           )
 
     def insert_celeb(self, celeb_id, name, dob, dod, age, page_url):
+        """Insert or update a celeb's row. Raises on failure, so the scraped stage is retried."""
         try:
-            self.connect()
-            cursor = self.conn.cursor()
-            insert_query = f"""INSERT INTO {self.current_table} (imdb_id, name, dob, dod, age, page_url) 
-                              VALUES (%s, %s, %s, %s, %s, %s)
-                              ON DUPLICATE KEY UPDATE name = %s, dob = %s, dod = %s, age = %s, page_url = %s"""
-            cursor.execute(insert_query, (celeb_id, name, dob, dod, age, page_url, name, dob, dod, age, page_url))
-            self.conn.commit()
+            with self.transaction() as cursor:
+                insert_query = f"""INSERT INTO {self.current_table} (imdb_id, name, dob, dod, age, page_url) 
+                                  VALUES (%s, %s, %s, %s, %s, %s)
+                                  ON DUPLICATE KEY UPDATE name = %s, dob = %s, dod = %s, age = %s, page_url = %s"""
+                cursor.execute(insert_query, (celeb_id, name, dob, dod, age, page_url, name, dob, dod, age, page_url))
         except Exception as e:
             print(f"An error occurred while inserting data into the database: {e}")
+            raise
         finally:
-            self.close()
+            self.celeb_info_cache.invalidate(celeb_id)
 
     def update_celeb_main_image_url(self, celeb_id, image_url, to_s3=False):
+        """Store a celeb's main image URL, or its S3 copy's with to_s3. Raises on failure, like insert_celeb."""
         try:
-            self.connect()
-            cursor = self.conn.cursor()
             if to_s3:
                 column = "main_image_s3_url"
             else:
                 column = "main_image_url"
 
             update_query = f"""UPDATE {self.current_table} SET {column} = %s WHERE imdb_id = %s"""
-            cursor.execute(update_query, (image_url, celeb_id))
-            self.conn.commit()
+            with self.transaction() as cursor:
+                cursor.execute(update_query, (image_url, celeb_id))
         except Exception as e:
             print(f"An error occurred while inserting main image url into the database: {e}")
+            raise
         finally:
-            self.close()
+            self.celeb_info_cache.invalidate(celeb_id)
 
     def update_additional_images_urls(self, celeb_id, urls_list):
         try:
-            self.connect()
-            cursor = self.conn.cursor()
             column = "additional_images_urls"
             urls_string = ','.join(urls_list)
             update_query = f"""UPDATE {self.current_table} SET {column} = %s WHERE imdb_id = %s"""
-            cursor.execute(update_query, (urls_string, celeb_id))
-            self.conn.commit()
+            with self.transaction() as cursor:
+                cursor.execute(update_query, (urls_string, celeb_id))
         except Exception as e:
             print(f"An error occurred while inserting additional images urls into the database: {e}")
         finally:
-            self.close()
+            self.celeb_info_cache.invalidate(celeb_id)
 
     def get_celeb_info(self, imdb_id: str):
         """
         :param imdb_id:
         :return: Tuple: (imdb_id, name, dob, dod, age, page_url, main_image_url, main_image_s3_url)
+        Served from celeb_info_cache when possible; unknown IDs are cached as None too.
         """
-        self.connect()
-        self.cursor.execute(f"SELECT * FROM {self.current_table} WHERE imdb_id = %s", (imdb_id,))
-        result = self.cursor.fetchone()
-        self.close()
+        result = self.celeb_info_cache.get(imdb_id)
+        if result is not MISSING:
+            return result
+
+        with self.transaction() as cursor:
+            cursor.execute(f"SELECT * FROM {self.current_table} WHERE imdb_id = %s", (imdb_id,))
+            result = cursor.fetchone()
+        self.celeb_info_cache.set(imdb_id, result)
         return result
 
+    def get_celeb_infos(self, imdb_ids):
+        """
+        Bulk version of get_celeb_info: returns {imdb_id: info or None}.
+        IDs missing from celeb_info_cache are fetched with a single query.
+        """
+        celeb_infos, missing = {}, []
+        for imdb_id in set(imdb_ids):
+            result = self.celeb_info_cache.get(imdb_id)
+            if result is MISSING:
+                missing.append(imdb_id)
+            else:
+                celeb_infos[imdb_id] = result
+
+        if missing:
+            placeholders = ", ".join(["%s"] * len(missing))
+            with self.transaction() as cursor:
+                cursor.execute(f"SELECT * FROM {self.current_table} WHERE imdb_id IN ({placeholders})", missing)
+                results = {result[0]: result for result in cursor.fetchall()}
+            for imdb_id in missing:
+                celeb_infos[imdb_id] = results.get(imdb_id)
+                self.celeb_info_cache.set(imdb_id, celeb_infos[imdb_id])
+        return celeb_infos
+
+    def get_all_celeb_infos(self):
+        """Fetch every row of the celebs table, as returned by get_celeb_info."""
+        with self.transaction() as cursor:
+            cursor.execute(f"SELECT * FROM {self.current_table}")
+            return cursor.fetchall()
+
+    def warm_celeb_info_cache(self):
+        """Bulk-load the whole celebs table into celeb_info_cache with one query, e.g. at server startup."""
+        results = self.get_all_celeb_infos()
+        self.celeb_info_cache.set_many((result[0], result) for result in results)
+        print(f"Cached info of {len(results)} celebs.")
+        return len(results)
+
     def get_all_imdb_ids(self):
         """Fetch all IMDb IDs from the database."""
-        self.connect()
-        self.cursor.execute(f"SELECT imdb_id FROM {self.current_table}")
-        results = self.cursor.fetchall()
-        self.close()
+        with self.transaction() as cursor:
+            cursor.execute(f"SELECT imdb_id FROM {self.current_table}")
+            results = cursor.fetchall()
         return [result[0] for result in results]
 
     ##### Celeb_Images related functions #####
 
     def create_images_table(self):
-        self.connect()
-        self.cursor.execute("CREATE TABLE IF NOT EXISTS Images ("
-                            "image_id INT AUTO_INCREMENT PRIMARY KEY, "
-                            "imdb_id VARCHAR(255), "
-                            "image_url VARCHAR(255), "
-                            "FOREIGN KEY(imdb_id) REFERENCES Celebs(imdb_id))")
-        self.conn.commit()
-        self.close()
+        with self.transaction() as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS Images ("
+                           "image_id INT AUTO_INCREMENT PRIMARY KEY, "
+                           "imdb_id VARCHAR(255), "
+                           "image_url VARCHAR(255), "
+                           "FOREIGN KEY(imdb_id) REFERENCES Celebs(imdb_id))")
 
     def insert_additional_images_urls(self, celeb_id, images_list):
-        self.connect()
-        for image in images_list:
-            sql_query = ("INSERT INTO Celebs_Images (imdb_id, image_url)"
-                         "VALUES (%s, %s)")
-            # image is the URL, so we pass celeb_id and image to the execute function
-            self.cursor.execute(sql_query, (celeb_id, image))
-        self.conn.commit()
-        self.close()
+        with self.transaction() as cursor:
+            for image in images_list:
+                sql_query = ("INSERT INTO Celebs_Images (imdb_id, image_url)"
+                             "VALUES (%s, %s)")
+                # image is the URL, so we pass celeb_id and image to the execute function
+                cursor.execute(sql_query, (celeb_id, image))
+
+    def delete_additional_images_urls(self, celeb_id):
+        """Remove a celeb's additional image URLs, so a retried scrape doesn't insert them twice."""
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM Celebs_Images WHERE imdb_id = %s", (celeb_id,))
 
     def get_additional_images_urls(self, imdb_id) -> dict:
         """Fetch the additional image URLs and their respective IDs for a given celebrity based on IMDb ID."""
-        self.connect()
-        self.cursor.execute(f"SELECT image_id, image_url FROM Celebs_Images WHERE imdb_id = %s", (imdb_id,))
-        results = self.cursor.fetchall()
-        self.close()
+        with self.transaction() as cursor:
+            cursor.execute(f"SELECT image_id, image_url FROM Celebs_Images WHERE imdb_id = %s", (imdb_id,))
+            results = cursor.fetchall()
         return {result[0]: result[1] for result in results}
 
     ##### Face_Encoding related functions #####
 
     def create_face_encodings_table(self):
-        self.connect()
-        self.cursor.execute(
-            "CREATE TABLE Face_Encodings ("
-            "    encoding_id INT AUTO_INCREMENT PRIMARY KEY, "
-            "    imdb_id VARCHAR(255) NOT NULL, "
-            "    encoding TEXT NOT NULL, "
-            "    image_type VARCHAR(50) NOT NULL, "
-            "    image_number INT DEFAULT NULL, "
-            "    image_id INT, "
-            "    FOREIGN KEY (imdb_id) REFERENCES Celebs2(imdb_id),"
-            "    FOREIGN KEY (image_id) REFERENCES Celebs_images(image_id)"
-            ")"
-        )
-        self.conn.commit()
-        self.close()
+        with self.transaction() as cursor:
+            cursor.execute(
+                "CREATE TABLE Face_Encodings ("
+                "    encoding_id INT AUTO_INCREMENT PRIMARY KEY, "
+                "    imdb_id VARCHAR(255) NOT NULL, "
+                "    encoding TEXT NOT NULL, "
+                "    encoding_blob BLOB DEFAULT NULL, "
+                "    image_type VARCHAR(50) NOT NULL, "
+                "    image_number INT DEFAULT NULL, "
+                "    image_id INT, "
+                "    FOREIGN KEY (imdb_id) REFERENCES Celebs2(imdb_id),"
+                "    FOREIGN KEY (image_id) REFERENCES Celebs_images(image_id)"
+                ")"
+            )
+
+    def add_encoding_blob_column(self):
+        """Add the encoding_blob column to a Face_Encodings table created before it existed."""
+        with self.transaction() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM information_schema.COLUMNS "
+                           "WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'Face_Encodings' AND COLUMN_NAME = 'encoding_blob'",
+                           (self.database,))
+            if cursor.fetchone()[0] == 0:
+                cursor.execute("ALTER TABLE Face_Encodings ADD COLUMN encoding_blob BLOB DEFAULT NULL AFTER encoding")
+
+    def migrate_encodings_to_blob(self, batch_size=MIGRATION_BATCH_SIZE):
+        """
+        Fill encoding_blob for rows that only have a text encoding, in either legacy format (numpy repr for main
+        images, comma-separated for additional ones). Walks the table by encoding_id, so it can be re-run safely.
+        """
+        self.add_encoding_blob_column()
+        last_id, migrated = 0, 0
+        while True:
+            # One transaction per batch, so an interrupted migration keeps the batches already converted
+            with self.transaction() as cursor:
+                cursor.execute("SELECT encoding_id, image_type, encoding FROM Face_Encodings "
+                               "WHERE encoding_id > %s AND encoding_blob IS NULL "
+                               "ORDER BY encoding_id LIMIT %s", (last_id, batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+
+                updates = []
+                for encoding_id, image_type, encoding_str in rows:
+                    encoding = decode_encoding(None, encoding_str, image_type)
+                    if encoding is not None:
+                        updates.append((encoding_to_blob(encoding), encoding_id))
+                if updates:
+                    cursor.executemany("UPDATE Face_Encodings SET encoding_blob = %s WHERE encoding_id = %s", updates)
+            migrated += len(updates)
+            print(f"{migrated} encodings migrated to binary storage.")
+        return migrated
 
     def insert_face_encoding(self, imdb_id, encoding, image_type, image_number=0, image_id=None):
         """
         Insert a new face encoding into the FaceEncodings table.
         For inserting main image ignore the image_number and image_id. i.e. use defaults.
+        The encoding is stored as raw float32 bytes in encoding_blob; the legacy text column is left empty.
         """
-        self.connect()
-
-        # Convert the numpy array encoding to a serialized format (string)
-        encoding_str = ','.join(map(str, encoding))
-
         query = """
-        INSERT INTO Face_Encodings (imdb_id, encoding, image_type, image_number, image_id)
-        VALUES (%s, %s, %s, %s, %s)
+        INSERT INTO Face_Encodings (imdb_id, encoding, encoding_blob, image_type, image_number, image_id)
+        VALUES (%s, %s, %s, %s, %s, %s)
         """
-        self.cursor.execute(query, (imdb_id, encoding_str, image_type, image_number, image_id))
-        self.conn.commit()
-        self.close()
+        with self.transaction() as cursor:
+            cursor.execute(query, (imdb_id, '', encoding_to_blob(encoding), image_type, image_number, image_id))
+
+    def delete_face_encodings(self, imdb_id, image_type):
+        """Remove a celeb's encodings of one image type, so a retried encoding stage doesn't store them twice."""
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM Face_Encodings WHERE imdb_id = %s AND image_type = %s", (imdb_id, image_type))
 
     def get_face_encodings(self, imdb_id, image_type):
         """
@@ -181,19 +330,15 @@ class DBManager:
 
         :param imdb_id: IMDb ID of the celebrity.
         :param image_type: Type of image ('main' or 'additional').
-        :return: List of face encoding values for the specified image type or None if not found.
+        :return: float32 array of the face encoding for the specified image type or None if not found.
         """
-        self.connect()
-        query = "SELECT encoding FROM Face_Encodings WHERE imdb_id = %s AND image_type = %s"
-        self.cursor.execute(query, (imdb_id, image_type))
-        result = self.cursor.fetchone()
-        self.close()
+        query = "SELECT encoding_blob, encoding FROM Face_Encodings WHERE imdb_id = %s AND image_type = %s"
+        with self.transaction() as cursor:
+            cursor.execute(query, (imdb_id, image_type))
+            result = cursor.fetchone()
 
         if result:
-            # Clean up the encoding string
-            encoding_str = result[0].replace('[', '').replace(']', '').replace('\n', '').replace('  ', ' ')
-            encoding_list = [float(value) for value in encoding_str.split()]
-            return encoding_list
+            return decode_encoding(result[0], result[1], image_type)
         return None
 
     def get_processed_celebs_ids(self):
@@ -204,54 +349,90 @@ class DBManager:
         GROUP BY imdb_id
         HAVING COUNT(imdb_id) > 1
         """
-        self.connect()
-        self.cursor.execute(query)
-        imdb_ids_with_additional_images = [result[0] for result in self.cursor.fetchall()]
+        with self.transaction() as cursor:
+            cursor.execute(query)
+            imdb_ids_with_additional_images = [result[0] for result in cursor.fetchall()]
         return imdb_ids_with_additional_images
 
     def get_main_image_encodings(self, imdb_id):
-        self.connect()
-        query = "SELECT encoding FROM Face_Encodings WHERE imdb_id = %s AND image_type = 'main'"
-        self.cursor.execute(query, (imdb_id,))
-        result = self.cursor.fetchone()
-        self.close()
-
-        if result:
-            return string_to_encoding_main_image(result[0])
-        return None
+        return self.get_face_encodings(imdb_id, 'main')
 
     def get_additional_image_encodings(self, imdb_id):
-        self.connect()
-        query = "SELECT encoding FROM Face_Encodings WHERE imdb_id = %s AND image_type = 'additional'"
-        self.cursor.execute(query, (imdb_id,))
-        results = self.cursor.fetchall()
-        self.close()
+        query = "SELECT encoding_blob, encoding FROM Face_Encodings WHERE imdb_id = %s AND image_type = 'additional'"
+        with self.transaction() as cursor:
+            cursor.execute(query, (imdb_id,))
+            results = cursor.fetchall()
 
-        if results:
-            return [string_to_encoding_additional_image(result[0]) for result in results]
-        return []
+        encodings = [decode_encoding(result[0], result[1], 'additional') for result in results]
+        return [encoding for encoding in encodings if encoding is not None]
 
     def get_processed_celebs_all_encodings(self):
-        imdb_ids_with_additional_images = self.get_processed_celebs_ids()
-
+        """Fetch {imdb_id: [main encoding, additional encodings...]} for all processed celebs."""
         imdb_id_to_encodings = {}
-        for imdb_id in imdb_ids_with_additional_images:
-            # Fetch main image encoding
-            main_image_encoding = self.get_main_image_encodings(imdb_id)
-
-            # Fetch additional image encodings
-            encodings = self.get_additional_image_encodings(imdb_id)
-
-            # Add the main image encoding to the beginning of the encodings list
-            if main_image_encoding:
-                encodings.insert(0, main_image_encoding)
-
-            # Add the combined list of encodings (main + additional) to the dictionary
-            if encodings:
-                imdb_id_to_encodings[imdb_id] = encodings
+        for imdb_ids, encodings in self.iter_processed_celebs_encodings():
+            for imdb_id, encoding in zip(imdb_ids, encodings):
+                imdb_id_to_encodings.setdefault(imdb_id, []).append(encoding)
 
         return imdb_id_to_encodings
 
+    def iter_processed_celebs_encodings(self, chunk_size=EXPORT_CHUNK_SIZE):
+        """
+        Stream the encodings of all processed celebs (those with additional images) with a single query.
+        Rows are read through an unbuffered server-side cursor and parsed chunk by chunk, so memory stays bounded
+        by chunk_size regardless of the table size.
+        Yields (imdb_ids, encodings) batches: a list of IMDb IDs and an (n, 128) float32 array, with each celeb's
+        main encoding ahead of its additional ones, as in get_processed_celebs_all_encodings.
+        """
+        query = """
+        SELECT fe.imdb_id, fe.image_type, fe.encoding_blob, fe.encoding
+        FROM Face_Encodings fe
+        JOIN (SELECT imdb_id FROM Face_Encodings GROUP BY imdb_id HAVING COUNT(imdb_id) > 1) processed
+            ON processed.imdb_id = fe.imdb_id
+        ORDER BY fe.imdb_id, fe.image_type = 'main' DESC, fe.encoding_id
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor(buffered=False)
+            try:
+                cursor.execute(query)
+                exported, last_main_id = 0, None
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+
+                    imdb_ids, blob_positions, blobs, text_positions, encoding_strs = [], [], [], [], []
+                    for imdb_id, image_type, encoding_blob, encoding_str in rows:
+                        # Main images with no or several faces were stored as an empty encoding
+                        if not encoding_blob and not (encoding_str and encoding_str.strip()):
+                            continue
+                        # Only the first main encoding of a celeb is used, as in get_main_image_encodings
+                        if image_type == 'main':
+                            if imdb_id == last_main_id:
+                                continue
+                            last_main_id = imdb_id
+                        # Binary rows are decoded with one frombuffer, rows not migrated yet with one text parse
+                        if encoding_blob:
+                            blob_positions.append(len(imdb_ids))
+                            blobs.append(encoding_blob)
+                        else:
+                            text_positions.append(len(imdb_ids))
+                            encoding_strs.append(encoding_str)
+                        imdb_ids.append(imdb_id)
+
+                    if imdb_ids:
+                        encodings = np.empty((len(imdb_ids), 128), dtype=np.float32)
+                        if blobs:
+                            encodings[blob_positions] = blobs_to_encodings(blobs)
+                        if encoding_strs:
+                            encodings[text_positions] = strings_to_encodings(encoding_strs)
+                        exported += len(imdb_ids)
+                        print(f"{exported} encodings exported.")
+                        yield imdb_ids, encodings
+            finally:
+                # Drain what's left if the consumer stopped early, so the connection goes back to the pool clean
+                conn.consume_results()
+                cursor.close()
+
 
     def get_image_count(self, celeb_id):
         # Query to find imdb_id's that appear more than once (indicating additional images)
@@ -261,9 +442,9 @@ class DBManager:
         WHERE imdb_id = %s
         """
 
-        self.connect()
-        self.cursor.execute(query, (celeb_id,))
-        count = self.cursor.fetchone()[0]
+        with self.transaction() as cursor:
+            cursor.execute(query, (celeb_id,))
+            count = cursor.fetchone()[0]
         return count
 
 
@@ -281,3 +462,4 @@ class DBManager:
 
 
 
+
@@ -0,0 +1,382 @@
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from itertools import groupby
+import numpy as np
+from brute_force_index import BruteForceIndex
+from label_store import replace_atomically
+
+NEAREST_NEIGHBOURS = 15
+# Galleries up to this size are searched exactly by the NumPy backend when search_backend="auto"
+BRUTE_FORCE_MAX_ITEMS = 50000
+SEARCH_BACKENDS = ("annoy", "numpy", "auto")
+DEFAULT_TREES = 10
+DEFAULT_SEARCH_K = -1  # Annoy's default, trees * k
+# "vote" is the plain majority vote; "weighted" weighs every neighbour by its inverse distance
+SCORING_MODES = ("vote", "weighted")
+# Keeps the inverse distance of an exact duplicate finite
+WEIGHT_EPSILON = 1e-6
+# Search parameters (trees, k, search_k) are saved next to the index, e.g. new_annoy.ann.meta.json
+INDEX_METADATA_SUFFIX = ".meta.json"
+# Encodings added since the index was built, saved next to it (new_annoy.ann.delta.npz) so every worker loads them
+DELTA_SUFFIX = ".delta.npz"
+# Held while the saved delta or the index files behind it are being rewritten, across processes
+LOCK_SUFFIX = ".lock"
+
+
+def load_index_metadata(index_path):
+    """The metadata saved with an index, or {} for indexes saved without any."""
+    metadata_path = index_path + INDEX_METADATA_SUFFIX
+    if not os.path.exists(metadata_path):
+        return {}
+    with open(metadata_path) as f:
+        return json.load(f)
+
+
+def save_index_metadata(index_path, metadata):
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            json.dump(metadata, f, indent=2)
+    replace_atomically(index_path + INDEX_METADATA_SUFFIX, write)
+
+
+def load_delta(index_path, build_id):
+    """
+    (vectors, imdb_ids) of the delta saved next to an index, or None if there is none or it was saved for
+    another build of the index (build_id from the index metadata).
+    """
+    delta_path = index_path + DELTA_SUFFIX
+    if not os.path.exists(delta_path):
+        return None
+    with np.load(delta_path) as delta:
+        if str(delta["build_id"]) != (build_id or ""):
+            print(f"Ignoring {delta_path}, it was saved for another build of the index.")
+            return None
+        return delta["vectors"], [imdb_id.decode() for imdb_id in delta["ids"]]
+
+
+def save_delta(index_path, build_id, vectors, imdb_ids):
+    """Save the delta of an index atomically, or remove the saved one if there are no delta encodings."""
+    delta_path = index_path + DELTA_SUFFIX
+    if len(imdb_ids) == 0:
+        if os.path.exists(delta_path):
+            os.remove(delta_path)
+        return
+
+    def write(tmp_path):
+        # Through a file object, since np.savez would append .npz to the temporary name
+        with open(tmp_path, "wb") as f:
+            np.savez(f, vectors=np.asarray(vectors, dtype=np.float32), build_id=np.array(build_id or ""),
+                     ids=np.array([imdb_id.encode() for imdb_id in imdb_ids], dtype=np.bytes_))
+    replace_atomically(delta_path, write)
+
+
+@contextmanager
+def saved_gallery_lock(index_path):
+    """Exclusive lock on the files of a saved gallery, shared by every process that uses this file system."""
+    with open(index_path + LOCK_SUFFIX, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def sum_by_neighbour_label(neighbour_labels, weights):
+    """
+    (N, k) total weight of each neighbour's label within its row of neighbour_labels.
+    Rows are sorted and equal labels summed run by run, so the work stays O(N * k) however many celebs the
+    gallery holds.
+    """
+    n_rows, k = neighbour_labels.shape
+    order = np.argsort(neighbour_labels, axis=1, kind="stable")
+    sorted_labels = np.take_along_axis(neighbour_labels, order, axis=1)
+    # Every row starts a new run, so runs never span two rows
+    run_starts = np.ones((n_rows, k), dtype=bool)
+    run_starts[:, 1:] = sorted_labels[:, 1:] != sorted_labels[:, :-1]
+    runs = np.cumsum(run_starts.ravel()) - 1
+    run_sums = np.bincount(runs, np.take_along_axis(weights, order, axis=1).ravel())
+    sums = np.empty((n_rows, k), dtype=run_sums.dtype)
+    np.put_along_axis(sums, order, run_sums[runs].reshape(n_rows, k), axis=1)
+    return sums
+
+
+def vote_nearest_labels(neighbour_labels):
+    """
+    Majority vote over each row of an (N, k) array of celeb ordinals, ignoring -1 padding.
+    Ties go to the label of the nearest neighbour, the same way Counter.most_common does.
+    Returns an (N,) array of winning ordinals (-1 for rows without any neighbour).
+    """
+    n_rows = neighbour_labels.shape[0]
+    padding = neighbour_labels < 0
+    # Count of each neighbour's label, in neighbour order, so argmax picks the nearest among ties
+    neighbour_counts = sum_by_neighbour_label(neighbour_labels, np.ones(neighbour_labels.shape))
+    neighbour_counts[padding] = -1
+    winners = np.argmax(neighbour_counts, axis=1)
+    return neighbour_labels[np.arange(n_rows), winners]
+
+
+def score_nearest_labels(neighbour_labels, distances, scoring="vote"):
+    """
+    Pick a celeb per row of (N, k) neighbour ordinals and distances, and score how close the face is to it.
+    Parameters:
+    - neighbour_labels: (N, k) celeb ordinals sorted by distance, padded with -1.
+    - distances: (N, k) euclidean distances of those neighbours, padded with inf.
+    - scoring: "vote" picks the majority label and scores it by its nearest neighbour's distance.
+      "weighted" picks the label with the largest sum of inverse distances and scores it by the harmonic mean
+      distance of its neighbours, so a few close neighbours outweigh many distant ones.
+    Returns (winners, scores): (N,) ordinals (-1 for rows without neighbours) and (N,) scores, where lower is a
+    closer match (inf for rows without neighbours).
+    """
+    if scoring not in SCORING_MODES:
+        raise ValueError(f"Unknown scoring mode {scoring!r}, expected one of {SCORING_MODES}.")
+    n_rows = neighbour_labels.shape[0]
+    if n_rows == 0:
+        return np.empty(0, dtype=neighbour_labels.dtype), np.empty(0, dtype=np.float32)
+    padding = neighbour_labels < 0
+    weights = np.where(padding, 0.0, 1.0 / (distances + WEIGHT_EPSILON))
+
+    if scoring == "vote":
+        winners = vote_nearest_labels(neighbour_labels)
+    else:
+        # Same as vote_nearest_labels, summing weights instead of counting
+        neighbour_sums = sum_by_neighbour_label(neighbour_labels, weights)
+        neighbour_sums[padding] = -1
+        winners = neighbour_labels[np.arange(n_rows), np.argmax(neighbour_sums, axis=1)]
+
+    is_winner = (neighbour_labels == winners[:, None]) & ~padding
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if scoring == "vote":
+            scores = np.where(is_winner, distances, np.inf).min(axis=1)
+        else:
+            scores = is_winner.sum(axis=1) / np.where(is_winner, weights, 0.0).sum(axis=1) - WEIGHT_EPSILON
+    scores = np.where(winners >= 0, scores, np.inf).astype(np.float32)
+    return winners, scores
+
+
+class DeltaSegment:
+    """
+    Small mutable segment holding encodings added after the main index was built, searched by brute force.
+    Additions publish a new copy of the segment, so a concurrent query sees either the old or the new one.
+    """
+
+    def __init__(self, f):
+        self._index = BruteForceIndex(f)
+
+    def __len__(self):
+        return self._index.get_n_items()
+
+    @property
+    def vectors(self):
+        return self._index.vectors
+
+    @property
+    def labels(self):
+        return self._index.labels
+
+    def add(self, vectors, labels):
+        index = self._index
+        new_index = BruteForceIndex(index.f)
+        new_index.set_vectors(np.vstack([index.vectors, vectors]), np.concatenate([index.labels, labels]))
+        self._index = new_index
+
+    def query(self, encodings, k):
+        """Return the celeb ordinals and distances of the k nearest delta encodings, padded with -1 / inf."""
+        index = self._index
+        rows, distances = index.query(encodings, k)
+        return np.where(rows >= 0, index.labels[rows], -1), distances
+
+
+class Gallery:
+    """
+    One version of the searchable gallery: the Annoy index, its label store and the optional exact index, plus
+    a delta segment of encodings added since the index was built.
+    ImageProcessor swaps whole Gallery objects, so a request that pinned a version keeps searching it even if a
+    newer one is published meanwhile. A retired gallery unloads its index once its last reader releases it.
+    """
+
+    def __init__(self, annoy_index, labels, version, brute_force_index=None, metadata=None):
+        self.annoy_index = annoy_index
+        self.labels = labels
+        self.base_version = version
+        # Build and search parameters of this index: trees, and the tuned k and search_k if it was autotuned
+        self.metadata = dict(metadata or {})
+        self._brute_force_index = brute_force_index
+        self._lock = threading.Lock()
+        self._readers = 0
+        self._retired = False
+        # Celebs that only exist in the delta get ordinals after the label store's, in this order
+        self.delta = DeltaSegment(annoy_index.f)
+        self._delta_ids = []
+        self._ordinal_of = None
+
+    @property
+    def version(self):
+        """The base version, suffixed with the number of delta encodings once any were added."""
+        return f"{self.base_version}+{len(self.delta)}" if len(self.delta) else self.base_version
+
+    @property
+    def trees(self):
+        return self.metadata.get("trees", DEFAULT_TREES)
+
+    @property
+    def k(self):
+        return self.metadata.get("k", NEAREST_NEIGHBOURS)
+
+    @property
+    def search_k(self):
+        return self.metadata.get("search_k", DEFAULT_SEARCH_K)
+
+    def __len__(self):
+        return len(self.labels) + len(self.delta)
+
+    def __contains__(self, imdb_id):
+        return imdb_id in self._get_ordinal_map()
+
+    def _get_ordinal_map(self):
+        if self._ordinal_of is None:
+            self._ordinal_of = {imdb_id.decode(): i for i, imdb_id in enumerate(self.labels.ids)}
+        return self._ordinal_of
+
+    def add_encodings(self, imdb_id, encodings):
+        """Make encodings of a (new or existing) celeb searchable through the delta segment."""
+        encodings = np.atleast_2d(np.asarray(encodings, dtype=np.float32))
+        with self._lock:
+            ordinal_of = self._get_ordinal_map()
+            ordinal = ordinal_of.get(imdb_id)
+            if ordinal is None:
+                ordinal = self.labels.n_celebs + len(self._delta_ids)
+                self._delta_ids.append(imdb_id)
+                ordinal_of[imdb_id] = ordinal
+            self.delta.add(encodings, np.full(len(encodings), ordinal, dtype=np.int32))
+
+    def add_delta_items(self, vectors, imdb_ids):
+        """Add delta encodings in the form delta_items returns them, e.g. loaded from a saved delta."""
+        start = 0
+        for imdb_id, rows in groupby(imdb_ids):
+            end = start + len(list(rows))
+            self.add_encodings(imdb_id, vectors[start:end])
+            start = end
+
+    def ids_of(self, ordinals):
+        """IMDb IDs of celeb ordinals from either tier, with None for -1."""
+        n_main = self.labels.n_celebs
+        return [None if ordinal < 0 else self.labels.id_of(ordinal) if ordinal < n_main
+                else self._delta_ids[ordinal - n_main] for ordinal in ordinals]
+
+    def main_vectors(self):
+        n_items = self.annoy_index.get_n_items()
+        vectors = np.array([self.annoy_index.get_item_vector(i) for i in range(n_items)], dtype=np.float32)
+        return vectors.reshape(n_items, self.annoy_index.f)
+
+    def delta_items(self, start=0):
+        """(vectors, imdb_ids) of the delta encodings from position start on."""
+        return self.delta.vectors[start:], self.ids_of(self.delta.labels[start:])
+
+    def acquire(self):
+        with self._lock:
+            if self._retired and self._readers == 0:
+                raise RuntimeError(f"Gallery version {self.version} has already been released.")
+            self._readers += 1
+
+    def release(self):
+        with self._lock:
+            self._readers -= 1
+            unload = self._retired and self._readers == 0
+        if unload:
+            self._unload()
+
+    def retire(self):
+        """Mark the gallery as replaced. It is unloaded now if idle, otherwise when its last reader releases it."""
+        with self._lock:
+            self._retired = True
+            unload = self._readers == 0
+        if unload:
+            self._unload()
+
+    def _unload(self):
+        self.annoy_index.unload()
+        self._brute_force_index = None
+        print(f"Released gallery version {self.version}.")
+
+    @property
+    def readers(self):
+        return self._readers
+
+    def set_brute_force_index(self, brute_force_index):
+        if brute_force_index.get_n_items() != len(self.labels):
+            raise ValueError(f"Exact index has {brute_force_index.get_n_items()} items but the mapping has "
+                             f"{len(self.labels)}.")
+        brute_force_index.set_labels(self.labels.row_labels)
+        self._brute_force_index = brute_force_index
+
+    def get_brute_force_index(self):
+        """Copy the gallery vectors out of the Annoy index once, for the NumPy backend."""
+        with self._lock:
+            if self._brute_force_index is None:
+                vectors = self.main_vectors()
+                brute_force_index = BruteForceIndex(self.annoy_index.f)
+                brute_force_index.set_vectors(vectors, self.labels.row_labels[:len(vectors)])
+                self._brute_force_index = brute_force_index
+            return self._brute_force_index
+
+    def match_encodings(self, encodings, k=None, backend="annoy", search_k=None):
+        """
+        Return the most common IMDb ID among the k nearest neighbours of each encoding (None if there are none).
+        k and search_k default to the values in the index metadata.
+        """
+        return self.match_encodings_with_scores(encodings, k, backend, search_k)[0]
+
+    def match_encodings_with_scores(self, encodings, k=None, backend="annoy", search_k=None, scoring="vote",
+                                    threshold=None):
+        """
+        Like match_encodings, but also return the score of every match (see score_nearest_labels).
+        With a threshold, faces whose best score is above it are treated as unknown and matched to None.
+        Returns (imdb_ids, scores), with None scores for faces without any neighbour.
+        """
+        k = k or self.k
+        search_k = self.search_k if search_k is None else search_k
+        neighbour_labels, distances = self.nearest_labels(encodings, k, backend, search_k)
+        winners, scores = score_nearest_labels(neighbour_labels, distances, scoring)
+        if threshold is not None:
+            winners = np.where(scores <= threshold, winners, -1)
+        return self.ids_of(winners), [float(score) if np.isfinite(score) else None for score in scores]
+
+    def nearest_labels(self, encodings, k, backend, search_k=DEFAULT_SEARCH_K):
+        """
+        Search the main index and the delta segment and merge the results by distance.
+        Returns (labels, distances), both (N, k): the celeb ordinals of the k nearest encodings over both tiers.
+        """
+        rows, distances = self.nearest_rows(encodings, k, backend, search_k)
+        labels = self.labels.labels_of(rows)
+        if len(self.delta) == 0:
+            return labels, distances
+
+        delta_labels, delta_distances = self.delta.query(encodings, k)
+        labels, distances = np.hstack([labels, delta_labels]), np.hstack([distances, delta_distances])
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(labels, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+    def nearest_rows(self, encodings, k, backend, search_k=DEFAULT_SEARCH_K):
+        """
+        Return (rows, distances) of the main index rows nearest to each encoding, padded with -1 / inf.
+        search_k is the number of Annoy nodes inspected per query; the exact backend ignores it.
+        """
+        if backend not in SEARCH_BACKENDS:
+            raise ValueError(f"Unknown search backend {backend!r}, expected one of {SEARCH_BACKENDS}.")
+        if backend == "auto":
+            backend = "numpy" if self.annoy_index.get_n_items() <= BRUTE_FORCE_MAX_ITEMS else "annoy"
+
+        if backend == "numpy":
+            return self.get_brute_force_index().query(encodings, k)
+
+        nearest_rows = np.full((len(encodings), k), -1, dtype=np.int64)
+        nearest_distances = np.full((len(encodings), k), np.inf, dtype=np.float32)
+        for i, encoding in enumerate(encodings):
+            nearest, distances = self.annoy_index.get_nns_by_vector(encoding, k, search_k=search_k,
+                                                                    include_distances=True)
+            nearest_rows[i, :len(nearest)] = nearest
+            nearest_distances[i, :len(distances)] = distances
+        return nearest_rows, nearest_distances
@@ -0,0 +1,96 @@
+import os
+import re
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml.etree
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+
+# Compiled once; matched against data-image-id, e.g. "rm3133285889-curr" marks the full-size photo
+IMAGE_ID_PATTERN = re.compile(r"^rm\d+-curr")
+
+# BeautifulSoup tree builder: lxml's C parser when installed, otherwise the pure-Python one
+HTML_PARSER = "lxml" if lxml is not None else "html.parser"
+
+EXTRACTION_BACKENDS = ("selectolax", "lxml", "soup")
+AVAILABLE_BACKENDS = tuple(backend for backend, available in
+                           (("selectolax", HTMLParser is not None), ("lxml", lxml is not None), ("soup", True))
+                           if available)
+# The fastest available backend unless HTML_EXTRACTION_BACKEND picks one
+EXTRACTION_BACKEND = os.environ.get("HTML_EXTRACTION_BACKEND", AVAILABLE_BACKENDS[0])
+
+# Profile pages are parsed for the name, birth/death blocks and the main photo section only. Skipping the rest
+# (mostly large <script> blobs) is what makes the parse cheap.
+PROFILE_STRAINER = SoupStrainer(["h1", "div", "section"])
+MEDIA_INDEX_STRAINER = SoupStrainer("div", class_="media_index_thumb_list")
+PHOTO_STRAINER = SoupStrainer(attrs={"data-image-id": IMAGE_ID_PATTERN})
+
+
+def _backend(backend):
+    backend = backend or EXTRACTION_BACKEND
+    if backend not in AVAILABLE_BACKENDS:
+        raise ValueError(f"HTML extraction backend {backend!r} is not available, expected one of {AVAILABLE_BACKENDS}.")
+    return backend
+
+
+def parse_html(html, parse_only=None):
+    """Parse a page into BeautifulSoup with the fastest installed tree builder, optionally keeping only parse_only."""
+    return BeautifulSoup(html, HTML_PARSER, parse_only=parse_only)
+
+
+def parse_profile(html):
+    """Soup of a celeb profile page, for scrape_celebrity_info and get_main_photo_url."""
+    return parse_html(html, PROFILE_STRAINER)
+
+
+def _lxml_document(html):
+    """lxml tree of a page, or None for a page without any elements, which lxml refuses to parse."""
+    try:
+        return lxml.html.fromstring(html)
+    except lxml.etree.ParserError:
+        return None
+
+
+def extract_photo_url(html, backend=None):
+    """src of the first tag whose data-image-id marks the full-size photo of a media viewer page, or None."""
+    backend = _backend(backend)
+    if backend == "selectolax":
+        for node in HTMLParser(html).css("[data-image-id]"):
+            if IMAGE_ID_PATTERN.match(node.attributes.get("data-image-id") or ""):
+                return node.attributes.get("src")
+        return None
+    if backend == "lxml":
+        document = _lxml_document(html)
+        if document is None:
+            return None
+        for element in document.xpath("//*[@data-image-id]"):
+            if IMAGE_ID_PATTERN.match(element.get("data-image-id")):
+                return element.get("src")
+        return None
+    image_tag = parse_html(html, PHOTO_STRAINER).find(attrs={"data-image-id": IMAGE_ID_PATTERN})
+    return image_tag.get("src") if image_tag else None
+
+
+def extract_media_index_links(html, backend=None):
+    """hrefs of the photo pages linked from a media index page, or None if the page has no thumbnail list."""
+    backend = _backend(backend)
+    if backend == "selectolax":
+        div = HTMLParser(html).css_first("div.media_index_thumb_list")
+        return None if div is None else [a.attributes.get("href") for a in div.css("a")
+                                         if a.attributes.get("href") is not None]
+    if backend == "lxml":
+        document = _lxml_document(html)
+        if document is None:
+            return None
+        divs = document.xpath(
+            '//div[contains(concat(" ", normalize-space(@class), " "), " media_index_thumb_list ")]')
+        return None if not divs else [str(href) for href in divs[0].xpath(".//a/@href")]
+    div = parse_html(html, MEDIA_INDEX_STRAINER).find("div", {"class": "media_index_thumb_list"})
+    return None if div is None else [a["href"] for a in div.find_all("a") if a.has_attr("href")]
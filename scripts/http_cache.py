@@ -0,0 +1,245 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import requests
+from requests import RequestException
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# SQLite file of the scraper's HTTP cache; empty disables caching
+HTTP_CACHE_PATH = os.environ.get("HTTP_CACHE_PATH", "")
+HTTP_CACHE_MAX_BYTES = int(float(os.environ.get("HTTP_CACHE_MAX_MB", 2048)) * 1024 * 1024)
+# Seconds a cached response is served without asking the server: IMDb pages change, photos behind a URL don't
+HTTP_CACHE_TTL = float(os.environ.get("HTTP_CACHE_TTL", 24 * 3600))
+HTTP_CACHE_IMAGE_TTL = float(os.environ.get("HTTP_CACHE_IMAGE_TTL", 30 * 24 * 3600))
+# Replay mode: serve everything from the cache, stale or not, and never touch the network
+HTTP_CACHE_OFFLINE = os.environ.get("HTTP_CACHE_OFFLINE", "0") == "1"
+
+# Kept with a cached body; Content-Encoding/Length are dropped since bodies are stored decoded
+STORED_HEADERS = ("Content-Type", "ETag", "Last-Modified", "Cache-Control", "Date")
+# Query parameters of S3 pre-signed URLs, which change on every signing of the same object
+VOLATILE_QUERY_PREFIXES = ("X-Amz-",)
+# Marks a pre-signed URL. The object behind it can be overwritten (e.g. a re-uploaded main image) under the
+# same cache key, so those responses are revalidated with their ETag on every use instead of served for a TTL.
+PRESIGNED_QUERY_PARAMETERS = ("X-Amz-Signature", "Signature")
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+class OfflineCacheMiss(RequestException):
+    """Raised in offline mode for a URL the cache has no response for."""
+
+
+def cache_key(url):
+    """url without the query parameters that differ between requests for the same content."""
+    parts = urlsplit(url)
+    query = [(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+             if not name.startswith(VOLATILE_QUERY_PREFIXES)]
+    return urlunsplit(parts._replace(query=urlencode(query), fragment=""))
+
+
+def is_presigned(url):
+    return any(name in PRESIGNED_QUERY_PARAMETERS for name, _ in parse_qsl(urlsplit(url).query))
+
+
+def cached_response(url, headers, body):
+    """Rebuild a requests.Response from a cache entry, so callers can't tell it from a network one."""
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers = CaseInsensitiveDict(headers)
+    response.encoding = get_encoding_from_headers(response.headers)
+    response._content = body
+    response.from_cache = True
+    return response
+
+
+class HTTPCache:
+    """
+    Persistent cache of successful GET responses in one SQLite file, shared by the page and image downloads.
+    Bodies are content-addressed (stored once per SHA-256, however many URLs return them) and the least recently
+    used responses are evicted once the bodies exceed max_bytes. Expired responses are revalidated with
+    If-None-Match/If-Modified-Since, so an unchanged page costs a 304 instead of a download.
+    Thread-safe; every process opens its own connection (see get_http_cache).
+    """
+
+    def __init__(self, path, max_bytes=HTTP_CACHE_MAX_BYTES, ttl=HTTP_CACHE_TTL, offline=HTTP_CACHE_OFFLINE,
+                 clock=time.time):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.offline = offline
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        # WAL lets the scraper's processes read while one of them writes
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS bodies (hash TEXT PRIMARY KEY, body BLOB NOT NULL, "
+                         "size INTEGER NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, body_hash TEXT NOT NULL, "
+                         "headers TEXT NOT NULL, fetched_at REAL NOT NULL, expires_at REAL NOT NULL, "
+                         "last_used_at REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used_at)")
+        self.total_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM bodies").fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stored = 0
+        self.evictions = 0
+
+    def get(self, url, send, ttl=None):
+        """
+        Return the response for url, from the cache when possible.
+        Parameters:
+        - url: URL to GET.
+        - send: Called with the extra request headers to actually fetch url; returns a response or None.
+        - ttl: Seconds the response stays fresh, overriding the cache-wide ttl. Pre-signed URLs are never fresh:
+          their body is only reused after the server confirms it with a 304.
+        Returns the response, or whatever send returned if it wasn't a 200/304.
+        """
+        key = cache_key(url)
+        presigned = is_presigned(url)
+        with self._lock:
+            entry = self._db.execute("SELECT r.headers, r.expires_at, b.body FROM responses r "
+                                     "JOIN bodies b ON b.hash = r.body_hash WHERE r.url = ?", (key,)).fetchone()
+            # Step 1: Serve fresh entries (any entry when offline) without touching the network
+            if entry is not None and (self.offline or (not presigned and entry[1] > self._clock())):
+                self._db.execute("UPDATE responses SET last_used_at = ? WHERE url = ?", (self._clock(), key))
+                self.hits += 1
+                return cached_response(url, json.loads(entry[0]), entry[2])
+            self.misses += 1
+        if self.offline:
+            raise OfflineCacheMiss(f"{url} is not in the HTTP cache and offline mode is on")
+
+        # Step 2: Revalidate a stale entry with its validators, or fetch a new one
+        conditional_headers = {}
+        if entry is not None:
+            headers = CaseInsensitiveDict(json.loads(entry[0]))
+            if "ETag" in headers:
+                conditional_headers["If-None-Match"] = headers["ETag"]
+            if "Last-Modified" in headers:
+                conditional_headers["If-Modified-Since"] = headers["Last-Modified"]
+        response = send(conditional_headers)
+        if response is None:
+            return None
+
+        # Step 3: Refresh or store the entry
+        ttl = 0 if presigned else self.ttl if ttl is None else ttl
+        if response.status_code == 304 and entry is not None:
+            headers = {**json.loads(entry[0]), **self._stored_headers(response)}
+            with self._lock:
+                self.revalidated += 1
+                now = self._clock()
+                self._db.execute("UPDATE responses SET headers = ?, expires_at = ?, last_used_at = ? WHERE url = ?",
+                                 (json.dumps(headers), now + ttl, now, key))
+            return cached_response(url, headers, entry[2])
+        if response.status_code == 200:
+            self._store(key, response, ttl)
+        return response
+
+    @contextmanager
+    def _transaction(self):
+        self._db.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    @staticmethod
+    def _stored_headers(response):
+        return {name: response.headers[name] for name in STORED_HEADERS if name in response.headers}
+
+    def _store(self, key, response, ttl):
+        body = response.content
+        body_hash = hashlib.sha256(body).hexdigest()
+        headers = json.dumps(self._stored_headers(response))
+        with self._lock:
+            now = self._clock()
+            previous = self._db.execute("SELECT body_hash FROM responses WHERE url = ?", (key,)).fetchone()
+            with self._transaction():
+                if self._db.execute("INSERT OR IGNORE INTO bodies (hash, body, size) VALUES (?, ?, ?)",
+                                    (body_hash, body, len(body))).rowcount:
+                    self.total_bytes += len(body)
+                self._db.execute("INSERT OR REPLACE INTO responses (url, body_hash, headers, fetched_at, "
+                                 "expires_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?)",
+                                 (key, body_hash, headers, now, now + ttl, now))
+                if previous is not None and previous[0] != body_hash:
+                    self._delete_orphan_body(previous[0])
+            self.stored += 1
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _delete_orphan_body(self, body_hash):
+        size = self._db.execute("SELECT size FROM bodies WHERE hash = ?", (body_hash,)).fetchone()
+        if size is not None and self._db.execute(
+                "DELETE FROM bodies WHERE hash = ? AND NOT EXISTS (SELECT 1 FROM responses WHERE body_hash = ?)",
+                (body_hash, body_hash)).rowcount:
+            self.total_bytes -= size[0]
+
+    def _evict(self):
+        """Drop least recently used responses until the bodies fit in max_bytes. Called with the lock held."""
+        with self._transaction():
+            while self.total_bytes > self.max_bytes:
+                oldest = self._db.execute("SELECT url, body_hash FROM responses ORDER BY last_used_at "
+                                          "LIMIT 64").fetchall()
+                if not oldest:
+                    break
+                for url, body_hash in oldest:
+                    self._db.execute("DELETE FROM responses WHERE url = ?", (url,))
+                    self._delete_orphan_body(body_hash)
+                    self.evictions += 1
+                    if self.total_bytes <= self.max_bytes:
+                        break
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.execute("DELETE FROM bodies")
+            self.total_bytes = 0
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+            "stored": self.stored,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def get_http_cache():
+    """
+    Return the process-wide HTTP cache at HTTP_CACHE_PATH, opening it on first use (and again after a fork),
+    or None when HTTP_CACHE_PATH is unset.
+    """
+    global _cache, _cache_pid
+    if not HTTP_CACHE_PATH:
+        return None
+    with _cache_lock:
+        if _cache is None or _cache_pid != os.getpid():
+            _cache, _cache_pid = HTTPCache(HTTP_CACHE_PATH), os.getpid()
+        return _cache
@@ -0,0 +1,90 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from http_cache import get_http_cache, HTTP_CACHE_IMAGE_TTL
+
+# Hosts kept in the pool, and idle keep-alive connections kept per host
+HTTP_POOL_HOSTS = 16
+HTTP_POOL_CONNECTIONS_PER_HOST = int(os.environ.get("HTTP_POOL_CONNECTIONS_PER_HOST", 32))
+# (connect, read) timeouts in seconds, so a stalled socket can't hang a worker forever
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 30))
+HTTP_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+
+def _brotli_available():
+    for module in ("brotli", "brotlicffi"):
+        try:
+            __import__(module)
+            return True
+        except ImportError:
+            pass
+    return False
+
+
+# Only advertise encodings urllib3 can decode; a "br" response without brotli installed is unreadable bytes
+ACCEPT_ENCODING = "gzip, deflate, br" if _brotli_available() else "gzip, deflate"
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Return the process-wide requests session, creating it on first use (and again after a fork).
+    Its urllib3 pools are thread-safe and keep connections to each host alive across calls, so pages and images
+    reuse TCP+TLS connections instead of opening one per request. Don't mutate its headers or adapters; pass
+    per-request headers instead.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            # Block instead of opening throwaway connections when every pooled one is busy
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_CONNECTIONS_PER_HOST,
+                                  pool_block=True)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+            _session, _session_pid = session, os.getpid()
+        return _session
+
+
+def http_get(url, timeout=HTTP_TIMEOUT, cache_ttl=HTTP_CACHE_IMAGE_TTL, headers=None, **kwargs):
+    """
+    GET url on the shared session. gzip/deflate bodies are decoded transparently by urllib3.
+    Goes through the on-disk HTTP cache when HTTP_CACHE_PATH is set, keeping responses fresh for cache_ttl seconds.
+    Pre-signed S3 downloads are revalidated with their ETag every time instead (see http_cache.is_presigned).
+    """
+    cache = get_http_cache()
+    if cache is None:
+        return get_session().get(url, timeout=timeout, headers=headers, **kwargs)
+    return cache.get(url, lambda conditional_headers: get_session().get(
+        url, timeout=timeout, headers={**(headers or {}), **conditional_headers}, **kwargs), cache_ttl)
+
+
+def connection_stats():
+    """
+    Requests sent and connections opened by the shared session, per host and in total.
+    reuse_rate is the share of requests served on an already open connection.
+    """
+    hosts = {}
+    if _session is not None:
+        for adapter in set(_session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                host = f"{pool.scheme}://{pool.host}:{pool.port}"
+                requests_sent, connections = pool.num_requests, pool.num_connections
+                previous = hosts.get(host, {"requests": 0, "connections": 0})
+                hosts[host] = {"requests": previous["requests"] + requests_sent,
+                               "connections": previous["connections"] + connections}
+
+    total_requests = sum(host["requests"] for host in hosts.values())
+    total_connections = sum(host["connections"] for host in hosts.values())
+    return {"requests": total_requests, "connections": total_connections,
+            "reuse_rate": 1 - total_connections / total_requests if total_requests else 0.0, "hosts": hosts}
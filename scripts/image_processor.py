@@ -1,102 +1,202 @@
-import pickle
-from collections import Counter
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 from functools import partial
 from multiprocessing import Pool
 import boto3
 import face_recognition
 import numpy as np
 from annoy import AnnoyIndex
+from PIL import Image
+from brute_force_index import BruteForceIndex
+from gallery import Gallery, SEARCH_BACKENDS, SCORING_MODES, DEFAULT_TREES, load_index_metadata, \
+    save_index_metadata, load_delta, save_delta, saved_gallery_lock
+from ingestion_jobs import JobStore, SkipJob, get_job_store, run_stage, MAIN_ENCODED, ADDITIONALS_ENCODED, DONE, \
+    PENDING, SKIPPED
+from label_store import LabelStore, replace_atomically
+from metrics import timed
 from utils import create_presigned_url, download_image
 
 MAX_IMAGES_TO_ADD = 20
+ENCODING_LENGTH = 128
+# Fold the delta segment into a rebuilt main index once it holds this many encodings
+DELTA_COMPACTION_THRESHOLD = 1000
+
+# Face detection for recognition requests. Read from the environment so spawned encoding workers pick them up.
+DETECTION_MODELS = ("hog", "cnn")
+DETECTION_MODEL = os.environ.get("DETECTION_MODEL", "hog")
+# Faces are detected on a copy whose longest side is at most this many pixels (0 detects at full resolution)
+DETECTION_MAX_SIDE = int(os.environ.get("DETECTION_MAX_SIDE", 1024))
+DETECTION_UPSAMPLE = int(os.environ.get("DETECTION_UPSAMPLE", 1))
+ENCODING_JITTERS = int(os.environ.get("ENCODING_JITTERS", 1))
+
+
+def detect_faces(image_np, max_side=DETECTION_MAX_SIDE, model=DETECTION_MODEL, upsample=DETECTION_UPSAMPLE):
+    """
+    Locate the faces in an image by running the detector on a downscaled copy.
+    Parameters:
+    - image_np: (H, W, 3) RGB image.
+    - max_side: Longest side of the copy the detector sees. 0 or a larger value detects at full resolution.
+    - model: "hog" (fast, CPU) or "cnn" (more accurate, slow without a GPU).
+    - upsample: How many times the detector upsamples the copy to find smaller faces.
+    Returns a list of (top, right, bottom, left) boxes in full-resolution coordinates.
+    """
+    if model not in DETECTION_MODELS:
+        raise ValueError(f"Unknown detection model {model!r}, expected one of {DETECTION_MODELS}.")
+    height, width = image_np.shape[:2]
+    scale = max_side / max(height, width) if max_side else 1.0
+    if scale >= 1.0:
+        return face_recognition.face_locations(image_np, number_of_times_to_upsample=upsample, model=model)
+
+    # Detection time grows with the pixel count, so a 12MP photo is detected at roughly 1MP
+    small = np.asarray(Image.fromarray(image_np).resize((round(width * scale), round(height * scale)),
+                                                        Image.BILINEAR))
+    boxes = face_recognition.face_locations(small, number_of_times_to_upsample=upsample, model=model)
+    return [(max(0, round(top / scale)), min(width, round(right / scale)),
+             min(height, round(bottom / scale)), max(0, round(left / scale)))
+            for top, right, bottom, left in boxes]
+
+
+def compute_face_encodings(image_np, max_side=DETECTION_MAX_SIDE, model=DETECTION_MODEL,
+                           upsample=DETECTION_UPSAMPLE, num_jitters=ENCODING_JITTERS):
+    """
+    Detect and encode every face in an image, as an (N, 128) float32 array.
+    Faces are found on a downscaled copy (see detect_faces) and encoded from the full-resolution image.
+    A module-level function so it can run in a process pool: dlib is CPU-bound and holds the GIL.
+    """
+    with timed("face_detection"):
+        boxes = detect_faces(image_np, max_side, model, upsample)
+    with timed("face_encoding"):
+        encodings = face_recognition.face_encodings(image_np, known_face_locations=boxes, num_jitters=num_jitters) \
+            if boxes else []
+    return np.array(encodings, dtype=np.float32).reshape(len(encodings), ENCODING_LENGTH)
 
 
 class ImageProcessor:
-    def __init__(self, bucket_name):
+    def __init__(self, bucket_name, search_backend="annoy", delta_compaction_threshold=DELTA_COMPACTION_THRESHOLD,
+                 trees=None, k=None, search_k=None, scoring="vote", match_threshold=None):
+        if search_backend not in SEARCH_BACKENDS:
+            raise ValueError(f"Unknown search backend {search_backend!r}, expected one of {SEARCH_BACKENDS}.")
+        if scoring not in SCORING_MODES:
+            raise ValueError(f"Unknown scoring mode {scoring!r}, expected one of {SCORING_MODES}.")
         self.s3 = boto3.client('s3')
         self.bucket_name = bucket_name
-        # Fields for the Annoy index and the mapping dictionary
-        self._annoy_index = None
-        self._index_to_imdb = None
+        self.search_backend = search_backend
+        # Deployment overrides of the index parameters; None uses the values in the gallery's index metadata
+        self.trees = trees
+        self.k = k
+        self.search_k = search_k
+        # How matches are picked and scored, and the score above which a face counts as unknown (None: never)
+        self.scoring = scoring
+        self.match_threshold = match_threshold
+        # Current gallery version (Annoy index, label store and exact index), replaced as a whole on reload
+        self._gallery = None
+        self._gallery_lock = threading.Lock()
+        self.delta_compaction_threshold = delta_compaction_threshold
+        self._compaction_lock = threading.Lock()
 
     ###### Main image processing related functions ######
 
-    def process_main_images_and_save_encodings(self, db_manager):
+    def process_main_images_and_save_encodings(self, db_manager, jobs: JobStore = None, workers=1):
         """
         Process all main images, compute their encodings, and save to the database.
+        Celebs whose main_encoded job is already done are skipped, so an interrupted run resumes where it stopped.
         Parameters:
         - db_manager: Instance of DBManager to interact with the database.
+        - jobs: JobStore recording the progress. Defaults to the process-wide one.
+        - workers: Number of celebs processed at once.
         """
-        # Step 1: Fetch main image S3 URLs for all celebrities
-        all_celebs_ids = db_manager.get_all_imdb_ids()
-
-        for i, imdb_id in enumerate(all_celebs_ids):
-            if i % 50 == 0:
-                print(f"{i} images' encodings saved to db.")
-
-            celeb_info = db_manager.get_celeb_info(imdb_id)
-            if not celeb_info or not celeb_info[7]:
-                print(f"No main image s3-url found for celeb id {imdb_id}")
-                continue
-            main_image_s3_url = celeb_info[7]  # Extracting the main image S3 URL
-
-            # Generate pre-signed URL
-            presigned_url = create_presigned_url(self.bucket_name, main_image_s3_url)
+        # Step 1: Register every celeb with the job table
+        jobs = jobs or get_job_store()
+        jobs.add_celebs(db_manager.get_all_imdb_ids())
 
-            # Step 2: Download the main image
-            image_np = download_image(presigned_url)
+        # Step 2: Encode the main image of every celeb that isn't done yet
+        def main_encoding_job(imdb_id):
+            if not self.process_main_image(db_manager, imdb_id):
+                raise SkipJob("no single face in the main image")
 
-            # Step 3: Compute the face encoding
-            main_image_encoding = face_recognition.face_encodings(image_np)
+        results = run_stage(jobs, MAIN_ENCODED, main_encoding_job, workers, require_upstream=False)
+        print(f"Main images' encodings: {results}")
 
-            # Step 4: Save the encoding to the database
-            if main_image_encoding is not None:
-                num_faces = len(main_image_encoding)
-                if num_faces == 0:
-                    print(f"No face detected in the main image of celeb {imdb_id}.")
-                elif num_faces > 1:
-                    main_image_encoding = []
-                    print(f"More than 1 faces detected in the main image of celeb {imdb_id}, can't identify the "
-                          f"correct face.")
+    def process_main_image(self, db_manager, imdb_id):
+        """
+        Download one celeb's main image from S3, compute its face encoding and save it to the database.
+        Returns whether exactly one face was found, i.e. whether the celeb has a usable main encoding.
+        """
+        celeb_info = db_manager.get_celeb_info(imdb_id)
+        if not celeb_info or not celeb_info[7]:
+            print(f"No main image s3-url found for celeb id {imdb_id}")
+            return False
+        main_image_s3_url = celeb_info[7]  # Extracting the main image S3 URL
+
+        # Step 1: Generate pre-signed URL
+        presigned_url = create_presigned_url(self.bucket_name, main_image_s3_url)
+
+        # Step 2: Download the main image
+        image_np = download_image(presigned_url)
+
+        # Step 3: Compute the face encoding
+        main_image_encoding = face_recognition.face_encodings(image_np)
+
+        # Step 4: Save the encoding to the database, replacing one saved by an interrupted earlier attempt
+        if main_image_encoding is None:
+            print(f"Failed to compute encoding for main image of celeb {imdb_id}")
+            return False
+        num_faces = len(main_image_encoding)
+        if num_faces == 0:
+            print(f"No face detected in the main image of celeb {imdb_id}.")
+        elif num_faces > 1:
+            main_image_encoding = []
+            print(f"More than 1 faces detected in the main image of celeb {imdb_id}, can't identify the "
+                  f"correct face.")
 
-                db_manager.insert_face_encoding(imdb_id, main_image_encoding, "main")
-            else:
-                print(f"Failed to compute encoding for main image of celeb {imdb_id}")
+        db_manager.delete_face_encodings(imdb_id, "main")
+        db_manager.insert_face_encoding(imdb_id, main_image_encoding, "main")
+        return num_faces == 1
 
     ###### Additional images processing related functions ######
 
-    def process_all_celebrity_additional_images(self, db_manager, process_remaining_ids=True):
+    def process_all_celebrity_additional_images(self, db_manager, process_remaining_ids=True, jobs: JobStore = None,
+                                                workers=1):
         """
         Process additional images for all celebrities.
         Parameters:
         - db_manager: Instance of DBManager to interact with the database.
+        - process_remaining_ids: Skip the celebs whose additionals_encoded job is already done or skipped.
+          Otherwise every celeb is processed again.
+        - jobs: JobStore recording the progress. Defaults to the process-wide one.
+        - workers: Number of celebs processed at once (each one also fans out over a process pool).
         """
+        jobs = jobs or get_job_store()
         all_celebs_ids = db_manager.get_all_imdb_ids()
-        processed_ids = db_manager.get_processed_celebs_ids()
+        jobs.add_celebs(all_celebs_ids)
 
         if process_remaining_ids:
-            start_idx = all_celebs_ids.index(processed_ids[-1]) + 1
-            ids_to_process = all_celebs_ids[start_idx:]
-            already_processed_count = start_idx
+            # Celebs that got additional encodings before the job table existed count as done
+            recorded = set(jobs.ids(ADDITIONALS_ENCODED, (DONE, SKIPPED)))
+            jobs.mark([imdb_id for imdb_id in db_manager.get_processed_celebs_ids() if imdb_id not in recorded],
+                      ADDITIONALS_ENCODED, DONE)
         else:
-            ids_to_process = all_celebs_ids
-            already_processed_count = 0
+            jobs.mark(all_celebs_ids, ADDITIONALS_ENCODED, PENDING)
 
-        for i, imdb_id in enumerate(ids_to_process):
+        def additional_images_job(imdb_id):
             print("##########################################################")
-            print(
-                f"Processing additional images for celebrity {i + 1 + already_processed_count}/{len(all_celebs_ids)}: {imdb_id}")
-            self.process_celebrity_additional_images(db_manager, imdb_id)
+            print(f"Processing additional images for celebrity {imdb_id}")
+            if not self.process_celebrity_additional_images(db_manager, imdb_id):
+                raise SkipJob("no main encoding or not enough matching additional images")
+
+        results = run_stage(jobs, ADDITIONALS_ENCODED, additional_images_job, workers, require_upstream=False)
+        print(f"Additional images' encodings: {results}")
 
     def process_celebrity_additional_images(self, db_manager, imdb_id):
+        """Returns whether enough additional images matched the main one to be saved."""
         # 1. Fetch main image encoding
-        main_encoding_list = db_manager.get_main_image_encodings(imdb_id)
-        if not main_encoding_list:
+        main_encoding_np = db_manager.get_main_image_encodings(imdb_id)
+        if main_encoding_np is None:
             print(f"No encoding found for main image of celeb {imdb_id}.")
-            return
-
-        # 1.1. Convert the encoding to numpy array
-        main_encoding_np = np.array(main_encoding_list)
+            return False
 
         # 2. Retrieve additional images URLs
         additional_images_data = db_manager.get_additional_images_urls(imdb_id)
@@ -105,7 +205,7 @@ class ImageProcessor:
         # Early check: If we have less than the desired minimum images, skip processing
         if len(additional_images_urls) < 10:
             print(f"Not enough additional images for celeb {imdb_id}. Skipping.")
-            return
+            return False
 
         # 3. Process additional images in batches
         BATCH_SIZE = 10
@@ -124,18 +224,22 @@ class ImageProcessor:
             potential_matches = len(matched_encodings) + len(additional_images_urls) - (i + BATCH_SIZE)
             if potential_matches < 10:
                 print(f"Can't achieve minimum matched images for celeb {imdb_id}. Skipping.")
-                return
+                return False
 
             # Check for early stopping
             if len(matched_encodings) >= 20:
                 break
 
-        # 4. Save encodings to the database, but only up to the desired number
+        # 4. Save encodings to the database, but only up to the desired number, replacing those of an earlier attempt
         print(f"Adding {len(matched_encodings)} images to DB for celeb id = {imdb_id}.")
-        with open('saved_celebs.txt', 'a') as f:
-            f.write(f"{imdb_id}\n")
+        db_manager.delete_face_encodings(imdb_id, "additional")
         self.save_encodings_to_db(db_manager, imdb_id, matched_encodings, additional_images_data)
 
+        # 5. If this processor serves a gallery, publish the new celeb right away instead of waiting for a rebuild
+        if self._gallery is not None and imdb_id not in self._gallery:
+            self.add_encodings_to_gallery(imdb_id, [main_encoding_np] + [enc for _, enc in matched_encodings])
+        return True
+
     @staticmethod
     def process_additional_image(image_url, main_encoding):
         image_np = download_image(image_url)
@@ -168,87 +272,303 @@ class ImageProcessor:
                     db_manager.insert_face_encoding(imdb_id, encoding, image_type="additional", image_id=image_id)
 
     ###### Annoy and index map related functions ######
-    def build_annoy_index_and_mapping(self, encodings_dict, vector_length=128, trees=10):
+    def build_annoy_index_and_mapping(self, encodings_dict, vector_length=128, trees=None, version=None):
+        """Build the gallery from {imdb_id: [encodings]}, e.g. as returned by get_processed_celebs_all_encodings."""
+        batches = (([imdb_id] * len(encodings), encodings) for imdb_id, encodings in encodings_dict.items())
+        self.build_annoy_index_from_batches(batches, vector_length, trees, version)
+
+    def build_annoy_index_from_batches(self, batches, vector_length=128, trees=None, version=None, metadata=None):
+        """
+        Build the gallery from (imdb_ids, encodings) batches, e.g. streamed by
+        DBManager.iter_processed_celebs_encodings, without holding all encodings in a dict first.
+        trees defaults to self.trees, then DEFAULT_TREES. metadata (e.g. tuned k and search_k) is kept with the index.
+        """
+        trees = trees or self.trees or DEFAULT_TREES
         # Initialize Annoy index with the given vector length and Euclidean distance metric
         annoy_index = AnnoyIndex(vector_length, 'euclidean')
 
-        # Initialize a mapping dictionary to keep track of the index to IMDb ID mapping
-        index_to_imdb = {}
+        # Keep track of the IMDb ID of every index row
+        row_ids = []
 
-        # Current index in Annoy
-        current_index = 0
-
-        # Loop over the encodings dictionary and add each encoding to the Annoy index
-        for imdb_id, encodings in encodings_dict.items():
-            for encoding in encodings:
-                # Add encoding to Annoy index
-                annoy_index.add_item(current_index, encoding)
-
-                # Record the mapping between the current index and the corresponding IMDb ID
-                index_to_imdb[current_index] = imdb_id
-
-                # Increment the current index
-                current_index += 1
+        # Loop over the batches and add each encoding to the Annoy index
+        for imdb_ids, encodings in batches:
+            for imdb_id, encoding in zip(imdb_ids, encodings):
+                # Add encoding to Annoy index, and record the IMDb ID of its row
+                annoy_index.add_item(len(row_ids), encoding)
+                row_ids.append(imdb_id)
 
         # Build the Annoy index with the specified number of trees
         annoy_index.build(trees)
 
-        # Update instance fields
-        self._annoy_index, self._index_to_imdb = annoy_index, index_to_imdb
+        # Publish the new gallery version
+        version = version or time.strftime("built-%Y%m%d-%H%M%S")
+        self._publish_gallery(Gallery(annoy_index, LabelStore.from_row_ids(row_ids), version,
+                                      metadata={**(metadata or {}), "trees": trees, "build_id": uuid.uuid4().hex}))
 
     def save_annoy_index_and_mapping(self, index_path, mapping_path):
-        if not self._annoy_index or not self._index_to_imdb:
+        """
+        Save the Annoy index, and the label store as a directory of .npy files at mapping_path.
+        Every file is written under a temporary name and renamed into place, since server workers may have the
+        current ones memory-mapped: overwriting them in place could hand those workers garbage or a SIGBUS.
+        The delta segment is saved with them, so the encodings it holds aren't lost.
+        """
+        if self._gallery is None:
             raise ValueError("Annoy index and mapping have not been built yet.")
+        with saved_gallery_lock(index_path):
+            self._save_gallery(self._gallery, index_path, mapping_path)
 
+    @staticmethod
+    def _save_gallery(gallery, index_path, mapping_path):
         # Save the Annoy index to the specified path
-        self._annoy_index.save(index_path)
+        replace_atomically(index_path, gallery.annoy_index.save)
+
+        # Save the row labels and IMDb ID table
+        gallery.labels.save(mapping_path)
+
+        # Save trees and the search parameters, which load_annoy_index_and_mapping picks up again
+        save_index_metadata(index_path, gallery.metadata)
+
+        # Save the delta encodings, or drop the saved ones of a previous build
+        save_delta(index_path, gallery.metadata.get("build_id"), *gallery.delta_items())
+
+    def load_annoy_index_and_mapping(self, vector_length, index_path, mapping_path, mmap=True, version=None):
+        """
+        Load the Annoy index and its label store and publish them as the current gallery version.
+        mapping_path is either a label store directory or a legacy pickled index_to_imdb dict, which is converted
+        in memory. With mmap, the index file and label arrays are mapped read-only without prefaulting, so every
+        worker process serving the same files shares one copy in the page cache instead of holding its own.
+        Loading happens before the swap, so it can run in the background while requests use the old version.
+        The version defaults to the index file's modification time. Search parameters saved with the index
+        (see save_index_metadata) and its saved delta encodings are loaded with it.
+        """
+        self._publish_gallery(self._load_gallery(vector_length, index_path, mapping_path, mmap, version))
+
+    @staticmethod
+    def _load_labels(mapping_path, mmap=True):
+        if mapping_path.endswith('.pkl'):
+            return LabelStore.from_pickle(mapping_path)
+        return LabelStore.load(mapping_path, mmap=mmap)
+
+    @staticmethod
+    def _load_gallery(vector_length, index_path, mapping_path, mmap=True, version=None):
+        annoy_index = AnnoyIndex(vector_length, 'euclidean')
+        annoy_index.load(index_path, prefault=not mmap)
+
+        labels = ImageProcessor._load_labels(mapping_path, mmap)
+
+        if annoy_index.get_n_items() != len(labels):
+            annoy_index.unload()
+            raise ValueError(f"Index at {index_path} has {annoy_index.get_n_items()} items but the mapping has "
+                             f"{len(labels)}.")
+
+        version = version or time.strftime("%Y%m%d-%H%M%S", time.localtime(os.path.getmtime(index_path)))
+        gallery = Gallery(annoy_index, labels, version, metadata=load_index_metadata(index_path))
+        delta = load_delta(index_path, gallery.metadata.get("build_id"))
+        if delta is not None:
+            gallery.add_delta_items(*delta)
+        return gallery
+
+    def save_brute_force_index(self, index_path):
+        """Save the exact NumPy index vectors next to the Annoy index."""
+        with self.use_gallery() as gallery:
+            gallery.get_brute_force_index().save(index_path)
+
+    def load_brute_force_index(self, vector_length, index_path, mmap=True):
+        """Attach a saved exact index to the current gallery instead of extracting its vectors on first use."""
+        brute_force_index = BruteForceIndex(vector_length)
+        brute_force_index.load(index_path, mmap=mmap)
+        with self.use_gallery() as gallery:
+            gallery.set_brute_force_index(brute_force_index)
+
+    def _publish_gallery(self, gallery, replaces=None, carry_over_from=None):
+        """
+        Atomically make gallery the current version. The previous one is released after its last reader.
+        With replaces, the swap only happens if that gallery is still current, and its delta encodings from
+        position carry_over_from on (added while the new gallery was being built) are moved over first.
+        Returns whether the gallery was published.
+        """
+        with self._gallery_lock:
+            previous = self._gallery
+            if replaces is not None:
+                if previous is not replaces:
+                    return False
+                gallery.add_delta_items(*previous.delta_items(carry_over_from))
+            self._gallery = gallery
+        print(f"Published gallery version {gallery.version} ({len(gallery)} encodings).")
+        if previous is not None:
+            previous.retire()
+        return True
+
+    ###### Incremental gallery updates ######
+
+    def add_encodings_to_gallery(self, imdb_id, encodings):
+        """
+        Make new encodings searchable immediately by adding them to the current gallery's delta segment, which
+        is searched exactly and merged with the main index results. Triggers a background compaction once the
+        delta reaches delta_compaction_threshold encodings.
+        """
+        with self._gallery_lock:
+            if self._gallery is None:
+                raise ValueError("Annoy index or mapping is missing. Please load or build them first.")
+            self._gallery.add_encodings(imdb_id, encodings)
+            delta_size = len(self._gallery.delta)
 
-        # Save the mapping dictionary using pickle
-        with open(mapping_path, 'wb') as f:
-            pickle.dump(self._index_to_imdb, f)
+        if delta_size >= self.delta_compaction_threshold and not self._compaction_lock.locked():
+            threading.Thread(target=self.compact_gallery, daemon=True).start()
 
-    def load_annoy_index_and_mapping(self, vector_length, index_path, mapping_path):
-        # Load the Annoy index and mapping dictionary and update the instance fields
-        self._annoy_index = AnnoyIndex(vector_length, 'euclidean')
-        self._annoy_index.load(index_path)
+    def compact_gallery(self, trees=None):
+        """
+        Fold the delta segment into a freshly built main index and publish it as a new gallery version.
+        Requests keep using the current version while the new index builds. Only the served gallery changes;
+        save it with save_annoy_index_and_mapping, or use compact_saved_gallery for a gallery served from files.
+        """
+        with self._compaction_lock:
+            with self.use_gallery() as gallery:
+                n_delta = len(gallery.delta)
+                if n_delta == 0:
+                    return
+                compacted = self._compact(gallery, n_delta, trees)
+            if not self._publish_gallery(compacted, replaces=gallery, carry_over_from=n_delta):
+                print("Gallery was replaced during compaction, dropping the compacted index.")
+                compacted.annoy_index.unload()
+
+    def _compact(self, gallery, n_delta, trees=None):
+        """A new gallery whose main index holds gallery's main encodings and its first n_delta delta encodings."""
+        main_vectors = gallery.main_vectors()
+        delta_vectors, delta_ids = gallery.delta_items()
+        row_ids = [gallery.labels[row] for row in range(len(gallery.labels))] + delta_ids[:n_delta]
+
+        annoy_index = AnnoyIndex(gallery.annoy_index.f, 'euclidean')
+        for i, vector in enumerate(np.vstack([main_vectors, delta_vectors[:n_delta]])):
+            annoy_index.add_item(i, vector)
+        trees = trees or self.trees or gallery.trees
+        annoy_index.build(trees)
 
-        # Load the mapping dictionary using pickle
-        with open(mapping_path, 'rb') as f:
-            self._index_to_imdb = pickle.load(f)
+        return Gallery(annoy_index, LabelStore.from_row_ids(row_ids), time.strftime("compacted-%Y%m%d-%H%M%S"),
+                       metadata={**gallery.metadata, "trees": trees, "build_id": uuid.uuid4().hex})
 
-    # Provide methods to access the Annoy index and mapping dictionary
+    ###### Galleries shared through their files ######
+
+    @staticmethod
+    def add_encodings_to_saved_gallery(index_path, mapping_path, imdb_id, encodings):
+        """
+        Append a celeb's encodings to the delta saved next to index_path, where every process serving the index
+        picks them up on its next load. Returns the number of encodings in the saved delta, or None if the celeb
+        is already in the saved index or delta, so a repeated call doesn't add its encodings twice.
+        """
+        encodings = np.atleast_2d(np.asarray(encodings, dtype=np.float32))
+        with saved_gallery_lock(index_path):
+            build_id = load_index_metadata(index_path).get("build_id")
+            vectors, imdb_ids = load_delta(index_path, build_id) or (np.empty((0, encodings.shape[1])), [])
+            if imdb_id in imdb_ids or np.any(ImageProcessor._load_labels(mapping_path).ids == imdb_id.encode()):
+                return None
+            imdb_ids = imdb_ids + [imdb_id] * len(encodings)
+            save_delta(index_path, build_id, np.vstack([vectors, encodings]), imdb_ids)
+        return len(imdb_ids)
+
+    def compact_saved_gallery(self, vector_length, index_path, mapping_path, trees=None):
+        """
+        Fold the delta saved next to index_path into a rebuilt index saved under the same paths. The files are
+        only locked while they are read and written, not while the index builds: encodings added meanwhile are
+        carried over into the new delta. Returns whether the saved gallery was compacted; processes serving it
+        still have to reload it.
+        """
+        with self._compaction_lock:
+            with saved_gallery_lock(index_path):
+                gallery = self._load_gallery(vector_length, index_path, mapping_path)
+            n_delta = len(gallery.delta)
+            try:
+                if n_delta == 0:
+                    return False
+                compacted = self._compact(gallery, n_delta, trees)
+                build_id = gallery.metadata.get("build_id")
+                with saved_gallery_lock(index_path):
+                    if load_index_metadata(index_path).get("build_id") != build_id:
+                        print(f"{index_path} was replaced during compaction, dropping the compacted index.")
+                        compacted.retire()
+                        return False
+                    late_delta = load_delta(index_path, build_id)
+                    if late_delta is not None:
+                        late_vectors, late_ids = late_delta
+                        compacted.add_delta_items(late_vectors[n_delta:], late_ids[n_delta:])
+                    self._save_gallery(compacted, index_path, mapping_path)
+                compacted.retire()
+                print(f"Compacted {n_delta} delta encodings into {index_path}.")
+                return True
+            finally:
+                gallery.retire()
+
+    @contextmanager
+    def use_gallery(self):
+        """Pin the current gallery version, e.g. for the duration of a request."""
+        with self._gallery_lock:
+            gallery = self._gallery
+            if gallery is None:
+                raise ValueError("Annoy index or mapping is missing. Please load or build them first.")
+            gallery.acquire()
+        try:
+            yield gallery
+        finally:
+            gallery.release()
+
+    # Provide methods to access the current gallery version
     @property
     def annoy_index(self):
-        return self._annoy_index
+        return self._gallery.annoy_index if self._gallery is not None else None
 
     @property
     def index_to_imdb(self):
-        return self._index_to_imdb
+        return self._gallery.labels if self._gallery is not None else None
 
-    def recognize_celeb_from_image(self, image_np, db_manager):
-        """Recognize the celebrity from the given image using the pre-built Annoy index."""
+    @property
+    def index_version(self):
+        return self._gallery.version if self._gallery is not None else None
+
+    def recognize_celeb_from_image(self, image_np, db_manager, backend=None, gallery=None):
+        """
+        Recognize the celebrity from the given image using the pre-built Annoy index.
+        Pass a gallery pinned with use_gallery() to search that version, otherwise the current one is used.
+        """
         # Ensure that Annoy index and mapping are available
-        if not self.annoy_index or not self.index_to_imdb:
+        if self._gallery is None and gallery is None:
             raise ValueError("Annoy index or mapping is missing. Please load or build them first.")
 
         # Extract face encoding from the new image
         # image_np = download_image(image_url)
-        image_encodings = face_recognition.face_encodings(image_np)
+        image_encodings = compute_face_encodings(image_np)
         num_faces = len(image_encodings)
         if num_faces == 0:
             print(f"No faces recognized in the image. Please try again with another image.")
             return []
 
-        results = []
-
-        # Loop through each detected face encoding
-        for encoding in image_encodings:
-            nearest_indexes = self.annoy_index.get_nns_by_vector(encoding, 15)  # Retrieve the 15 closest matches
-            nearest_imdb_ids = [self.index_to_imdb[idx] for idx in nearest_indexes]
-            # print(nearest_imdb_ids)
-
-            # Use Counter to determine the most common IMDb ID
-            most_common_imdb_id, appearances = Counter(nearest_imdb_ids).most_common(1)[0]
-            results.append(most_common_imdb_id)
+        # Look up and vote for all detected faces at once
+        return self.match_encodings(image_encodings, backend=backend, gallery=gallery)
 
-        return results
+    def match_encodings(self, encodings, k=None, backend=None, gallery=None, search_k=None):
+        """
+        Match a batch of face encodings against the gallery.
+        Parameters:
+        - encodings: (N, 128) array of face encodings.
+        - k: Number of nearest neighbours that vote for each face. Defaults to self.k, then the index metadata.
+        - backend: "annoy", "numpy" (exact brute force) or "auto". Defaults to self.search_backend.
+        - gallery: Gallery version pinned by the caller. Defaults to the current version.
+        - search_k: Annoy nodes inspected per face. Defaults to self.search_k, then the index metadata.
+        Returns a list with the IMDb ID matched to each face, picked with self.scoring. Faces without neighbours,
+        or scored above self.match_threshold, are matched to None.
+        """
+        return self.match_encodings_with_scores(encodings, k, backend, gallery, search_k)[0]
+
+    def match_encodings_with_scores(self, encodings, k=None, backend=None, gallery=None, search_k=None):
+        """Like match_encodings, but returns (imdb_ids, scores). Lower scores are closer matches."""
+        encodings = np.atleast_2d(np.asarray(encodings, dtype=np.float32))
+        if len(encodings) == 0:
+            return [], []
+
+        k = k or self.k
+        search_k = self.search_k if search_k is None else search_k
+        search = (k, backend or self.search_backend, search_k, self.scoring, self.match_threshold)
+        with timed("gallery_lookup"):
+            if gallery is not None:
+                return gallery.match_encodings_with_scores(encodings, *search)
+            with self.use_gallery() as gallery:
+                return gallery.match_encodings_with_scores(encodings, *search)
@@ -0,0 +1,138 @@
+import argparse
+import os
+from db_manager import DBManager
+from image_processor import ImageProcessor, ENCODING_LENGTH
+from ingestion_jobs import JobStore, SkipJob, get_job_store, run_pipeline, STAGES, SCRAPED, MAIN_IMAGE_STORED, \
+    MAIN_ENCODED, ADDITIONALS_ENCODED, INDEXED
+from scrape_manager import scrape_celeb, process_imdb_pages, CELEB_CONCURRENCY
+from utils import upload_main_image_to_s3
+
+# Celebs processed at once per stage. Additional images fan out over a process pool of their own.
+STAGE_WORKERS = {SCRAPED: CELEB_CONCURRENCY, MAIN_IMAGE_STORED: 8, MAIN_ENCODED: 2, ADDITIONALS_ENCODED: 1,
+                 INDEXED: 1}
+
+
+def build_handlers(db_manager: DBManager, image_processor: ImageProcessor, stages=STAGES, workers=None):
+    """
+    {stage: (handler, workers)} running each ingestion stage for one celeb, for run_pipeline.
+    Parameters:
+    - db_manager: DBManager the stages read from and write to.
+    - image_processor: ImageProcessor for the S3 bucket and the encodings; the indexed stage needs a loaded gallery.
+    - stages: Stages to build handlers for.
+    - workers: {stage: number of celebs processed at once}, overriding STAGE_WORKERS.
+    """
+    workers = {**STAGE_WORKERS, **(workers or {})}
+
+    def scrape(imdb_id):
+        scrape_celeb(imdb_id, db_manager)
+
+    def store_main_image(imdb_id):
+        celeb_info = db_manager.get_celeb_info(imdb_id)
+        if not celeb_info or not celeb_info[6]:
+            raise SkipJob("no main image found while scraping")
+        upload_main_image_to_s3(celeb_info[6], imdb_id, celeb_info[1], image_processor.s3,
+                                image_processor.bucket_name, db_manager)
+
+    def encode_main_image(imdb_id):
+        if not image_processor.process_main_image(db_manager, imdb_id):
+            raise SkipJob("no single face in the main image")
+
+    def encode_additional_images(imdb_id):
+        if not image_processor.process_celebrity_additional_images(db_manager, imdb_id):
+            raise SkipJob("not enough matching additional images")
+
+    def index(imdb_id):
+        # Celebs are published to the served gallery as soon as their additional images are encoded, if it's loaded
+        with image_processor.use_gallery() as gallery:
+            if imdb_id in gallery:
+                return
+        encodings = [db_manager.get_main_image_encodings(imdb_id)] + db_manager.get_additional_image_encodings(imdb_id)
+        image_processor.add_encodings_to_gallery(imdb_id, encodings)
+
+    handlers = {SCRAPED: scrape, MAIN_IMAGE_STORED: store_main_image, MAIN_ENCODED: encode_main_image,
+                ADDITIONALS_ENCODED: encode_additional_images, INDEXED: index}
+    return {stage: (handlers[stage], workers[stage]) for stage in stages}
+
+
+def create_processed_celebs_names_file(db_manager, jobs=None):
+    # Celebs whose additional images were encoded, as recorded by the ingestion job table
+    ids_list = (jobs or get_job_store()).ids(ADDITIONALS_ENCODED)
+
+    with open('../data/saved_celebs_names.txt', 'a', encoding='utf-8') as f:
+        for current_id in ids_list:
+            celeb_data = db_manager.get_celeb_info(current_id)
+            name = celeb_data[1]
+            page_url = celeb_data[5]
+            f.write(f"{current_id:<9} - {name:<25} - {page_url:<35}\n")
+
+
+def print_status(jobs: JobStore, max_errors=20):
+    for stage, counts in jobs.counts().items():
+        print(f"{stage:<20} " + ", ".join(f"{status}: {n}" for status, n in sorted(counts.items())))
+    errors = jobs.errors()
+    for imdb_id, stage, status, attempts, error in errors[:max_errors]:
+        print(f"{status:<6} {stage:<20} {imdb_id} after {attempts} attempts: {error}")
+    if len(errors) > max_errors:
+        print(f"... and {len(errors) - max_errors} more failed jobs.")
+
+
+def parse_workers(value):
+    stage, _, n = value.partition("=")
+    if stage not in STAGES or not n.isdigit():
+        raise argparse.ArgumentTypeError(f"expected <stage>=<workers> with a stage in {STAGES}, got {value!r}")
+    return stage, int(n)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the ingestion stages of every registered celeb, resuming "
+                                                 "where the last run stopped.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--workers", nargs="*", type=parse_workers, default=[], help="e.g. scraped=16")
+    parser.add_argument("--start-url", help="IMDb list to register celebs from, scraping them on the way.")
+    parser.add_argument("--max-pages", type=int, default=1)
+    parser.add_argument("--retry-failed", action="store_true", help="Give failed and dead jobs fresh attempts.")
+    parser.add_argument("--recover", action="store_true",
+                        help="Hand out running jobs again right away. Only when no other ingestion is running.")
+    parser.add_argument("--status", action="store_true", help="Only print the job table's progress.")
+    parser.add_argument("--index", help="Annoy index to add the celebs to in the indexed stage, and save back.")
+    parser.add_argument("--mapping", default="../data/new_idx_labels")
+    args = parser.parse_args()
+
+    jobs = get_job_store()
+    if args.status:
+        print_status(jobs)
+        return
+    if args.recover:
+        print(f"Recovered {jobs.recover()} running jobs.")
+    if args.retry_failed:
+        print(f"Retrying {jobs.retry_failed()} failed jobs.")
+
+    db_manager = DBManager(
+        host="celebs-database-1.c4duzx241qat.eu-north-1.rds.amazonaws.com",
+        user=os.environ.get("DB_USER"),
+        password=os.environ.get("DB_PASSWORD"),
+        database="celebs_database",
+        table="Celebs2")
+    image_processor = ImageProcessor(bucket_name='celebs-images-bucket-2')
+
+    stages = list(args.stages)
+    if INDEXED in stages:
+        if args.index:
+            image_processor.load_annoy_index_and_mapping(ENCODING_LENGTH, args.index, args.mapping)
+        else:
+            print("No --index given, skipping the indexed stage.")
+            stages.remove(INDEXED)
+
+    if args.start_url:
+        process_imdb_pages(args.start_url, args.max_pages, db_manager, image_processor, jobs)
+    results = run_pipeline(jobs, build_handlers(db_manager, image_processor, stages, dict(args.workers)))
+    print(f"Attempts this run: {results}")
+
+    if INDEXED in stages:
+        image_processor.compact_gallery()
+        image_processor.save_annoy_index_and_mapping(args.index, args.mapping)
+    print_status(jobs)
+
+
+if __name__ == "__main__":
+    main()
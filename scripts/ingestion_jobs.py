@@ -0,0 +1,331 @@
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+
+# Per-celeb ingestion stages, in order; a celeb's stage becomes runnable once its previous stage is done
+SCRAPED = "scraped"
+MAIN_IMAGE_STORED = "main_image_stored"
+MAIN_ENCODED = "main_encoded"
+ADDITIONALS_ENCODED = "additionals_encoded"
+INDEXED = "indexed"
+STAGES = (SCRAPED, MAIN_IMAGE_STORED, MAIN_ENCODED, ADDITIONALS_ENCODED, INDEXED)
+
+# Job statuses. Failed jobs are retried after a backoff until max_attempts, then they are dead.
+PENDING, RUNNING, DONE, FAILED, DEAD, SKIPPED = "pending", "running", "done", "failed", "dead", "skipped"
+
+# SQLite file of the job table, in the data directory next to the index files wherever the scripts are run from
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+INGESTION_JOBS_PATH = os.environ.get("INGESTION_JOBS_PATH", os.path.join(DATA_DIR, "ingestion_jobs.sqlite"))
+MAX_ATTEMPTS = int(os.environ.get("INGESTION_MAX_ATTEMPTS", 5))
+BACKOFF_BASE_SECONDS = float(os.environ.get("INGESTION_BACKOFF_BASE_SECONDS", 30))
+MAX_BACKOFF_SECONDS = 3600
+# A running job not finished after this long belongs to a crashed worker and is handed out again
+LEASE_SECONDS = float(os.environ.get("INGESTION_LEASE_SECONDS", 1800))
+POLL_INTERVAL_SECONDS = 1.0
+
+_store = None
+_store_pid = None
+_store_lock = threading.Lock()
+
+
+class SkipJob(Exception):
+    """Raised by a stage handler when a celeb can't go through the stage, e.g. no face in its main image."""
+
+
+def upstream_stage(stage):
+    index = STAGES.index(stage)
+    return STAGES[index - 1] if index else None
+
+
+class JobStore:
+    """
+    Durable per-celeb, per-stage job table in one SQLite file, replacing the scraper's text logs.
+    Workers claim runnable jobs, which records them as running under a lease, and report each one as done,
+    skipped or failed. Failed jobs are retried with exponential backoff, and jobs left running by a crashed
+    process are handed out again once their lease expires, so ingestion resumes exactly where it stopped.
+    Thread-safe, and safe to share between processes.
+    """
+
+    def __init__(self, path=INGESTION_JOBS_PATH, max_attempts=MAX_ATTEMPTS, backoff_base=BACKOFF_BASE_SECONDS,
+                 lease_seconds=LEASE_SECONDS, clock=time.time):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.lease_seconds = lease_seconds
+        self._clock = clock
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS jobs (imdb_id TEXT NOT NULL, stage TEXT NOT NULL, "
+                         "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT, "
+                         "next_attempt_at REAL NOT NULL DEFAULT 0, updated_at REAL NOT NULL, worker TEXT, "
+                         "PRIMARY KEY (imdb_id, stage))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_stage_status ON jobs (stage, status)")
+        # Progress markers that aren't per celeb, like the next list page to scrape
+        self._db.execute("CREATE TABLE IF NOT EXISTS checkpoints (name TEXT PRIMARY KEY, value TEXT, "
+                         "updated_at REAL NOT NULL)")
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, so two processes can't claim the same job
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def add_celebs(self, imdb_ids, stages=STAGES):
+        """Register celebs with a pending job per stage. Celebs that are already registered keep their jobs."""
+        now = self._clock()
+        with self._transaction() as db:
+            db.executemany("INSERT OR IGNORE INTO jobs (imdb_id, stage, status, updated_at) VALUES (?, ?, ?, ?)",
+                           [(imdb_id, stage, PENDING, now) for imdb_id in imdb_ids for stage in stages])
+
+    def mark(self, imdb_ids, stage, status, error=None):
+        """Set the status of many celebs' jobs at once, e.g. to record work done before the job table existed."""
+        now = self._clock()
+        with self._transaction() as db:
+            db.executemany("INSERT INTO jobs (imdb_id, stage, status, last_error, updated_at) VALUES (?, ?, ?, ?, ?) "
+                           "ON CONFLICT (imdb_id, stage) DO UPDATE SET status = excluded.status, attempts = 0, "
+                           "last_error = excluded.last_error, next_attempt_at = 0, updated_at = excluded.updated_at",
+                           [(imdb_id, stage, status, error, now) for imdb_id in imdb_ids])
+
+    def _runnable_filter(self, stage, imdb_ids, require_upstream):
+        """WHERE clause and parameters selecting stage's jobs, optionally only for imdb_ids and done upstream."""
+        clause, params = "j.stage = ?", [stage]
+        if imdb_ids is not None:
+            imdb_ids = list(imdb_ids)
+            clause += f" AND j.imdb_id IN ({', '.join('?' * len(imdb_ids))})"
+            params += imdb_ids
+        if require_upstream and upstream_stage(stage):
+            clause += (" AND EXISTS (SELECT 1 FROM jobs u WHERE u.imdb_id = j.imdb_id AND u.stage = ? "
+                       "AND u.status = ?)")
+            params += [upstream_stage(stage), DONE]
+        return clause, params
+
+    def claim(self, stage, limit, imdb_ids=None, require_upstream=True):
+        """
+        Mark up to limit runnable jobs of stage as running for this worker and return their IMDb IDs.
+        Runnable are pending jobs, failed jobs whose backoff has passed, and running jobs whose lease expired.
+        Parameters:
+        - stage: One of STAGES.
+        - limit: Maximum number of jobs to claim.
+        - imdb_ids: Only claim jobs of these celebs.
+        - require_upstream: Only claim jobs whose previous stage is done.
+        """
+        now = self._clock()
+        clause, params = self._runnable_filter(stage, imdb_ids, require_upstream)
+        with self._transaction() as db:
+            rows = db.execute(f"SELECT j.imdb_id FROM jobs j WHERE {clause} AND (j.status = ? "
+                              f"OR (j.status = ? AND j.next_attempt_at <= ?) OR (j.status = ? AND j.updated_at <= ?)) "
+                              f"ORDER BY j.imdb_id LIMIT ?",
+                              params + [PENDING, FAILED, now, RUNNING, now - self.lease_seconds, limit]).fetchall()
+            claimed = [row[0] for row in rows]
+            db.executemany("UPDATE jobs SET status = ?, attempts = attempts + 1, updated_at = ?, worker = ? "
+                           "WHERE imdb_id = ? AND stage = ?",
+                           [(RUNNING, now, self.worker, imdb_id, stage) for imdb_id in claimed])
+        return claimed
+
+    def complete(self, imdb_id, stage):
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET status = ?, last_error = NULL, updated_at = ? WHERE imdb_id = ? AND stage = ?",
+                       (DONE, self._clock(), imdb_id, stage))
+
+    def skip(self, imdb_id, stage, reason):
+        """Record that the celeb can't go through stage, nor through any later stage."""
+        later_stages = STAGES[STAGES.index(stage):]
+        with self._transaction() as db:
+            db.executemany("UPDATE jobs SET status = ?, last_error = ?, updated_at = ? WHERE imdb_id = ? AND stage = ?",
+                           [(SKIPPED, reason if later == stage else f"{stage} skipped: {reason}", self._clock(),
+                             imdb_id, later) for later in later_stages])
+
+    def fail(self, imdb_id, stage, error):
+        """Record a failed attempt: retried after an exponential backoff, or dead after max_attempts."""
+        with self._transaction() as db:
+            row = db.execute("SELECT attempts FROM jobs WHERE imdb_id = ? AND stage = ?", (imdb_id, stage)).fetchone()
+            attempts = row[0] if row else self.max_attempts
+            now = self._clock()
+            if attempts >= self.max_attempts:
+                status, next_attempt_at = DEAD, 0
+            else:
+                # Jitter keeps the retries of a batch that failed together (e.g. during an outage) apart
+                backoff = min(self.backoff_base * 2 ** (attempts - 1) * (1 + random.random()), MAX_BACKOFF_SECONDS)
+                status, next_attempt_at = FAILED, now + backoff
+            db.execute("UPDATE jobs SET status = ?, last_error = ?, next_attempt_at = ?, updated_at = ? "
+                       "WHERE imdb_id = ? AND stage = ?", (status, error, next_attempt_at, now, imdb_id, stage))
+
+    def retry_failed(self, stage=None):
+        """Give failed and dead jobs (of stage, or of every stage) a fresh set of attempts. Returns their number."""
+        query = "UPDATE jobs SET status = ?, attempts = 0, next_attempt_at = 0, updated_at = ? WHERE status IN (?, ?)"
+        params = [PENDING, self._clock(), FAILED, DEAD]
+        if stage:
+            query += " AND stage = ?"
+            params.append(stage)
+        with self._transaction() as db:
+            return db.execute(query, params).rowcount
+
+    def recover(self, worker=None):
+        """
+        Hand out the running jobs of a crashed worker (of every worker if None) again, without waiting for their
+        lease to expire. Only call it when those workers are gone. Returns the number of jobs recovered.
+        """
+        query, params = "UPDATE jobs SET status = ?, updated_at = ? WHERE status = ?", [PENDING, self._clock(), RUNNING]
+        if worker:
+            query += " AND worker = ?"
+            params.append(worker)
+        with self._transaction() as db:
+            return db.execute(query, params).rowcount
+
+    def has_unfinished(self, stage, imdb_ids=None, require_upstream=True):
+        """Whether stage has jobs that are running or waiting for a retry, or runnable ones not yet claimed."""
+        clause, params = self._runnable_filter(stage, imdb_ids, require_upstream)
+        with self._lock:
+            return self._db.execute(f"SELECT EXISTS (SELECT 1 FROM jobs j WHERE {clause} AND j.status IN (?, ?, ?))",
+                                    params + [PENDING, RUNNING, FAILED]).fetchone()[0] == 1
+
+    def ids(self, stage, statuses=(DONE,)):
+        with self._lock:
+            rows = self._db.execute(f"SELECT imdb_id FROM jobs WHERE stage = ? AND status IN "
+                                    f"({', '.join('?' * len(statuses))}) ORDER BY imdb_id",
+                                    [stage, *statuses]).fetchall()
+        return [row[0] for row in rows]
+
+    def errors(self, stage=None):
+        """[(imdb_id, stage, status, attempts, last_error)] of the failed and dead jobs."""
+        query, params = "SELECT imdb_id, stage, status, attempts, last_error FROM jobs WHERE status IN (?, ?)", \
+            [FAILED, DEAD]
+        if stage:
+            query += " AND stage = ?"
+            params.append(stage)
+        with self._lock:
+            return self._db.execute(query + " ORDER BY stage, imdb_id", params).fetchall()
+
+    def counts(self):
+        """{stage: {status: number of jobs}}."""
+        counts = {stage: {} for stage in STAGES}
+        with self._lock:
+            for stage, status, n in self._db.execute("SELECT stage, status, COUNT(*) FROM jobs GROUP BY stage, status"):
+                counts.setdefault(stage, {})[status] = n
+        return counts
+
+    def get_checkpoint(self, name, default=None):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM checkpoints WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else default
+
+    def set_checkpoint(self, name, value):
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO checkpoints (name, value, updated_at) VALUES (?, ?, ?)",
+                       (name, value, self._clock()))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def get_job_store():
+    """Return the process-wide job store at INGESTION_JOBS_PATH, opening it on first use (and again after a fork)."""
+    global _store, _store_pid
+    with _store_lock:
+        if _store is None or _store_pid != os.getpid():
+            _store, _store_pid = JobStore(), os.getpid()
+        return _store
+
+
+def run_job(jobs: JobStore, stage, handler, imdb_id):
+    """Run handler(imdb_id) for a claimed job and record the outcome. Returns the status it ended with."""
+    try:
+        handler(imdb_id)
+    except SkipJob as e:
+        print(f"Skipping {stage} for {imdb_id}: {e}")
+        jobs.skip(imdb_id, stage, str(e))
+        return SKIPPED
+    except Exception as e:
+        print(f"{stage} failed for {imdb_id}: {type(e).__name__}: {e}")
+        jobs.fail(imdb_id, stage, f"{type(e).__name__}: {e}")
+        return FAILED
+    jobs.complete(imdb_id, stage)
+    return DONE
+
+
+def run_stage(jobs: JobStore, stage, handler, workers=1, imdb_ids=None, require_upstream=True, upstream_active=None,
+              wait_for_retries=True, poll_interval=POLL_INTERVAL_SECONDS):
+    """
+    Run handler over every runnable job of stage on a pool of workers, until none is left.
+    Failed jobs are retried once their backoff has passed, so this waits for them rather than giving up early.
+    Parameters:
+    - jobs: The JobStore.
+    - stage: One of STAGES.
+    - handler: Called with an IMDb ID. Raises SkipJob to skip the celeb, or any other exception to fail the job.
+    - workers: Number of jobs run at once.
+    - imdb_ids: Only run the jobs of these celebs.
+    - require_upstream: Only run jobs whose previous stage is done.
+    - upstream_active: Returns whether the previous stage is still running (see run_pipeline), in which case more
+      jobs may become runnable and the stage keeps polling.
+    - wait_for_retries: Wait for failed jobs' backoff to pass and retry them. Otherwise return as soon as nothing
+      is runnable, leaving them to a later run.
+    Returns {status: number of jobs} of the attempts made.
+    """
+    results = {}
+    if imdb_ids is not None:
+        imdb_ids = list(imdb_ids)
+        if not imdb_ids:
+            return results
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=stage) as executor:
+        running = set()
+        while True:
+            # Step 1: Keep every worker busy with a claimed job
+            if len(running) < workers:
+                for imdb_id in jobs.claim(stage, workers - len(running), imdb_ids, require_upstream):
+                    running.add(executor.submit(run_job, jobs, stage, handler, imdb_id))
+            if running:
+                done, running = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[future.result()] = results.get(future.result(), 0) + 1
+                continue
+
+            # Step 2: Nothing to run right now; stop unless retries are pending or upstream may still add work
+            upstream_running = upstream_active is not None and upstream_active()
+            if not upstream_running and (not wait_for_retries
+                                         or not jobs.has_unfinished(stage, imdb_ids, require_upstream)):
+                return results
+            time.sleep(poll_interval)
+
+
+def run_pipeline(jobs: JobStore, handlers, imdb_ids=None, poll_interval=POLL_INTERVAL_SECONDS):
+    """
+    Run several stages at once, each on its own workers, so a celeb moves to its next stage as soon as the
+    previous one is done instead of waiting for the whole previous stage.
+    Parameters:
+    - jobs: The JobStore.
+    - handlers: {stage: (handler, workers)}. Stages without a handler aren't run.
+    - imdb_ids: Only run the jobs of these celebs.
+    Returns {stage: {status: number of jobs}} of the attempts made.
+    """
+    threads, results = {}, {}
+
+    def stage_loop(stage, handler, workers, upstream):
+        upstream_thread = threads.get(upstream)
+        results[stage] = run_stage(jobs, stage, handler, workers, imdb_ids,
+                                   upstream_active=upstream_thread.is_alive if upstream_thread else None,
+                                   poll_interval=poll_interval)
+
+    for stage in STAGES:
+        if stage in handlers:
+            handler, workers = handlers[stage]
+            threads[stage] = threading.Thread(target=stage_loop, args=(stage, handler, workers, upstream_stage(stage)),
+                                              name=f"{stage}-loop")
+    for thread in threads.values():
+        thread.start()
+    for thread in threads.values():
+        thread.join()
+    return results
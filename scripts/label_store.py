@@ -0,0 +1,118 @@
+import os
+import pickle
+import sys
+import numpy as np
+
+ROW_LABELS_FILE = "rows.npy"
+IDS_FILE = "ids.npy"
+
+
+def replace_atomically(path, write):
+    """
+    Write a file by calling write with a temporary path next to it, then rename that over path. Readers never see
+    a half-written file, and processes that memory-mapped the old one keep reading it until they reload.
+    """
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_array(path, array):
+    """np.save array to path atomically (see replace_atomically)."""
+    def write(tmp_path):
+        # Through a file object, since np.save would append .npy to the temporary name
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+    replace_atomically(path, write)
+
+
+class LabelStore:
+    """
+    Array-backed replacement for the pickled index_to_imdb dict.
+    Holds a dense int32 array mapping every index row to a celeb ordinal and one deduplicated table of IMDb IDs.
+    Saved as a directory of two .npy files so both arrays can be memory-mapped instead of unpickled.
+    """
+
+    def __init__(self, row_labels, ids):
+        self.row_labels = row_labels  # (n_rows,) int32, celeb ordinal of every index row
+        self.ids = ids  # (n_celebs,) fixed-width bytes, IMDb ID of every ordinal
+
+    @classmethod
+    def from_row_ids(cls, row_ids):
+        """Build the store from a sequence holding the IMDb ID of every row, in row order."""
+        ordinal_of = {}
+        row_labels = np.fromiter((ordinal_of.setdefault(imdb_id, len(ordinal_of)) for imdb_id in row_ids),
+                                 dtype=np.int32)
+        return cls(row_labels, np.array([imdb_id.encode() for imdb_id in ordinal_of], dtype=np.bytes_))
+
+    @classmethod
+    def from_mapping(cls, index_to_imdb):
+        """Build the store from the legacy {row: imdb_id} dict."""
+        if sorted(index_to_imdb) != list(range(len(index_to_imdb))):
+            raise ValueError("The mapping rows must be exactly 0..n-1.")
+        return cls.from_row_ids(index_to_imdb[row] for row in range(len(index_to_imdb)))
+
+    @classmethod
+    def from_pickle(cls, mapping_path):
+        with open(mapping_path, 'rb') as f:
+            return cls.from_mapping(pickle.load(f))
+
+    @classmethod
+    def load(cls, mapping_path, mmap=True):
+        """Load a saved store. With mmap the arrays are read-only views of the files, paged in on demand."""
+        mmap_mode = 'r' if mmap else None
+        row_labels = np.load(os.path.join(mapping_path, ROW_LABELS_FILE), mmap_mode=mmap_mode)
+        ids = np.load(os.path.join(mapping_path, IDS_FILE), mmap_mode=mmap_mode)
+        return cls(row_labels, ids)
+
+    def save(self, mapping_path):
+        """Save both arrays, each replaced atomically so workers that memory-mapped the old ones are unaffected."""
+        os.makedirs(mapping_path, exist_ok=True)
+        save_array(os.path.join(mapping_path, ROW_LABELS_FILE), np.ascontiguousarray(self.row_labels, dtype=np.int32))
+        save_array(os.path.join(mapping_path, IDS_FILE), np.asarray(self.ids, dtype=np.bytes_))
+
+    @property
+    def n_celebs(self):
+        return len(self.ids)
+
+    def id_of(self, ordinal):
+        return self.ids[ordinal].decode()
+
+    def ids_of(self, ordinals):
+        """IMDb IDs of an array of ordinals, with None for negative (missing) ordinals."""
+        return [self.id_of(ordinal) if ordinal >= 0 else None for ordinal in ordinals]
+
+    def labels_of(self, rows):
+        """Celeb ordinals of an array of index rows, keeping -1 padding as -1."""
+        rows = np.asarray(rows)
+        return np.where(rows >= 0, self.row_labels[rows], -1)
+
+    # Dict-like access so callers of the old index_to_imdb mapping keep working
+    def __len__(self):
+        return len(self.row_labels)
+
+    def __getitem__(self, row):
+        return self.id_of(self.row_labels[row])
+
+    def to_mapping(self):
+        return {row: self.id_of(ordinal) for row, ordinal in enumerate(self.row_labels)}
+
+
+def convert_pickled_mapping(pickle_path, mapping_path):
+    """Convert a pickled index_to_imdb dict (e.g. data/new_idx_map.pkl) into the array-backed format."""
+    label_store = LabelStore.from_pickle(pickle_path)
+    label_store.save(mapping_path)
+    print(f"Converted {len(label_store)} rows of {label_store.n_celebs} celebs from {pickle_path} to {mapping_path}.")
+    return label_store
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python label_store.py <index_to_imdb.pkl> <output directory>")
+        sys.exit(1)
+    convert_pickled_mapping(sys.argv[1], sys.argv[2])
@@ -1,11 +1,15 @@
 import os
+from io import BytesIO
 import numpy as np
 from PIL import Image
 
-from utils import save_main_image_to_s3, save_all_main_images, create_presigned_url, \
-    create_processed_celebs_names_file
+from utils import save_main_image_to_s3, save_all_main_images, create_presigned_urls
+from ingestion import create_processed_celebs_names_file
 from db_manager import DBManager
-from image_processor import ImageProcessor, download_image
+from image_processor import ImageProcessor, compute_face_encodings
+from http_session import http_get
+from result_cache import RecognitionResultCache
+from metrics import timed
 from scrape_manager import process_imdb_list, process_imdb_pages, get_main_photo_url, get_additional_photos, \
     scrape_html, scrape_celebrity_info, rescrape_failed_pages
 
@@ -23,22 +27,61 @@ def load_image_as_np_array(image_path):
     return image_array
 
 
-def handle_image_upload(image_path, image_processor: ImageProcessor, db_manager: DBManager, from_server=True):
-    if from_server:
-        np_img = load_image_as_np_array(image_path)
-    else:
-        np_img = download_image(image_path)
-    # matched_celebs_id = image_processor.find_nearest(np_img, 8)
-    matched_celebs_id = image_processor.recognize_celeb_from_image(np_img, db_manager)
+def load_image_from_bytes(image_bytes):
+    """Decode an encoded image (JPEG, PNG, ...) straight from memory into an RGB NumPy array."""
+    with timed("image_decode"), Image.open(BytesIO(image_bytes)) as image:
+        return np.array(image.convert("RGB"))
+
+
+def handle_image_upload(image_path, image_processor: ImageProcessor, db_manager: DBManager, from_server=True,
+                        gallery=None, result_cache: RecognitionResultCache = None):
+    with timed("image_load"):
+        if from_server:
+            with open(image_path, "rb") as f:
+                image_bytes = f.read()
+        else:
+            image_bytes = http_get(image_path).content
+    np_img = load_image_from_bytes(image_bytes)
+
+    # Identical images reuse the matches of the same gallery version, keyed by their bytes like the server's uploads
+    cache_key = version = matched_celebs_id = None
+    if result_cache is not None:
+        cache_key = result_cache.key_of_bytes(image_bytes)
+        version = gallery.version if gallery is not None else image_processor.index_version
+        cached = result_cache.get(cache_key, version)
+        matched_celebs_id = cached[0] if cached else None
+
+    if matched_celebs_id is None:
+        # matched_celebs_id = image_processor.find_nearest(np_img, 8)
+        matched_celebs_id = image_processor.recognize_celeb_from_image(np_img, db_manager, gallery=gallery)
+        if result_cache is not None:
+            result_cache.set(cache_key, version, matched_celebs_id)
+    return resolve_recognized_celebs(matched_celebs_id, image_processor, db_manager)
+
+
+def encode_image_bytes(image_bytes):
+    """Decode an uploaded image from memory and compute its face encodings. Runs in the server's process pool."""
+    return compute_face_encodings(load_image_from_bytes(image_bytes))
+
+
+def resolve_recognized_celebs(matched_celebs_id, image_processor: ImageProcessor, db_manager: DBManager):
+    """
+    Turn the matched IMDb ID of every face (None for unmatched faces) into the celeb's info list, with a
+    pre-signed URL of its main image in the last field. Returns None when no faces were detected.
+    """
     if len(matched_celebs_id) > 0:
+        # Retrieve the celebrities' info from the database in one query, then sign their image URLs
+        with timed("celeb_info"):
+            celeb_infos = db_manager.get_celeb_infos(celeb_id for celeb_id in matched_celebs_id if celeb_id)
+        with timed("presigned_urls"):
+            presigned_urls = dict(zip(celeb_infos, create_presigned_urls(
+                image_processor.bucket_name, [celeb_info[-1] for celeb_info in celeb_infos.values()])))
+
         recognized_celebs = []
         for i, celeb_id in enumerate(matched_celebs_id, start=1):
             if celeb_id:
-                # Retrieve the celebrity's info from the database
-                celeb_info = db_manager.get_celeb_info(celeb_id)
-                s3_url = celeb_info[-1]
-                info_list = [*celeb_info]
-                info_list[-1] = create_presigned_url(image_processor.bucket_name, s3_url)
+                info_list = [*celeb_infos[celeb_id]]
+                info_list[-1] = presigned_urls[celeb_id]
                 recognized_celebs.append(info_list)
             else:
                 recognized_celebs.append(None)
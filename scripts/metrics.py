@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+
+# Per-stage timing is cheap, but METRICS_ENABLED=0 turns every hook into a shared no-op context
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+METRICS_PREFIX = "fastimdb"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FACE_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20)
+
+
+class Histogram:
+    """Thread-safe histogram with fixed upper bounds, rendered in the Prometheus text format."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last slot counts values above every bound
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def render(self, name, labels=""):
+        separator = "," if labels else ""
+        label_block = f"{{{labels}}}" if labels else ""
+        lines, cumulative = [], 0
+        with self._lock:
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+            lines.append(f"{name}_sum{label_block} {self.sum}")
+            lines.append(f"{name}_count{label_block} {self.count}")
+        return lines
+
+
+_stage_histograms = {}
+_face_histogram = Histogram(FACE_COUNT_BUCKETS)
+_counters = {}
+_registry_lock = threading.Lock()
+# Set by collect_stage_timings so a pool worker returns its timings instead of recording them locally
+_collector = threading.local()
+
+
+def observe_stage(stage, seconds):
+    timings = getattr(_collector, "timings", None)
+    if timings is not None:
+        timings.append((stage, seconds))
+        return
+    histogram = _stage_histograms.get(stage)
+    if histogram is None:
+        with _registry_lock:
+            histogram = _stage_histograms.setdefault(stage, Histogram(LATENCY_BUCKETS))
+    histogram.observe(seconds)
+
+
+def observe_stages(timings):
+    """Record timings returned by collect_stage_timings from another process."""
+    for stage, seconds in timings:
+        observe_stage(stage, seconds)
+
+
+class _StageTimer:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        observe_stage(self.stage, time.perf_counter() - self.start)
+
+
+_DISABLED = nullcontext()
+
+
+def timed(stage):
+    """Context manager that records how long its block took under the given stage name."""
+    return _StageTimer(stage) if METRICS_ENABLED else _DISABLED
+
+
+def collect_stage_timings(fn, *args):
+    """
+    Run fn(*args) and return (result, [(stage, seconds), ...]) of the stages timed inside it.
+    Used as the process pool target so worker-side stages (decode, detection, encoding) reach the server's metrics.
+    """
+    _collector.timings = []
+    try:
+        return fn(*args), _collector.timings
+    finally:
+        _collector.timings = None
+
+
+def observe_faces(n_faces):
+    if METRICS_ENABLED:
+        _face_histogram.observe(n_faces)
+
+
+def increment(name, amount=1):
+    if METRICS_ENABLED:
+        with _registry_lock:
+            _counters[name] = _counters.get(name, 0) + amount
+
+
+def render_metrics(gauges=None, cache_stats=None):
+    """
+    Render every metric in the Prometheus text exposition format.
+    Parameters:
+    - gauges: {name: value} of point-in-time values, e.g. the index size.
+    - cache_stats: {cache name: TTLCache.stats()-like dict} exported as hit/miss/eviction counters and a size gauge.
+    """
+    lines = [f"# HELP {METRICS_PREFIX}_stage_seconds Time spent in each stage of a recognition request.",
+             f"# TYPE {METRICS_PREFIX}_stage_seconds histogram"]
+    for stage, histogram in sorted(_stage_histograms.items()):
+        lines += histogram.render(f"{METRICS_PREFIX}_stage_seconds", f'stage="{stage}"')
+
+    lines += [f"# HELP {METRICS_PREFIX}_faces_per_request Number of faces detected per recognition request.",
+              f"# TYPE {METRICS_PREFIX}_faces_per_request histogram"]
+    lines += _face_histogram.render(f"{METRICS_PREFIX}_faces_per_request")
+
+    for name, value in sorted(_counters.items()):
+        lines += [f"# TYPE {METRICS_PREFIX}_{name}_total counter", f"{METRICS_PREFIX}_{name}_total {value}"]
+
+    for name, value in sorted((gauges or {}).items()):
+        lines += [f"# TYPE {METRICS_PREFIX}_{name} gauge", f"{METRICS_PREFIX}_{name} {value}"]
+
+    if cache_stats:
+        for field in ("hits", "misses", "evictions"):
+            lines.append(f"# TYPE {METRICS_PREFIX}_cache_{field}_total counter")
+            lines += [f'{METRICS_PREFIX}_cache_{field}_total{{cache="{cache}"}} {stats.get(field, 0)}'
+                      for cache, stats in sorted(cache_stats.items())]
+        lines.append(f"# TYPE {METRICS_PREFIX}_cache_size gauge")
+        lines += [f'{METRICS_PREFIX}_cache_size{{cache="{cache}"}} {stats.get("size", 0)}'
+                  for cache, stats in sorted(cache_stats.items())]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,59 @@
+import hashlib
+import threading
+from cache import TTLCache, MISSING
+
+RESULT_CACHE_SIZE = 4096
+
+
+def bytes_hash(image_bytes):
+    """Hash of an upload's encoded bytes: exact resubmissions hit without decoding anything."""
+    return "raw:" + hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+
+class RecognitionResultCache:
+    """
+    LRU cache of the IMDb IDs (and match scores) matched for an image, keyed by its content hash.
+    Uploads are looked up by the hash of their bytes (key_of_bytes), by the server and handle_image_upload alike.
+    Results depend on the gallery, so the cache is emptied whenever it sees a different gallery version.
+    IDs are cached rather than full celeb info, so pre-signed URLs are still refreshed on every hit.
+    """
+
+    def __init__(self, maxsize=RESULT_CACHE_SIZE):
+        self._cache = TTLCache(maxsize=maxsize)
+        self._version = None
+        self._version_lock = threading.Lock()
+        self.invalidations = 0
+
+    def _check_version(self, version):
+        with self._version_lock:
+            if version != self._version:
+                if self._version is not None:
+                    self._cache.clear()
+                    self.invalidations += 1
+                self._version = version
+
+    @staticmethod
+    def key_of_bytes(image_bytes):
+        return bytes_hash(image_bytes)
+
+    def get(self, key, version):
+        """
+        The (matched IDs, scores) cached for key under gallery version, or None.
+        IDs are [] for images without faces; scores are None if they weren't cached.
+        """
+        self._check_version(version)
+        result = self._cache.get(key)
+        return None if result is MISSING else result
+
+    def set(self, key, version, matched_celebs_id, scores=None):
+        # A result computed on a gallery that has been replaced meanwhile is not cached
+        with self._version_lock:
+            if version != self._version:
+                return
+        self._cache.set(key, (list(matched_celebs_id), None if scores is None else list(scores)))
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return {**self._cache.stats(), "invalidations": self.invalidations}
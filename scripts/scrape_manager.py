@@ -1,22 +1,32 @@
+import json
+import os
 import re
+import threading
 import urllib
 from datetime import datetime
-from multiprocessing.pool import ThreadPool
 from typing import Tuple, Optional, List
 from bs4 import BeautifulSoup
-import requests
-from requests import RequestException
+from crawler import Crawler
+from html_extraction import extract_photo_url, extract_media_index_links, IMAGE_ID_PATTERN, PROFILE_STRAINER
+from http_session import ACCEPT_ENCODING
 from db_manager import DBManager
 from image_processor import ImageProcessor
+from ingestion_jobs import JobStore, get_job_store, run_stage, SCRAPED, DONE
 import time
 from numpy import random
 
 MIN_ADDITIONAL_PHOTOS = 10
 MAX_ADDITIONAL_PHOTOS = 20
-IMDB_DOMAIN = "https://www.imdb.com"
+# Point this at a local fixture server (see benchmarks/fixture_server.py) to scrape saved pages
+IMDB_DOMAIN = os.environ.get("IMDB_DOMAIN", "https://www.imdb.com")
+# Celebs of a list page scraped at once; their page fetches share the crawler's per-host limits
+CELEB_CONCURRENCY = int(os.environ.get("CELEB_CONCURRENCY", 8))
 
+_crawler = None
+_crawler_lock = threading.Lock()
 
-def scrape_html(url: str) -> Optional[BeautifulSoup]:
+
+def build_headers():
     user_agents = [
         # Chrome
         "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 "
@@ -44,121 +54,123 @@ def scrape_html(url: str) -> Optional[BeautifulSoup]:
     headers = {
         "User-Agent": random.choice(user_agents),
         "Accept-Language": "en-US,en;q=0.5",
-        "Accept-Encoding": "gzip, deflate, br",
+        "Accept-Encoding": ACCEPT_ENCODING,
         "Connection": "keep-alive",
         "Upgrade-Insecure-Requests": "1",
         "TE": "Trailers",
     }
+    return headers
 
-    try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()  # This will raise an HTTPError if the response was an HTTP error.
-        return BeautifulSoup(response.text, 'html.parser')
-    except RequestException as e:
-        print(f"Unable to get url {url} due to {e}. Skipping...")
-        return None
-
-
-def process_imdb_pages(start_url: str, max_pages: int, db_manager: DBManager, image_processor: ImageProcessor):
-    current_page_url = start_url
-    pages_processed = 0
 
-    with open('processed_pages.txt', 'a') as f:  # Open the file for appending
-        while current_page_url and pages_processed < max_pages:
-            soup = scrape_html(current_page_url)  # Get the current page's HTML
-            if soup is None:
-                continue
+def get_crawler() -> Crawler:
+    """Return the process-wide crawler, so every page fetch shares one session, worker pool and rate limit."""
+    global _crawler
+    with _crawler_lock:
+        if _crawler is None:
+            _crawler = Crawler(headers_factory=build_headers)
+        return _crawler
 
-            # Calculate the range of actors for the current page
-            start_range = pages_processed * 50 + 1
-            end_range = start_range + 49
 
-            # Log the range and URL to the file
-            f.write(f"{pages_processed + 1}. {start_range}-{end_range}: {current_page_url}\n")
+def scrape_html(url: str, parse_only=None) -> Optional[BeautifulSoup]:
+    # Retries, backoff and rate limiting happen in the crawler; None means the page couldn't be fetched
+    return get_crawler().fetch_soup(url, parse_only)
 
-            process_imdb_list(soup, db_manager, image_processor)  # Process the current page
 
-            next_page_button = soup.find('a', {'class': 'next-page'})
-            if next_page_button:
-                next_page_relative_url = next_page_button['href']
-                current_page_url = urllib.parse.urljoin(start_url, next_page_relative_url)
-            else:
-                current_page_url = None  # No more pages
+def process_imdb_pages(start_url: str, max_pages: int, db_manager: DBManager, image_processor: ImageProcessor,
+                       jobs: JobStore = None):
+    jobs = jobs or get_job_store()
+    # The next list page and the number of pages done are checkpointed, so a re-run resumes after the last page
+    checkpoint = f"list_pages:{start_url}"
+    saved = jobs.get_checkpoint(checkpoint)
+    if saved:
+        saved = json.loads(saved)
+        current_page_url, pages_processed = saved["next_page_url"], saved["pages_processed"]
+        print(f"Resuming after {pages_processed} list pages at {current_page_url}.")
+    else:
+        current_page_url, pages_processed = start_url, 0
+
+    while current_page_url and pages_processed < max_pages:
+        soup = scrape_html(current_page_url)  # Get the current page's HTML
+        if soup is None:
+            # The crawler already retried, so asking again would loop forever
+            print(f"Stopping: could not fetch list page {current_page_url}.")
+            break
+
+        # Calculate the range of actors for the current page
+        start_range = pages_processed * 50 + 1
+        end_range = start_range + 49
+        print(f"{pages_processed + 1}. {start_range}-{end_range}: {current_page_url}")
+
+        process_imdb_list(soup, db_manager, image_processor, jobs)  # Process the current page
+
+        next_page_button = soup.find('a', {'class': 'next-page'})
+        if next_page_button:
+            next_page_relative_url = next_page_button['href']
+            current_page_url = urllib.parse.urljoin(start_url, next_page_relative_url)
+        else:
+            current_page_url = None  # No more pages
 
-            pages_processed += 1  # Increase the number of processed pages
+        pages_processed += 1  # Increase the number of processed pages
+        jobs.set_checkpoint(checkpoint, json.dumps({"next_page_url": current_page_url,
+                                                    "pages_processed": pages_processed}))
 
 
-def process_imdb_list(soup: BeautifulSoup, db_manager: DBManager, image_processor: ImageProcessor):
+def process_imdb_list(soup: BeautifulSoup, db_manager: DBManager, image_processor: ImageProcessor,
+                      jobs: JobStore = None):
     celebs_list = soup.findAll('h3', {'class': 'lister-item-header'})
-    # i = 1
-    for celeb in celebs_list:
-        start1 = time.time()
 
-        process_celeb(celeb, db_manager, image_processor)
-        # if i==1:
-        #     images_list = api_get_celeb_additional_images('nm0000607')
-        #     db_manager.insert_additional_images_urls('nm0000607', images_list)
-        #     i += 1
-        end1 = time.time()
-        print(f'single celeb scrapping took: {end1 - start1}')
-
-
-def process_celeb(celeb, db_manager, image_processor=None, url_to_rescrape=None):
-    try:
-        if url_to_rescrape:
-            url_to_page = url_to_rescrape
+    # Register the celebs of the page with the job table
+    imdb_ids = []
+    for celeb in celebs_list:
+        link_tag = celeb.find('a')  # Find the 'a' tag
+        match = re.search(r"nm\d{7}", link_tag['href']) if link_tag and link_tag.has_attr('href') else None
+        if match:
+            imdb_ids.append(match.group())
         else:
-            link_tag = celeb.find('a')  # Find the 'a' tag
-            url_to_page = IMDB_DOMAIN + link_tag['href']  # Get the 'href' attribute
-    except Exception as e:
-        with open('failed_celebs.txt', 'a') as f:
-            f.write(f"Failed to find 'a' tag or 'href' attribute for celeb {celeb}. Error: {str(e)}\n")
-        return
-
-    try:
-        celeb_page_soup = scrape_html(url_to_page)
-        if celeb_page_soup is None:
-            raise ValueError("Returned soup is None")
-    except Exception as e:
-        with open('failed_celebs.txt', 'a') as f:
-            f.write(f"Failed to scrape {url_to_page}. Error: {str(e)}\n")
-        return
+            print(f"Failed to find 'a' tag or 'href' attribute for celeb {celeb}.")
+    jobs = jobs or get_job_store()
+    jobs.add_celebs(imdb_ids)
 
-    # Attempt to scrape info
-    try:
-        celeb_info = scrape_celebrity_info(celeb_page_soup, url_to_page)
-        db_manager.insert_celeb(*celeb_info)
-        celeb_id, celeb_name = celeb_info[0], celeb_info[1]
-    except Exception as e:
-        with open('failed_celebs.txt', 'a') as f:
-            f.write(f"Failed to scrape or insert celeb info for {url_to_page}. Error: {str(e)}\n")
-        return
+    # Scrape the celebs of the page concurrently; the crawler bounds the load on IMDb. Celebs already scraped by an
+    # earlier run are skipped, and failures are left to be retried with backoff (see rescrape_failed_pages).
+    start = time.time()
+    results = run_stage(jobs, SCRAPED, lambda imdb_id: scrape_celeb(imdb_id, db_manager), CELEB_CONCURRENCY, imdb_ids,
+                        wait_for_retries=False)
+    print(f'{len(imdb_ids)} celebs in {time.time() - start:.1f}s: {results}, crawler stats: {get_crawler().stats()}')
 
-    # Attempt to get the main photo
-    try:
-        main_photo_url = get_main_photo_url(celeb_page_soup)
-        if not main_photo_url:
-            print(f"No main image found for {celeb_id}, no need to scrape further.")
-        else:
-            db_manager.update_celeb_main_image_url(celeb_id, main_photo_url)
-    except Exception as e:
-        with open('failed_celebs.txt', 'a') as f:
-            f.write(f"Failed to get main image for {celeb_id}. Error: {str(e)}\n")
-        return  # If the main photo fails, we will not want to proceed further
 
-    # Attempt to get the additional photos
-    try:
-        additional_photos_urls = get_additional_photos(celeb_page_soup, celeb_id)
-        if len(additional_photos_urls) >= MIN_ADDITIONAL_PHOTOS:
-            # db_manager.update_additional_images_urls(celeb_id, additional_photos_urls)
-            db_manager.insert_additional_images_urls(celeb_id, additional_photos_urls)
-            # image_processor.process_celebrity_images(celeb_id, main_photo_url, additional_photos_urls, db_manager)
+def scrape_celeb(imdb_id: str, db_manager: DBManager):
+    """
+    Scrape one celeb's info, main photo and additional photos into the DB: the scraped stage of ingestion.
+    Raises on failure, so the job is retried.
+    """
+    start = time.time()
+    url_to_page = f"{IMDB_DOMAIN}/name/{imdb_id}/"
+    # Only the name, birth/death and main photo elements are parsed
+    celeb_page_soup = scrape_html(url_to_page, PROFILE_STRAINER)
+    if celeb_page_soup is None:
+        raise ValueError(f"Failed to scrape {url_to_page}")
+
+    # Scrape info
+    celeb_info = scrape_celebrity_info(celeb_page_soup, url_to_page)
+    db_manager.insert_celeb(*celeb_info)
+    celeb_id = celeb_info[0]
+
+    # Get the main photo
+    main_photo_url = get_main_photo_url(celeb_page_soup)
+    if not main_photo_url:
+        print(f"No main image found for {celeb_id}, no need to scrape further.")
+    else:
+        db_manager.update_celeb_main_image_url(celeb_id, main_photo_url)
 
-    except Exception as e:
-        with open('failed_celebs.txt', 'a') as f:
-            f.write(f"Failed to process additional images for {celeb_id} or not enough photos. Error: {str(e)}\n")
+    # Get the additional photos, replacing any inserted by an interrupted earlier attempt
+    additional_photos_urls = get_additional_photos(celeb_page_soup, celeb_id)
+    if len(additional_photos_urls) >= MIN_ADDITIONAL_PHOTOS:
+        db_manager.delete_additional_images_urls(celeb_id)
+        db_manager.insert_additional_images_urls(celeb_id, additional_photos_urls)
 
     print_celeb_info(celeb_info)
+    print(f'single celeb scrapping took: {time.time() - start}')
 
 
 def scrape_celebrity_info(soup: BeautifulSoup, url: str) -> Tuple[
@@ -204,71 +216,65 @@ def get_main_photo2(soup: BeautifulSoup, celeb_name: str) -> Optional[str]:
         return None
 
 
-def get_main_photo_url(soup: BeautifulSoup) -> Optional[str]:
-    # Find the image tag of the actor's main image
+def get_main_photo_page_url(soup: BeautifulSoup) -> Optional[str]:
+    # Find the link to the page of the actor's main image
     img_section = soup.find('section', {'class': 'ipc-page-section'})
     a_tag = img_section.find('a', {'class': 'ipc-lockup-overlay ipc-focusable'}) if img_section else None
-    url_to_img_page = IMDB_DOMAIN + a_tag['href'] if a_tag else None  # Get the 'href' attribute
+    return IMDB_DOMAIN + a_tag['href'] if a_tag else None  # Get the 'href' attribute
 
-    return get_image_from_page(url_to_img_page)
+
+def get_main_photo_url(soup: BeautifulSoup) -> Optional[str]:
+    main_photo_page_url = get_main_photo_page_url(soup)
+    if main_photo_page_url is None:
+        return None
+    return get_image_from_page(main_photo_page_url)
 
 
 def get_additional_photos(soup: BeautifulSoup, celeb_id: str) -> List[str]:
 
     additional_photos_page_url = IMDB_DOMAIN + f"/name/{celeb_id}/mediaindex/?ref_=nm_mv_sm"
 
-    additional_soup = scrape_html(additional_photos_page_url)
-    if additional_soup is None:
+    additional_html = get_crawler().fetch_text(additional_photos_page_url)
+    if additional_html is None:
         return []
     else:
-        div = additional_soup.find('div', {'class': 'media_index_thumb_list'})
-        if div is not None:
-            images_links = div.findAll('a')
-        else:
+        images_links = extract_media_index_links(additional_html)
+        if images_links is None:
             print(f'Could not find additional images page for {celeb_id}')
             return []
 
-    # Extract URLs from the tags
-    large_image_page_urls = [IMDB_DOMAIN + link['href'] for link in images_links]
+    # Extract URLs from the links
+    large_image_page_urls = [IMDB_DOMAIN + link for link in images_links]
 
     # # Extract photos URLs from each page
     # large_image_urls = [get_image_from_page(url) for url in large_image_page_urls]
 
-    # Concurrently extract photo URLs from each page using ThreadPool
-    with ThreadPool() as pool:
-        large_image_urls = pool.map(get_image_from_page, large_image_page_urls)
+    # Concurrently extract photo URLs from each page on the crawler's shared worker pool
+    large_image_urls = get_crawler().map(get_image_from_page, large_image_page_urls)
 
     return large_image_urls
 
 
-def get_image_from_page(url: str) -> Optional[str]:
+def get_image_from_page(url: Optional[str]) -> Optional[str]:
+    if url is None:
+        return None
     try:
         # Scrape the page of the individual photo
-        soup = scrape_html(url)
-
-        # Find the tag containing the URL of the full-size image
-        # image_tag = soup.find('img', {'data-imag-id': 'rm3133285889-curr'})
-        image_tag = soup.find(matches_format)
+        html = get_crawler().fetch_text(url)
 
-        # Extract the URL from the tag
-        image_url = image_tag['src'] if image_tag else None
-
-        return image_url
+        # Extract the URL of the full-size image from the tag whose data-image-id matches IMAGE_ID_PATTERN
+        return extract_photo_url(html) if html is not None else None
     except Exception as e:
         print(f"Error getting image from page {url}: {e}")
         return None
 
 
 def matches_format(tag):
-    # The regular expression we'll use to match the data-image-id format
-    # image_id_pattern = re.compile(r"rm\d{10}-curr")
-    image_id_pattern = re.compile(r"rm\d+-curr")
-
     # Try to get the data-image-id attribute
     data_image_id = tag.get('data-image-id')
 
     # If the data-image-id attribute exists and matches our pattern, return True
-    if data_image_id and image_id_pattern.match(data_image_id):
+    if data_image_id and IMAGE_ID_PATTERN.match(data_image_id):
         return True
 
     # Otherwise, return False
@@ -294,8 +300,8 @@ def get_date_and_age(soup: BeautifulSoup, div_id: str, died=False) -> Tuple[Opti
         span = div.findAll('span')
         if span and len(span) > 1:
             if died:
-                info_list = span[1].text.rsplit('(', 1)  # should return: ["Month Day, Year", "Age)"]
-                date_str = info_list[0]
+                info_list = span[1].text.rsplit('(', 1)  # should return: ["Month Day, Year ", "Age)"]
+                date_str = info_list[0].strip()
                 age = int(info_list[1][:-1]) if len(info_list) > 1 else None
             else:
                 date_str = span[1].string.strip() if span[1] else None
@@ -331,47 +337,13 @@ def print_celeb_info(celeb_info):
     print("url:", url)
 
 
-def rescrape_failed_pages(db_manager):
-    filename = 'failed_celebs.txt'
-
-    # Step 1: Copy original file contents to a temporary file
-    with open(filename, 'r') as original_file:
-        original_file_lines = original_file.readlines()
-        original_file_len = len(original_file_lines)
-        failed_urls_list = [line.split(" ")[3][:-1] for line in original_file_lines if "Failed to scrape" in line]
-        num_pages_to_scrape = len(failed_urls_list)
-
-    with open(filename, 'a+') as original_file:
-        print("Re-scraping...")
-
-        original_file.write("##### Re-scraping section #####")
-
-        for url in failed_urls_list:
-            process_celeb(None, db_manager, url_to_rescrape=url)
-
-        original_file.seek(0)  # Move position back to the beginning
-        new_failed_urls_list = [line.split(" ")[3][:-1] for line in original_file.readlines() if "Failed to scrape" in line]
-        new_failed_urls_list_len = len(new_failed_urls_list)
-        num_rescraped_pages = new_failed_urls_list_len - num_pages_to_scrape
-        print(f"Successfully re-scraped {new_failed_urls_list_len - num_rescraped_pages}.")
-
-
-def rescrape_failed_pages1(db_manager):
-    # Keep track of lines to retain (those we couldn't scrape successfully)
-    lines_to_retain = []
-    filename = 'failed_celebs.txt'
-    with open(filename, 'r') as file:
-        lines = file.readlines()
-
-        for line in lines:
-            if "Failed to scrape" in line:
-                # Extract the URL from the line
-                celeb_url = line.split(" ")[3][:-1]
-                # print(url)
-                # soup = scrape_html(celeb_url)
-                process_celeb(None, db_manager, celeb_url)
-
-    # Rewrite the file with only the lines to retain
-    # with open(filename, 'w') as file:
-    #     file.writelines(lines_to_retain)
+def rescrape_failed_pages(db_manager, jobs: JobStore = None):
+    """Give the celebs whose scrape failed (or ran out of attempts) a fresh set of retries, and scrape them."""
+    jobs = jobs or get_job_store()
+    failed_ids = [imdb_id for imdb_id, *_ in jobs.errors(SCRAPED)]
+    jobs.retry_failed(SCRAPED)
 
+    print(f"Re-scraping {len(failed_ids)} celebs...")
+    results = run_stage(jobs, SCRAPED, lambda imdb_id: scrape_celeb(imdb_id, db_manager), CELEB_CONCURRENCY,
+                        failed_ids)
+    print(f"Successfully re-scraped {results.get(DONE, 0)}/{len(failed_ids)}.")
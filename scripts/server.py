@@ -1,10 +1,42 @@
+import asyncio
 import base64
-from fastapi import FastAPI, HTTPException, UploadFile, File
+import hmac
+import json
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+from fastapi import FastAPI, HTTPException, UploadFile, File, BackgroundTasks, Header
 import os
-from starlette.responses import FileResponse
+import time
+from starlette.responses import FileResponse, PlainTextResponse, JSONResponse
 from db_manager import DBManager
 from image_processor import ImageProcessor
-from main import handle_image_upload
+from label_store import replace_atomically
+from main import encode_image_bytes, resolve_recognized_celebs
+from result_cache import RecognitionResultCache
+from metrics import timed, collect_stage_timings, observe_stages, observe_faces, increment, render_metrics
+from utils import get_memory_usage, presigned_url_cache
+
+# Face encoding is CPU-bound, so it runs in a process pool; DB, S3 and file I/O run in a thread pool
+ENCODING_WORKERS = int(os.environ.get("ENCODING_WORKERS", os.cpu_count() or 1))
+IO_WORKERS = int(os.environ.get("IO_WORKERS", 16))
+# Requests beyond MAX_CONCURRENT_RECOGNITIONS wait for a slot; beyond MAX_QUEUED_RECOGNITIONS more they get a 503
+MAX_CONCURRENT_RECOGNITIONS = int(os.environ.get("MAX_CONCURRENT_RECOGNITIONS", ENCODING_WORKERS))
+MAX_QUEUED_RECOGNITIONS = int(os.environ.get("MAX_QUEUED_RECOGNITIONS", 4 * ENCODING_WORKERS))
+RETRY_AFTER_SECONDS = 2
+# Uploads are decoded in memory, so larger images are rejected with a 413
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+# Request bodies are cut off past this size while they are received: an image of MAX_UPLOAD_BYTES as base64,
+# plus room for the JSON or multipart framing around it
+MAX_REQUEST_BYTES = int(os.environ.get("MAX_REQUEST_BYTES", MAX_UPLOAD_BYTES * 4 // 3 + 64 * 1024))
+# Matches of recently seen images, keyed by the hash of their bytes; 0 disables the cache
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 4096))
+# "vote" or "weighted" (see gallery.score_nearest_labels). With MATCH_THRESHOLD set, faces scored above it are
+# returned as unknown (None) instead of being matched to the closest celeb.
+SCORING_MODE = os.environ.get("SCORING_MODE", "vote")
+MATCH_THRESHOLD = float(os.environ["MATCH_THRESHOLD"]) if os.environ.get("MATCH_THRESHOLD") else None
 
 db_pass = os.environ.get("DB_PASSWORD")
 db_user = os.environ.get("DB_USER")
@@ -15,11 +47,162 @@ db_manager = DBManager(
     password=db_pass,
     database="celebs_database",
     table='Celebs2')
+# Load the whole celebs table up front so the recognition path doesn't need DB round trips
+if os.environ.get("CELEB_CACHE_WARMUP", "1") == "1":
+    db_manager.warm_celeb_info_cache()
+
+DATA_DIR = os.path.realpath("../data")
+INDEX_PATH = "../data/new_annoy.ann"
+# Prefer the array-backed label store (see label_store.py) over the legacy pickled mapping
+MAPPING_PATH = '../data/new_idx_labels' if os.path.isdir('../data/new_idx_labels') else '../data/new_idx_map.pkl'
+# Admin endpoints are refused unless a token is configured
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+# Index version every worker should serve, written by /admin/reloadIndex/ and polled by every uvicorn worker
+INDEX_POINTER_PATH = os.environ.get("INDEX_POINTER_PATH", os.path.join(DATA_DIR, "current_index.json"))
+INDEX_POLL_SECONDS = float(os.environ.get("INDEX_POLL_SECONDS", 5))
+
+
+def optional_int_env(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+# Unset values come from the index metadata written by autotune.py (or the defaults in gallery.py)
+image_processor = ImageProcessor(bucket_name='celebs-images-bucket-2', trees=optional_int_env("INDEX_TREES"),
+                                 k=optional_int_env("NEAREST_NEIGHBOURS"), search_k=optional_int_env("SEARCH_K"),
+                                 scoring=SCORING_MODE, match_threshold=MATCH_THRESHOLD)
+INDEX_MMAP = os.environ.get("INDEX_MMAP", "1") == "1"
+
+
+def read_index_pointer():
+    """The index version requested through /admin/reloadIndex/, or None if there is none (or it is unreadable)."""
+    try:
+        with open(INDEX_POINTER_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_index_pointer(index_path, mapping_path, version):
+    # requested_at makes every request a new pointer, so files replaced under the same paths are reloaded too
+    pointer = {"index_path": index_path, "mapping_path": mapping_path, "version": version,
+               "requested_at": time.time()}
+
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            json.dump(pointer, f)
+    replace_atomically(INDEX_POINTER_PATH, write)
+    return pointer
+
+
+# Every uvicorn worker imports this module; memory-mapped loading lets them share the index pages.
+# Workers (re)started after a reload serve the requested version rather than the default paths.
+load_start = time.perf_counter()
+applied_index_pointer = read_index_pointer()
+if applied_index_pointer:
+    image_processor.load_annoy_index_and_mapping(128, applied_index_pointer["index_path"],
+                                                 applied_index_pointer["mapping_path"], mmap=INDEX_MMAP,
+                                                 version=applied_index_pointer["version"])
+else:
+    image_processor.load_annoy_index_and_mapping(128, INDEX_PATH, MAPPING_PATH, mmap=INDEX_MMAP)
+memory = get_memory_usage()
+print(f"[worker {os.getpid()}] Index loaded in {time.perf_counter() - load_start:.2f}s, "
+      + ", ".join(f"{key}={value:.1f}MB" for key, value in memory.items()))
+
+result_cache = RecognitionResultCache(RESULT_CACHE_SIZE) if RESULT_CACHE_SIZE else None
+
+class BodySizeLimitMiddleware:
+    """
+    ASGI middleware answering 413 to request bodies over max_bytes: up front from Content-Length, otherwise as
+    soon as the bytes received exceed it. FastAPI parses JSON and multipart bodies (spooling uploaded files)
+    before an endpoint runs, so an endpoint can't enforce the limit itself.
+    """
+
+    def __init__(self, app, max_bytes):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    def too_large(self):
+        return JSONResponse(status_code=413, content={"detail": f"Request body is larger than {self.max_bytes} bytes"})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            return await self.too_large()(scope, receive, send)
+
+        received = 0
+        response_started = rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Answer right away and make the app stop reading, as if the client had gone away
+                    rejected = True
+                    if not response_started:
+                        await self.too_large()(scope, receive, send)
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            if rejected:
+                return
+            response_started = response_started or message["type"] == "http.response.start"
+            await send(message)
+
+        await self.app(scope, limited_receive, guarded_send)
 
-image_processor = ImageProcessor(bucket_name='celebs-images-bucket-2')
-image_processor.load_annoy_index_and_mapping(128, "../data/new_annoy.ann", '../data/new_idx_map.pkl')
 
 app = FastAPI()
+app.add_middleware(BodySizeLimitMiddleware, max_bytes=MAX_REQUEST_BYTES)
+# Held while a new index version loads, so concurrent reload requests don't race each other
+reload_lock = threading.Lock()
+
+# Created at startup, inside the event loop and after the index is loaded
+encoding_pool = None
+io_pool = None
+recognition_slots = None
+recognitions_in_flight = 0
+index_poll_stop = threading.Event()
+
+
+def create_encoding_pool():
+    # Spawned workers only import main/image_processor, not this module, so they don't load the index again
+    return ProcessPoolExecutor(max_workers=ENCODING_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+def replace_broken_encoding_pool(broken_pool):
+    """Replace the encoding pool after one of its workers died (e.g. dlib crashed), unless that's already done."""
+    global encoding_pool
+    # Runs on the event loop, so requests that saw the same broken pool can't replace it twice
+    if encoding_pool is broken_pool:
+        print(f"[worker {os.getpid()}] An encoding worker died, restarting the encoding pool.")
+        increment("encoding_pool_restarts")
+        encoding_pool = create_encoding_pool()
+        broken_pool.shutdown(wait=False, cancel_futures=True)
+
+
+@app.on_event("startup")
+def start_worker_pools():
+    global encoding_pool, io_pool, recognition_slots
+    encoding_pool = create_encoding_pool()
+    io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+    recognition_slots = asyncio.Semaphore(MAX_CONCURRENT_RECOGNITIONS)
+    threading.Thread(target=poll_index_pointer, name="index-poll", daemon=True).start()
+
+
+@app.on_event("shutdown")
+def stop_worker_pools():
+    index_poll_stop.set()
+    encoding_pool.shutdown(cancel_futures=True)
+    io_pool.shutdown(cancel_futures=True)
 
 
 @app.get("/")
@@ -37,43 +220,275 @@ async def serve_script():
     return FileResponse('../static/style.css')
 
 
-@app.get("uploads")
-async def serve_script():
-    return FileResponse('uploads')
+def match_and_resolve(encodings, cache_key=None):
+    """
+    Gallery lookup plus celeb info and pre-signed URLs for a request's encodings. Runs in the I/O pool.
+    The matches are cached under the upload's cache_key, if given.
+    """
+    # Pin the gallery so the whole request uses one index version, even if a reload swaps it meanwhile
+    with image_processor.use_gallery() as gallery:
+        matched_celebs_id, scores = image_processor.match_encodings_with_scores(encodings, gallery=gallery)
+    if cache_key is not None:
+        result_cache.set(cache_key, gallery.version, matched_celebs_id, scores)
+    return resolve_recognized_celebs(matched_celebs_id, image_processor, db_manager), scores, gallery.version
+
+
+def lookup_cached_result(image_bytes):
+    """
+    Hash the upload's bytes, without decoding them, and resolve its cached matches, if any.
+    Returns (cache_key, (info, scores, version) or None).
+    """
+    cache_key = result_cache.key_of_bytes(image_bytes)
+    version = image_processor.index_version
+    cached = result_cache.get(cache_key, version)
+    if cached is None:
+        return cache_key, None
+    matched_celebs_id, scores = cached
+    return cache_key, (resolve_recognized_celebs(matched_celebs_id, image_processor, db_manager), scores, version)
 
 
-def process_uploaded_image(image_path, image_processor, db_manager):
+async def process_uploaded_image(image_bytes, filename):
+    """
+    Recognize the celebs in an uploaded image without blocking the event loop. At most
+    MAX_CONCURRENT_RECOGNITIONS requests are processed at once and MAX_QUEUED_RECOGNITIONS more may wait;
+    further requests are rejected with 503 and a Retry-After header.
+    """
+    global recognitions_in_flight
+    increment("recognition_requests")
+    if recognitions_in_flight >= MAX_CONCURRENT_RECOGNITIONS + MAX_QUEUED_RECOGNITIONS:
+        increment("rejected_requests")
+        raise HTTPException(status_code=503, detail="Server is busy, please retry shortly",
+                            headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+
+    recognitions_in_flight += 1
     try:
-        matched_celeb_info = handle_image_upload(image_path, image_processor, db_manager, from_server=True)
-        filename = os.path.basename(image_path)
-        os.remove(image_path)
-        return {"filename": filename, "celebrity_info": matched_celeb_info}
+        with timed("request"):
+            return await recognize_uploaded_image(image_bytes, filename)
+    except HTTPException:
+        increment("failed_requests")
+        raise
     except Exception as e:
+        increment("failed_requests")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        recognitions_in_flight -= 1
+
+
+async def recognize_uploaded_image(image_bytes, filename):
+    # Resubmitted frames skip face detection and encoding
+    with timed("result_cache_lookup"):
+        cache_key, cached = await run_io(lookup_cached_result, image_bytes) if result_cache else (None, None)
+    if cached:
+        matched_celeb_info, scores, index_version = cached
+        observe_faces(len(matched_celeb_info or []))
+        return {"filename": filename, "celebrity_info": matched_celeb_info, "scores": scores,
+                "index_version": index_version}
+
+    with timed("queue_wait"):
+        await recognition_slots.acquire()
+    try:
+        with timed("encoding_worker"):
+            encodings, worker_timings = await encode_in_pool(image_bytes)
+        observe_stages(worker_timings)
+        observe_faces(len(encodings))
+        matched_celeb_info, scores, index_version = await run_io(match_and_resolve, encodings, cache_key)
+    finally:
+        recognition_slots.release()
+    # scores[i] is the match distance of face i (lower is closer), None for faces without any neighbour
+    return {"filename": filename, "celebrity_info": matched_celeb_info, "scores": scores,
+            "index_version": index_version}
+
+
+async def encode_in_pool(image_bytes):
+    """
+    Face encodings of an upload, computed in the encoding pool. The encoded image bytes are sent to the worker,
+    which is much cheaper than a decoded array, and stages timed inside the worker come back with the encodings.
+    If a worker dies the pool is broken for every request, so it is replaced and the image retried once; a
+    second failure (e.g. an image that crashes dlib every time) is answered with a 503.
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = encoding_pool
+        try:
+            return await loop.run_in_executor(pool, collect_stage_timings, encode_image_bytes, image_bytes)
+        except BrokenProcessPool:
+            replace_broken_encoding_pool(pool)
+    raise HTTPException(status_code=503, detail="Face encoding failed, please retry shortly",
+                        headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+
+
+async def run_io(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(io_pool, fn, *args)
+
+
+def upload_too_large():
+    return HTTPException(status_code=413, detail=f"Image is larger than {MAX_UPLOAD_BYTES} bytes")
+
+
+def check_admin_token(x_admin_token):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled, ADMIN_TOKEN is not set")
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+def data_file_path(path):
+    """Resolve a path given to an admin endpoint, refusing anything outside DATA_DIR or that doesn't exist."""
+    real_path = os.path.realpath(path)
+    if os.path.commonpath([real_path, DATA_DIR]) != DATA_DIR:
+        raise HTTPException(status_code=400, detail=f"{path} is outside the data directory")
+    if not os.path.exists(real_path):
+        raise HTTPException(status_code=400, detail=f"{path} does not exist")
+    return real_path
+
+
+def served_index_paths():
+    """(index_path, mapping_path) of the index version the workers are pointed at."""
+    pointer = read_index_pointer() or applied_index_pointer
+    return (pointer["index_path"], pointer["mapping_path"]) if pointer else (INDEX_PATH, MAPPING_PATH)
+
+
+def reload_index(pointer):
+    global applied_index_pointer
+    try:
+        image_processor.load_annoy_index_and_mapping(128, pointer["index_path"], pointer["mapping_path"],
+                                                     mmap=INDEX_MMAP, version=pointer["version"])
+    except Exception as e:
+        print(f"[worker {os.getpid()}] Failed to reload index from {pointer['index_path']}: {e}")
+    finally:
+        # A broken version isn't retried on every poll; the next request replaces it
+        applied_index_pointer = pointer
+        reload_lock.release()
+
+
+def check_index_pointer():
+    """Reload the index if the shared pointer names another version than this worker serves."""
+    pointer = read_index_pointer()
+    if pointer and pointer != applied_index_pointer and reload_lock.acquire(blocking=False):
+        reload_index(pointer)
+
+
+def poll_index_pointer():
+    # Each uvicorn worker only sees the admin requests it receives itself, so all of them follow the pointer file
+    while not index_poll_stop.wait(INDEX_POLL_SECONDS):
+        check_index_pointer()
+
+
+@app.post("/admin/reloadIndex/")
+def request_index_reload(background_tasks: BackgroundTasks, request: Optional[dict] = None,
+                         x_admin_token: Optional[str] = Header(None)):
+    """
+    Point every worker at a new index version: this one loads it in the background right away, the others
+    within INDEX_POLL_SECONDS. Each swaps it in once ready, and in-flight requests finish on the version they
+    started with. Paths must be inside DATA_DIR.
+    Body (optional): {"index_path": ..., "mapping_path": ..., "version": ...}.
+    """
+    check_admin_token(x_admin_token)
+    if reload_lock.locked():
+        raise HTTPException(status_code=409, detail="An index reload is already in progress")
+
+    request = request or {}
+    pointer = write_index_pointer(data_file_path(request.get("index_path", INDEX_PATH)),
+                                  data_file_path(request.get("mapping_path", MAPPING_PATH)), request.get("version"))
+    background_tasks.add_task(check_index_pointer)
+    return {"status": "reloading", "index_version": image_processor.index_version,
+            "requested_version": pointer["version"]}
+
+
+def compact_served_index(index_path, mapping_path):
+    """Fold the saved delta into the served index files, then point every worker at the result."""
+    try:
+        if image_processor.compact_saved_gallery(128, index_path, mapping_path):
+            write_index_pointer(index_path, mapping_path, None)
+            check_index_pointer()
+    except Exception as e:
+        print(f"[worker {os.getpid()}] Failed to compact {index_path}: {e}")
+
+
+@app.post("/admin/addCeleb/{imdb_id}")
+def add_celeb_to_gallery(background_tasks: BackgroundTasks, imdb_id: str,
+                         x_admin_token: Optional[str] = Header(None)):
+    """
+    Publish a newly processed celeb's encodings from the DB without rebuilding the index. They are appended to
+    the delta saved next to the served index, which every worker loads within INDEX_POLL_SECONDS (this one right
+    away). Once the saved delta holds delta_compaction_threshold encodings it is compacted in the background.
+    Celebs already in the served index or its delta are refused with a 409.
+    """
+    check_admin_token(x_admin_token)
+
+    encodings = db_manager.get_additional_image_encodings(imdb_id)
+    main_encoding = db_manager.get_main_image_encodings(imdb_id)
+    if main_encoding is not None:
+        encodings.insert(0, main_encoding)
+    if not encodings:
+        raise HTTPException(status_code=404, detail=f"No encodings found for {imdb_id}")
+
+    index_path, mapping_path = served_index_paths()
+    delta_size = image_processor.add_encodings_to_saved_gallery(index_path, mapping_path, imdb_id, encodings)
+    if delta_size is None:
+        raise HTTPException(status_code=409, detail=f"{imdb_id} is already in the gallery")
+    write_index_pointer(index_path, mapping_path, None)
+    background_tasks.add_task(check_index_pointer)
+    if delta_size >= image_processor.delta_compaction_threshold:
+        background_tasks.add_task(compact_served_index, index_path, mapping_path)
+    return {"imdb_id": imdb_id, "encodings_added": len(encodings), "saved_delta_size": delta_size,
+            "index_version": image_processor.index_version}
+
+
+@app.get("/stats")
+def get_stats():
+    return {"index_version": image_processor.index_version,
+            "celeb_info_cache": db_manager.celeb_info_cache.stats(),
+            "result_cache": result_cache.stats() if result_cache else None,
+            "recognitions_in_flight": recognitions_in_flight}
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Stage latency histograms, faces per request, request counters, index size and cache hits, for Prometheus."""
+    gauges = {"recognitions_in_flight": recognitions_in_flight}
+    if image_processor.index_to_imdb is not None:
+        with image_processor.use_gallery() as gallery:
+            gauges.update(index_size=len(gallery), index_delta_size=len(gallery.delta))
+    cache_stats = {"celeb_info": db_manager.celeb_info_cache.stats(), "presigned_url": presigned_url_cache.stats()}
+    if result_cache:
+        cache_stats["recognition_result"] = result_cache.stats()
+    return PlainTextResponse(render_metrics(gauges, cache_stats), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/admin/indexVersion/")
+def get_index_version():
+    with image_processor.use_gallery() as gallery:
+        metadata = gallery.metadata
+    return {"index_version": image_processor.index_version,
+            "index_metadata": metadata,
+            "requested_index": read_index_pointer(),
+            "reloading": reload_lock.locked()}
 
 
 @app.post("/uploadImage/")
 async def upload_image(image_data: dict):
     image_base64 = image_data.get('image')
-    os.makedirs('uploads', exist_ok=True)
-    image_data = base64.b64decode(image_base64)
-    filename = "captured_image.jpg"
-    image_path = os.path.join("uploads", filename)
-    with open(image_path, "wb") as fh:
-        fh.write(image_data)
-    return process_uploaded_image(image_path, image_processor, db_manager)
+    # Every 4 base64 characters decode to 3 bytes
+    if len(image_base64) * 3 // 4 > MAX_UPLOAD_BYTES:
+        raise upload_too_large()
+    with timed("upload_read"):
+        image_data = base64.b64decode(image_base64)
+    return await process_uploaded_image(image_data, "captured_image.jpg")
 
 
 @app.post("/uploadFile/")
 async def upload_file(file: UploadFile = File(...)):
-    os.makedirs('uploads', exist_ok=True)
-    filename = file.filename
-    image_path = os.path.join("uploads", filename)
-    with open(image_path, "wb") as f:
-        f.write(file.file.read())
-    return process_uploaded_image(image_path, image_processor, db_manager)
+    # The body was already cut off at MAX_REQUEST_BYTES while it was received (see BodySizeLimitMiddleware)
+    with timed("upload_read"):
+        image_data = await file.read()
+    if len(image_data) > MAX_UPLOAD_BYTES:
+        raise upload_too_large()
+    return await process_uploaded_image(image_data, file.filename)
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    workers = int(os.environ.get("SERVER_WORKERS", 1))
+    # Multiple workers need the app as an import string so each worker process can import it
+    uvicorn.run("server:app" if workers > 1 else app, host="127.0.0.1", port=8000, workers=workers)
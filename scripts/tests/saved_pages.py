@@ -0,0 +1,66 @@
+import os
+import re
+from bs4 import BeautifulSoup
+import scrape_manager
+from html_extraction import extract_media_index_links, extract_photo_url, parse_profile
+
+# Saved pages with hand-checked expected results, checked by test_html_extraction and bench_html_extraction
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+SAVED_PAGES_DIR = os.path.join(FIXTURES_DIR, "imdb_pages")
+GOLDEN_PATH = os.path.join(FIXTURES_DIR, "imdb_golden.json")
+# Saved pages are named by their path, like the fixture server expects (name_nm0000001.html)
+PROFILE_FILE = re.compile(r"^name_(nm\d{7})\.html$")
+MEDIA_INDEX_FILE = re.compile(r"^name_nm\d{7}_mediaindex\.html$")
+MEDIA_VIEWER_FILE = re.compile(r"^name_nm\d{7}_mediaviewer_rm\d+\.html$")
+
+
+def page_kind(file_name):
+    if PROFILE_FILE.match(file_name):
+        return "profile"
+    if MEDIA_INDEX_FILE.match(file_name):
+        return "media_index"
+    if MEDIA_VIEWER_FILE.match(file_name):
+        return "photo"
+    return None
+
+
+def load_pages(html_dir):
+    """{file name: html} of the profile, media index and photo pages saved in html_dir."""
+    pages = {}
+    for file_name in sorted(os.listdir(html_dir)):
+        if page_kind(file_name):
+            with open(os.path.join(html_dir, file_name), encoding="utf-8") as f:
+                pages[file_name] = f.read()
+    return pages
+
+
+def profile_url(file_name):
+    return f"{scrape_manager.IMDB_DOMAIN}/name/{PROFILE_FILE.match(file_name).group(1)}/"
+
+
+def extract_profile(soup, file_name):
+    """Celeb info and main photo page link, as JSON-friendly values."""
+    celeb_info = scrape_manager.scrape_celebrity_info(soup, profile_url(file_name))
+    return [str(value) if value is not None else None for value in celeb_info] + \
+        [scrape_manager.get_main_photo_page_url(soup)]
+
+
+def legacy_extract(kind, file_name, html):
+    """The extraction as scrape_manager did it before the extraction layer: a full html.parser soup per page."""
+    soup = BeautifulSoup(html, "html.parser")
+    if kind == "profile":
+        return extract_profile(soup, file_name)
+    if kind == "media_index":
+        div = soup.find("div", {"class": "media_index_thumb_list"})
+        return [link["href"] for link in div.findAll("a")] if div is not None else None
+    image_tag = soup.find(scrape_manager.matches_format)
+    return image_tag["src"] if image_tag else None
+
+
+def extract(kind, file_name, html, backend):
+    if kind == "profile":
+        # Profiles are always parsed into a (strained) soup, since the date helpers work on soup
+        return extract_profile(parse_profile(html), file_name)
+    if kind == "media_index":
+        return extract_media_index_links(html, backend)
+    return extract_photo_url(html, backend)
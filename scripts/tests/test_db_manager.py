@@ -0,0 +1,364 @@
+import functools
+import os
+import sqlite3
+import threading
+import pytest
+
+for module in ("numpy", "mysql.connector", "boto3", "PIL", "requests"):
+    pytest.importorskip(module)
+
+import numpy as np
+import mysql.connector
+from mysql.connector.errors import PoolError
+import db_manager
+from db_manager import DBManager
+
+# A MySQL database the tests may drop and create tables in. The MySQL runs are skipped when it isn't set.
+MYSQL_HOST = os.environ.get("TEST_MYSQL_HOST", "localhost")
+MYSQL_USER = os.environ.get("TEST_MYSQL_USER", "root")
+MYSQL_PASSWORD = os.environ.get("TEST_MYSQL_PASSWORD", "")
+MYSQL_DATABASE = os.environ.get("TEST_MYSQL_DATABASE")
+
+# The same tables as create_images_table and create_face_encodings_table, without the foreign keys
+TEST_TABLES = [
+    "CREATE TABLE Celebs_Images ("
+    "image_id INT AUTO_INCREMENT PRIMARY KEY, "
+    "imdb_id VARCHAR(255), "
+    "image_url VARCHAR(255))",
+    "CREATE TABLE Face_Encodings ("
+    "encoding_id INT AUTO_INCREMENT PRIMARY KEY, "
+    "imdb_id VARCHAR(255) NOT NULL, "
+    "encoding TEXT NOT NULL, "
+    "encoding_blob BLOB DEFAULT NULL, "
+    "image_type VARCHAR(50) NOT NULL, "
+    "image_number INT DEFAULT NULL, "
+    "image_id INT)",
+]
+
+# The only MySQL syntax DBManager's queries use that SQLite spells differently
+MYSQL_TO_SQLITE = [
+    ("%s", "?"),
+    ("INT AUTO_INCREMENT PRIMARY KEY", "INTEGER PRIMARY KEY AUTOINCREMENT"),
+    # imdb_id is the only unique key of the celebs table
+    ("ON DUPLICATE KEY UPDATE", "ON CONFLICT(imdb_id) DO UPDATE SET"),
+]
+
+
+def to_sqlite(query):
+    for mysql_syntax, sqlite_syntax in MYSQL_TO_SQLITE:
+        query = query.replace(mysql_syntax, sqlite_syntax)
+    return query
+
+
+class SQLiteCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, params=()):
+        self._cursor.execute(to_sqlite(query), tuple(params))
+
+    def executemany(self, query, seq_params):
+        self._cursor.executemany(to_sqlite(query), [tuple(params) for params in seq_params])
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self._cursor.fetchmany(size)
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection:
+    """Pooled connection to a SQLite file with the part of mysql.connector's connection API DBManager uses."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.reconnects = 0
+        self.sqlite = pool.connect()
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        try:
+            self.sqlite.execute("SELECT 1")
+        except sqlite3.ProgrammingError:
+            if not reconnect:
+                raise
+            self.sqlite = self.pool.connect()
+            self.reconnects += 1
+
+    def cursor(self, buffered=None):
+        return SQLiteCursor(self.sqlite.cursor())
+
+    def commit(self):
+        self.sqlite.commit()
+
+    def rollback(self):
+        self.sqlite.rollback()
+
+    def consume_results(self):
+        pass
+
+    def close(self):
+        self.pool.put_back(self)
+
+
+class SQLitePool:
+    """Stand-in for MySQLConnectionPool over a SQLite file: raises when exhausted instead of waiting, like it."""
+
+    def __init__(self, pool_size, path, **kwargs):
+        self.path = path
+        self._lock = threading.Lock()
+        self._idle = [SQLiteConnection(self) for _ in range(pool_size)]
+
+    def connect(self):
+        return sqlite3.connect(self.path, check_same_thread=False)
+
+    def get_connection(self):
+        with self._lock:
+            if not self._idle:
+                raise PoolError("Failed getting connection; pool exhausted")
+            return self._idle.pop()
+
+    def put_back(self, connection):
+        with self._lock:
+            self._idle.append(connection)
+
+
+@pytest.fixture(params=["sqlite", "mysql"])
+def engine(request):
+    return request.param
+
+
+@pytest.fixture
+def manager(engine, tmp_path, monkeypatch):
+    if engine == "sqlite":
+        monkeypatch.setattr(db_manager.pooling, "MySQLConnectionPool",
+                            functools.partial(SQLitePool, path=str(tmp_path / "celebs.sqlite")))
+        manager = DBManager("localhost", "user", "password", "celebs_database", "Celebs2", pool_size=2)
+    else:
+        if not MYSQL_DATABASE:
+            pytest.skip("TEST_MYSQL_DATABASE is not set")
+        manager = DBManager(MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD, MYSQL_DATABASE, "Celebs2", pool_size=2)
+        try:
+            drop_tables(manager)
+        except mysql.connector.Error as e:
+            pytest.skip(f"MySQL is not available: {e}")
+
+    manager.create_celeb_table()
+    with manager.transaction() as cursor:
+        for statement in TEST_TABLES:
+            cursor.execute(statement)
+    yield manager
+    if engine == "mysql":
+        drop_tables(manager)
+
+
+def drop_tables(manager):
+    with manager.transaction() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS Face_Encodings, Celebs_Images, Celebs2")
+
+
+def celeb_row(imdb_id, name, age, main_image_url=None):
+    return imdb_id, name, None, None, age, f"/name/{imdb_id}/", main_image_url, None, None
+
+
+def insert_celebs(manager):
+    manager.insert_celeb("nm0000001", "Fred Astaire", None, None, 88, "/name/nm0000001/")
+    manager.insert_celeb("nm0000002", "Lauren Bacall", None, None, 89, "/name/nm0000002/")
+
+
+def count_transactions(manager, monkeypatch):
+    calls = []
+    transaction = manager.transaction
+
+    def counting_transaction(*args, **kwargs):
+        calls.append(args)
+        return transaction(*args, **kwargs)
+
+    monkeypatch.setattr(manager, "transaction", counting_transaction)
+    return calls
+
+
+def encoding(value):
+    return np.full(128, value, dtype=np.float32)
+
+
+def test_insert_celeb_updates_existing_rows(manager):
+    insert_celebs(manager)
+    manager.insert_celeb("nm0000001", "Fred Astaire", None, None, 87, "/name/nm0000001/")
+    assert manager.get_celeb_info("nm0000001") == celeb_row("nm0000001", "Fred Astaire", 87)
+    assert sorted(manager.get_all_imdb_ids()) == ["nm0000001", "nm0000002"]
+
+
+def test_insert_celeb_raises_on_failure(manager):
+    # A failed insert must fail the scraped stage, so the celeb is scraped again
+    manager.current_table = "Missing_Celebs"
+    with pytest.raises(Exception):
+        manager.insert_celeb("nm0000001", "Fred Astaire", None, None, 88, "/name/nm0000001/")
+
+
+def test_transaction_commits(manager):
+    insert_celebs(manager)
+    with manager.transaction() as cursor:
+        cursor.execute("UPDATE Celebs2 SET age = %s WHERE imdb_id = %s", (90, "nm0000001"))
+    assert celeb_row("nm0000001", "Fred Astaire", 90) in manager.get_all_celeb_infos()
+
+
+def test_transaction_rolls_back_on_error(manager):
+    insert_celebs(manager)
+    with pytest.raises(ValueError):
+        with manager.transaction() as cursor:
+            cursor.execute("UPDATE Celebs2 SET age = %s WHERE imdb_id = %s", (90, "nm0000001"))
+            raise ValueError("bad row")
+    assert celeb_row("nm0000001", "Fred Astaire", 88) in manager.get_all_celeb_infos()
+
+
+def test_connection_is_returned_when_the_block_raises(manager):
+    for _ in range(2 * manager.pool_size):
+        with pytest.raises(RuntimeError):
+            with manager.connection():
+                raise RuntimeError("query failed")
+    # Every connection and slot was given back, so the pool doesn't raise for being exhausted
+    with manager.transaction() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM Celebs2")
+        assert cursor.fetchone() == (0,)
+
+
+def test_borrowers_block_at_pool_size(manager):
+    release = threading.Event()
+    holding = threading.Barrier(manager.pool_size + 1)
+    third_got_connection = threading.Event()
+    errors = []
+
+    def hold_connection():
+        try:
+            with manager.connection():
+                holding.wait(timeout=5)
+                release.wait(timeout=5)
+        except Exception as e:
+            errors.append(e)
+
+    def borrow():
+        try:
+            with manager.connection():
+                third_got_connection.set()
+        except Exception as e:
+            errors.append(e)
+
+    holders = [threading.Thread(target=hold_connection) for _ in range(manager.pool_size)]
+    for thread in holders:
+        thread.start()
+    holding.wait(timeout=5)
+
+    waiter = threading.Thread(target=borrow)
+    waiter.start()
+    # The pool is exhausted, so the third borrower waits instead of failing
+    assert not third_got_connection.wait(timeout=0.2)
+    release.set()
+    assert third_got_connection.wait(timeout=5)
+    for thread in holders + [waiter]:
+        thread.join(timeout=5)
+    assert errors == []
+
+
+def test_idle_connections_are_reconnected(manager, engine, monkeypatch):
+    if engine != "sqlite":
+        pytest.skip("needs a connection the test can drop")
+    insert_celebs(manager)
+    # Once idle for too long, a connection the server dropped is reconnected before it is handed out
+    monkeypatch.setattr(db_manager, "HEALTH_CHECK_IDLE_SECONDS", -1)
+    pooled = list(manager._get_pool()._idle)
+    for connection in pooled:
+        connection.sqlite.close()
+    assert manager.get_all_imdb_ids()
+    assert sum(connection.reconnects for connection in pooled) == 1
+
+
+def test_get_celeb_infos_fetches_missing_ids_in_one_query(manager, monkeypatch):
+    insert_celebs(manager)
+    transactions = count_transactions(manager, monkeypatch)
+    infos = manager.get_celeb_infos(["nm0000001", "nm0000002", "nm9999999", "nm0000001"])
+    assert infos == {"nm0000001": celeb_row("nm0000001", "Fred Astaire", 88),
+                     "nm0000002": celeb_row("nm0000002", "Lauren Bacall", 89), "nm9999999": None}
+    assert len(transactions) == 1
+
+
+def test_celeb_infos_are_served_from_the_cache(manager, monkeypatch):
+    insert_celebs(manager)
+    manager.get_celeb_infos(["nm0000001", "nm9999999"])
+    # Changed behind DBManager's back, so only a database read would see it
+    with manager.transaction() as cursor:
+        cursor.execute("UPDATE Celebs2 SET age = %s WHERE imdb_id = %s", (90, "nm0000001"))
+
+    # Known and unknown IDs are both cached, for the bulk and the single lookup
+    transactions = count_transactions(manager, monkeypatch)
+    assert manager.get_celeb_infos(["nm0000001", "nm9999999"]) == {
+        "nm0000001": celeb_row("nm0000001", "Fred Astaire", 88), "nm9999999": None}
+    assert manager.get_celeb_info("nm0000001") == celeb_row("nm0000001", "Fred Astaire", 88)
+    assert manager.get_celeb_info("nm9999999") is None
+    assert transactions == []
+
+    # Only the IDs missing from the cache are queried
+    assert manager.get_celeb_infos(["nm0000001", "nm0000002"])["nm0000002"] == celeb_row("nm0000002",
+                                                                                        "Lauren Bacall", 89)
+    assert len(transactions) == 1
+
+    # Writing a celeb row invalidates its entry
+    manager.update_celeb_main_image_url("nm0000001", "https://example.com/main.jpg")
+    assert manager.get_celeb_info("nm0000001") == celeb_row("nm0000001", "Fred Astaire", 90,
+                                                            "https://example.com/main.jpg")
+
+
+def test_face_encodings(manager):
+    insert_celebs(manager)
+    manager.insert_face_encoding("nm0000001", encoding(1), "main")
+    manager.insert_face_encoding("nm0000001", encoding(2), "additional", image_number=1)
+    manager.insert_face_encoding("nm0000001", encoding(3), "additional", image_number=2)
+    manager.insert_face_encoding("nm0000002", encoding(4), "main")
+
+    np.testing.assert_array_equal(manager.get_main_image_encodings("nm0000001"), encoding(1))
+    additional = manager.get_additional_image_encodings("nm0000001")
+    np.testing.assert_array_equal(np.array(additional), [encoding(2), encoding(3)])
+    assert manager.get_image_count("nm0000001") == 3
+    # Only celebs with additional images count as processed
+    assert manager.get_processed_celebs_ids() == ["nm0000001"]
+
+    batches = list(manager.iter_processed_celebs_encodings(chunk_size=2))
+    imdb_ids = [imdb_id for batch_ids, _ in batches for imdb_id in batch_ids]
+    assert imdb_ids == ["nm0000001"] * 3
+    np.testing.assert_array_equal(np.concatenate([encodings for _, encodings in batches]),
+                                  [encoding(1), encoding(2), encoding(3)])
+
+    manager.delete_face_encodings("nm0000001", "additional")
+    assert manager.get_additional_image_encodings("nm0000001") == []
+    assert manager.get_processed_celebs_ids() == []
+
+
+def test_additional_images_urls(manager):
+    insert_celebs(manager)
+    urls = ["https://example.com/1.jpg", "https://example.com/2.jpg"]
+    manager.insert_additional_images_urls("nm0000001", urls)
+    assert sorted(manager.get_additional_images_urls("nm0000001").values()) == urls
+    assert manager.get_additional_images_urls("nm0000002") == {}
+
+    manager.delete_additional_images_urls("nm0000001")
+    assert manager.get_additional_images_urls("nm0000001") == {}
+
+
+def test_migrate_encodings_to_blob(manager, engine):
+    if engine != "mysql":
+        pytest.skip("looks the encoding_blob column up in MySQL's information_schema")
+    insert_celebs(manager)
+    legacy = ", ".join(str(value) for value in encoding(0.5))
+    with manager.transaction() as cursor:
+        cursor.execute("INSERT INTO Face_Encodings (imdb_id, encoding, image_type) VALUES (%s, %s, %s)",
+                       ("nm0000001", legacy, "additional"))
+    assert manager.migrate_encodings_to_blob() == 1
+    with manager.transaction() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM Face_Encodings WHERE encoding_blob IS NULL")
+        assert cursor.fetchone() == (0,)
+    np.testing.assert_array_equal(manager.get_additional_image_encodings("nm0000001"), [encoding(0.5)])
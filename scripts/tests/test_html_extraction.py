@@ -0,0 +1,43 @@
+import json
+import pytest
+
+# scrape_manager pulls in the DB and image processing modules
+for module in ("bs4", "numpy", "requests", "mysql.connector", "boto3", "PIL", "face_recognition", "annoy"):
+    pytest.importorskip(module)
+
+import scrape_manager
+from html_extraction import AVAILABLE_BACKENDS, extract_media_index_links, extract_photo_url
+from tests.saved_pages import SAVED_PAGES_DIR, GOLDEN_PATH, load_pages, page_kind, extract, legacy_extract
+
+PAGES = load_pages(SAVED_PAGES_DIR)
+with open(GOLDEN_PATH) as f:
+    GOLDEN = json.load(f)
+
+
+@pytest.fixture(autouse=True)
+def imdb_domain(monkeypatch):
+    # Profile and main photo page URLs in the golden file are absolute IMDb URLs
+    monkeypatch.setattr(scrape_manager, "IMDB_DOMAIN", "https://www.imdb.com")
+
+
+def test_every_saved_page_has_a_golden_result():
+    assert sorted(PAGES) == sorted(GOLDEN)
+    assert {page_kind(file_name) for file_name in PAGES} == {"profile", "media_index", "photo"}
+
+
+@pytest.mark.parametrize("backend", AVAILABLE_BACKENDS)
+@pytest.mark.parametrize("file_name", sorted(PAGES))
+def test_extraction_matches_golden(file_name, backend):
+    assert extract(page_kind(file_name), file_name, PAGES[file_name], backend) == GOLDEN[file_name]
+
+
+@pytest.mark.parametrize("file_name", sorted(PAGES))
+def test_legacy_extraction_matches_golden(file_name):
+    assert legacy_extract(page_kind(file_name), file_name, PAGES[file_name]) == GOLDEN[file_name]
+
+
+@pytest.mark.parametrize("backend", AVAILABLE_BACKENDS)
+@pytest.mark.parametrize("html", ["", "   ", "<!-- truncated -->"])
+def test_pages_without_elements_extract_nothing(html, backend):
+    assert extract_media_index_links(html, backend) is None
+    assert extract_photo_url(html, backend) is None
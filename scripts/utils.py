@@ -1,18 +1,55 @@
 import os
+import threading
 from io import BytesIO
 import re
 import boto3
 import numpy as np
 from PIL import Image
 from botocore.config import Config
-import requests
+from cache import TTLCache, MISSING
+from http_session import http_get
 
 
 MAX_IMAGE_SIZE = 500
+ENCODING_SEPARATORS = str.maketrans("[],\n", "    ")
+ENCODING_DTYPE = np.dtype('<f4')
+
+S3_REGION = 'eu-north-1'
+PRESIGNED_URL_EXPIRATION = 3600
+# Cached pre-signed URLs are handed out until this many seconds before they expire
+PRESIGNED_URL_REFRESH_MARGIN = 300
+
+# botocore client setup costs milliseconds, so one client is shared by all calls (clients are thread-safe)
+_s3_client = None
+_s3_client_pid = None
+_s3_client_lock = threading.Lock()
+presigned_url_cache = TTLCache(maxsize=20000)
+
+
+def get_memory_usage():
+    """
+    Resident memory of the current process in MB, as reported by /proc on Linux:
+    - VmRSS: total resident set.
+    - RssAnon: private anonymous memory (heap, unpickled objects).
+    - RssFile: resident file-backed pages, e.g. memory-mapped index files shared with other processes.
+    - Pss: proportional share, where pages shared by N processes count 1/N each.
+    Returns an empty dict when /proc is unavailable.
+    """
+    usage = {}
+    for path, keys in (('/proc/self/status', ('VmRSS', 'RssAnon', 'RssFile')), ('/proc/self/smaps_rollup', ('Pss',))):
+        try:
+            with open(path) as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in keys:
+                        usage[key] = int(value.split()[0]) / 1024
+        except OSError:
+            pass
+    return usage
 
 
 def download_image(url, resize=False):
-    response = requests.get(url)
+    response = http_get(url)
     img = Image.open(BytesIO(response.content))
     if img.mode != "RGB":  # if the image is not RGB or grayscale
 
@@ -26,24 +63,49 @@ def download_image(url, resize=False):
     return img_array
 
 
-def create_presigned_url(bucket_name, image_s3_url, expiration=3600):
-    s3 = boto3.client('s3',
-                      aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID"),
-                      aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
-                      config=Config(signature_version='s3v4'),
-                      region_name='eu-north-1',
-                      )
+def get_s3_client():
+    """Return the process-wide S3 client used for signing, creating it on first use (and again after a fork)."""
+    global _s3_client, _s3_client_pid
+    with _s3_client_lock:
+        if _s3_client is None or _s3_client_pid != os.getpid():
+            _s3_client = boto3.client('s3',
+                                      aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID"),
+                                      aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
+                                      config=Config(signature_version='s3v4'),
+                                      region_name=S3_REGION,
+                                      )
+            _s3_client_pid = os.getpid()
+        return _s3_client
+
+
+def create_presigned_url(bucket_name, image_s3_url, expiration=PRESIGNED_URL_EXPIRATION):
+    """
+    Generate a pre-signed GET URL for an S3 object URL. A URL generated earlier for the same object and expiration
+    is reused until PRESIGNED_URL_REFRESH_MARGIN seconds before it expires.
+    """
     key = image_s3_url.split(".s3.amazonaws.com/")[-1]
-    url = s3.generate_presigned_url(
+    cache_key = (bucket_name, key, expiration)
+    url = presigned_url_cache.get(cache_key)
+    if url is not MISSING:
+        return url
+
+    url = get_s3_client().generate_presigned_url(
         'get_object',
         Params={
             'Bucket': bucket_name,
             'Key': key,
-        }
+        },
+        ExpiresIn=expiration,
     )
+    presigned_url_cache.set(cache_key, url, ttl=max(expiration - PRESIGNED_URL_REFRESH_MARGIN, 0))
     return url
 
 
+def create_presigned_urls(bucket_name, image_s3_urls, expiration=PRESIGNED_URL_EXPIRATION):
+    """create_presigned_url for every URL, in the same order. Signing is local, so this is a plain loop."""
+    return [create_presigned_url(bucket_name, image_s3_url, expiration) for image_s3_url in image_s3_urls]
+
+
 def save_all_main_images(db_manager, s3, bucket_name):
     """Save all main images to S3."""
     all_imdb_ids = db_manager.get_all_imdb_ids()
@@ -78,32 +140,36 @@ def save_main_image_to_s3(main_image_url, celeb_id, celeb_name, s3, bucket_name,
     - db_manager: DBManager instance for updating the DB.
     """
     try:
-        # Download the image as a numpy array
-        main_image_np = download_image(main_image_url)
+        upload_main_image_to_s3(main_image_url, celeb_id, celeb_name, s3, bucket_name, db_manager)
+    except Exception as e:
+        print(f"Error saving main image for {celeb_id} to S3: {e}")
 
-        # Convert the numpy array back to a PIL Image
-        image = Image.fromarray(main_image_np)
 
-        # Prepare the image for saving to S3 - convert it to bytes
-        buffer = BytesIO()
-        image.save(buffer, format="JPEG")
-        buffer.seek(0)
+def upload_main_image_to_s3(main_image_url, celeb_id, celeb_name, s3, bucket_name, db_manager):
+    """Like save_main_image_to_s3, but raises on failure, e.g. for the ingestion job to be retried."""
+    # Download the image as a numpy array
+    main_image_np = download_image(main_image_url)
 
-        # Sanitize the celebrity name for S3 path
-        sanitized_name = sanitize_name(celeb_name)
+    # Convert the numpy array back to a PIL Image
+    image = Image.fromarray(main_image_np)
 
-        # Define the path for the main image in S3
-        s3_path = f"{celeb_id}_{sanitized_name}/main_image.jpg"
+    # Prepare the image for saving to S3 - convert it to bytes
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG")
+    buffer.seek(0)
 
-        # Save the image to S3
-        s3.upload_fileobj(buffer, bucket_name, s3_path)
+    # Sanitize the celebrity name for S3 path
+    sanitized_name = sanitize_name(celeb_name)
 
-        # Optionally, update the database with the S3 URL of the main image (if needed later)
-        main_image_s3_url = f"https://{bucket_name}.s3.amazonaws.com/{s3_path}"
-        db_manager.update_celeb_main_image_url(celeb_id, main_image_s3_url, to_s3=True)
+    # Define the path for the main image in S3
+    s3_path = f"{celeb_id}_{sanitized_name}/main_image.jpg"
 
-    except Exception as e:
-        print(f"Error saving main image for {celeb_id} to S3: {e}")
+    # Save the image to S3
+    s3.upload_fileobj(buffer, bucket_name, s3_path)
+
+    # Optionally, update the database with the S3 URL of the main image (if needed later)
+    main_image_s3_url = f"https://{bucket_name}.s3.amazonaws.com/{s3_path}"
+    db_manager.update_celeb_main_image_url(celeb_id, main_image_s3_url, to_s3=True)
 
 
 def string_to_encoding_main_image(encoding_str):
@@ -119,14 +185,29 @@ def string_to_encoding_additional_image(encoding_str):
     return encoding
 
 
-def create_processed_celebs_names_file(db_manager):
-    with open('saved_celebs.txt', 'r') as f:
-        ids_list = f.readlines()
+def encoding_to_blob(encoding):
+    """Serialize an encoding (or a list holding one) to raw little-endian float32 bytes, 512 for 128 values."""
+    return np.asarray(encoding, dtype=ENCODING_DTYPE).reshape(-1).tobytes()
+
 
-    with open('../data/saved_celebs_names.txt', 'a', encoding='utf-8') as f:
-        for current_id in ids_list:
-            current_id = current_id[:-1]  # Removing the '\n'
-            celeb_data = db_manager.get_celeb_info(current_id)
-            name = celeb_data[1]
-            page_url = celeb_data[5]
-            f.write(f"{current_id:<9} - {name:<25} - {page_url:<35}\n")
+def blob_to_encoding(blob):
+    """Zero-copy view of a stored encoding blob as a float32 array."""
+    return np.frombuffer(blob, dtype=ENCODING_DTYPE)
+
+
+def blobs_to_encodings(blobs, vector_length=128):
+    """Decode a batch of encoding blobs into an (n, vector_length) float32 array."""
+    return np.frombuffer(b"".join(blobs), dtype=ENCODING_DTYPE).reshape(len(blobs), vector_length)
+
+
+def strings_to_encodings(encoding_strs, vector_length=128):
+    """
+    Parse a batch of stored encodings in either text format (numpy repr for main images, comma-separated for
+    additional ones) into an (n, vector_length) float32 array with a single vectorized parse.
+    """
+    # Both formats become plain whitespace-separated numbers once brackets and commas are blanked out
+    text = " ".join(encoding_strs).translate(ENCODING_SEPARATORS)
+    values = np.fromstring(text, dtype=np.float32, sep=' ')
+    if values.size != len(encoding_strs) * vector_length:
+        raise ValueError(f"Expected {len(encoding_strs)} encodings of length {vector_length}, got {values.size} values.")
+    return values.reshape(len(encoding_strs), vector_length)